@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Numerical equivalence and cost of the numpy cleanup engine (utils/denoise.py).
+
+Synthetic mode (default) writes a small .ica directory and compares the block-wise engine with a direct
+in-memory implementation of the fix_cleanup.m regression, for soft and aggressive cleanup with and
+without motion confounds. Each run happens in a forked process so peak memory is measured separately.
+
+FIX mode compares the engine with a `fix -a` output of a real ICA directory:
+
+    python benchmarks/cleanup_engine.py --icadir sub-01_task-rest_bold_hp2000.ica \
+        --labels fix4melview_HCP_hp2000_thr10.txt --fix-output sub-01_task-rest_bold_hp2000_clean.nii.gz [-m]
+
+Usage:
+    python benchmarks/cleanup_engine.py --shape 64 64 40 --timepoints 400 --components 80
+"""
+
+import argparse
+import multiprocessing
+import os
+import os.path as op
+import resource
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+from utils import denoise  # noqa: E402
+
+
+def synthetic_ica(icadir, shape, ntime, ncomp, tr=0.8, seed=0):
+    """Write filtered_func_data, melodic_mix, motion parameters and labels; returns the labels file."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(op.join(icadir, "filtered_func_data.ica"))
+    os.makedirs(op.join(icadir, "mc"))
+
+    mix = rng.normal(size=(ntime, ncomp))
+    maps = rng.normal(size=(int(np.prod(shape)), ncomp)).astype(np.float32)
+    data = maps @ mix.T.astype(np.float32) + rng.normal(0, 1, (maps.shape[0], ntime)).astype(np.float32) + 1000
+
+    img = nib.Nifti1Image(data.reshape(shape + (ntime,)), np.diag([2.0, 2.0, 2.0, 1.0]))
+    img.header.set_zooms((2.0, 2.0, 2.0, tr))
+    nib.save(img, op.join(icadir, "filtered_func_data.nii.gz"))
+    np.savetxt(op.join(icadir, "filtered_func_data.ica", "melodic_mix"), mix, fmt="%.8f")
+    np.savetxt(op.join(icadir, "mc", "prefiltered_func_data_mcf.par"), np.cumsum(rng.normal(0, 0.01, (ntime, 6)), 0))
+
+    noise = sorted(rng.choice(np.arange(1, ncomp + 1), ncomp // 2, replace=False).tolist())
+    labels_file = op.join(icadir, "fix4melview_synthetic_thr10.txt")
+    with open(labels_file, "w") as f:
+        f.write(icadir + "\n" + "\n[" + ", ".join(str(n) for n in noise) + "]\n")
+    return labels_file
+
+
+def reference_cleanup(icadir, labels_file, aggressive, motion, highpass):
+    """Whole-series regression in the order used by fix_cleanup.m (motion first, then components)."""
+    img = nib.load(op.join(icadir, "filtered_func_data.nii.gz"))
+    ts = np.asarray(img.dataobj, dtype=np.float64).reshape(-1, img.shape[3]).T
+    mean = ts.mean(axis=0)
+    ts = ts - mean
+    mix = np.loadtxt(op.join(icadir, "filtered_func_data.ica", "melodic_mix"), ndmin=2)
+    idx = [n - 1 for n in denoise.read_noise_labels(labels_file)]
+
+    if motion:
+        conf = denoise.motion_confounds(op.join(icadir, "mc", "prefiltered_func_data_mcf.par"),
+                                        float(img.header.get_zooms()[3]), highpass)
+        pinv_conf = denoise.pinv(conf)
+        ts = ts - conf @ (pinv_conf @ ts)
+        mix = mix - conf @ (pinv_conf @ mix)
+
+    if aggressive:
+        ts = ts - mix[:, idx] @ (denoise.pinv(mix[:, idx]) @ ts)
+    else:
+        beta = denoise.pinv(mix) @ ts
+        ts = ts - mix[:, idx] @ beta[idx]
+
+    return (ts + mean).T.reshape(img.shape).astype(np.float32)
+
+
+def engine_cleanup(icadir, labels_file, aggressive, motion, highpass, out_file):
+    mix = np.loadtxt(op.join(icadir, "filtered_func_data.ica", "melodic_mix"), ndmin=2)
+    in_file = op.join(icadir, "filtered_func_data.nii.gz")
+    conf = None
+    if motion:
+        conf = denoise.motion_confounds(op.join(icadir, "mc", "prefiltered_func_data_mcf.par"),
+                                        float(nib.load(in_file).header.get_zooms()[3]), highpass)
+    remove = denoise.cleanup_matrix(mix, denoise.read_noise_labels(labels_file), aggressive=aggressive,
+                                    confounds=conf)
+    denoise.clean_volume(in_file, out_file, remove)
+
+
+def measured(func, *args):
+    """Run func in a forked process; returns (result, seconds, peak RSS in MB)."""
+    def target(queue):
+        start = time.perf_counter()
+        result = func(*args)
+        queue.put((result, time.perf_counter() - start,
+                   resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=target, args=(queue,))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def compare(label, cleaned, expected):
+    diff = np.abs(cleaned - expected)
+    scale = np.abs(expected - expected.mean(axis=-1, keepdims=True)).max()
+    corr = np.corrcoef(cleaned.ravel(), expected.ravel())[0, 1]
+    print(f"{label:<28s} max abs diff {diff.max():.3e} (relative {diff.max() / scale:.2e}), r = {corr:.9f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shape", type=int, nargs=3, default=[48, 56, 48])
+    parser.add_argument("--timepoints", type=int, default=300)
+    parser.add_argument("--components", type=int, default=60)
+    parser.add_argument("--highpass", type=float, default=2000)
+    parser.add_argument("--icadir", help="compare with a FIX output for this .ica directory")
+    parser.add_argument("--labels", help="labels file (in --icadir) used for the FIX output")
+    parser.add_argument("--fix-output", help="filtered_func_data_clean written by fix -a")
+    parser.add_argument("-m", dest="motion", action="store_true", help="FIX output used motion regression")
+    parser.add_argument("-A", dest="aggressive", action="store_true", help="FIX output used aggressive cleanup")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out_file = op.join(tmpdir, "engine_clean.nii.gz")
+
+        if args.icadir:
+            labels_file = op.join(args.icadir, args.labels)
+            _, seconds, rss = measured(engine_cleanup, args.icadir, labels_file, args.aggressive, args.motion,
+                                       args.highpass, out_file)
+            print(f"engine: {seconds:.1f} s, peak RSS {rss:.0f} MB")
+            compare("engine vs fix -a", np.asarray(nib.load(out_file).dataobj),
+                    np.asarray(nib.load(args.fix_output).dataobj, dtype=np.float32))
+            return
+
+        icadir = op.join(tmpdir, "synthetic_hp2000.ica")
+        labels_file = synthetic_ica(icadir, tuple(args.shape), args.timepoints, args.components)
+        for aggressive in (False, True):
+            for motion in (False, True):
+                label = ("aggressive" if aggressive else "soft") + (" + motion" if motion else "")
+                expected, ref_seconds, ref_rss = measured(reference_cleanup, icadir, labels_file, aggressive,
+                                                          motion, args.highpass)
+                _, seconds, rss = measured(engine_cleanup, icadir, labels_file, aggressive, motion,
+                                           args.highpass, out_file)
+                compare(label, np.asarray(nib.load(out_file).dataobj), expected)
+                print(f"{'':<28s} engine {seconds:.2f} s / {rss:.0f} MB, "
+                      f"in-memory {ref_seconds:.2f} s / {ref_rss:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Local stand-ins for the flywheel client and gear context used by the offline benchmarks.
+
+FakeClient serves a project / subject / session / analysis hierarchy from memory, with the acquisitions
+and files (BIDS and mriqc info) the gear looks up. Every API call is counted and can be given a fixed
+latency, so the number and cost of flywheel round trips can be measured without a flywheel instance.
+FakeGearContext provides the GearToolkitContext attributes the gear uses (config, inputs, client,
+work/output directories and destination).
+"""
+
+import json
+import os
+import os.path as op
+import re
+import time
+from collections import Counter
+from pathlib import Path
+from types import SimpleNamespace
+
+MANIFEST = op.join(op.dirname(op.dirname(op.abspath(__file__))), "manifest.json")
+
+DESTINATION_ID = "64a1b2c3d4e5f6a7b8c9d0e1"
+SESSION_ID = "64a1b2c3d4e5f6a7b8c9d0e2"
+SUBJECT_ID = "64a1b2c3d4e5f6a7b8c9d0e3"
+
+
+class FileEntry(SimpleNamespace):
+    """Container file; update_info replaces the given top level info keys (as flywheel does)."""
+
+    def update_info(self, info):
+        self.client._call("file.update_info")
+        self.info.update(json.loads(json.dumps(info, default=str)))
+
+
+class Finder:
+    """Container children with iter_find() / find('label=~<regex>') like flywheel finders."""
+
+    def __init__(self, client, items):
+        self.client = client
+        self.items = items
+
+    def iter_find(self, *filters):
+        return iter(self.find(*filters))
+
+    def find(self, *filters):
+        self.client._call("finder.find")
+        items = self.items
+        for flt in filters:
+            key, regex = flt.split("=~", 1)
+            items = [c for c in items if re.search(regex, getattr(c, key))]
+        return list(items)
+
+
+class FakeClient:
+    """
+    In-memory flywheel client for one session with an analysis as the gear destination.
+    Args:
+        acquisitions (list): (acquisition label, BIDS filename) of each functional run
+        dummy_trs (int): mriqc dummy_trs stored in each file's IQM info
+        latency (float): seconds added to every API call
+        subject (str), session (str): labels
+    """
+
+    def __init__(self, acquisitions, dummy_trs=0, latency=0.0, subject="01", session="01"):
+        self.latency = latency
+        self.calls = Counter()
+        self.seconds = 0.0
+        self.containers = {}
+
+        self.subject = self._add(id=SUBJECT_ID, label=subject, container_type="subject")
+        acqs = []
+        for i, (label, bids_filename) in enumerate(acquisitions):
+            acq = self._add(id="%024x" % (0xacacac000000 + i), label=label, container_type="acquisition",
+                            parents={"subject": SUBJECT_ID, "session": SESSION_ID})
+            acq.files = [FileEntry(client=self, name=label + ".nii.gz", type="nifti",
+                                   info={"BIDS": {"Filename": bids_filename},
+                                         "IQM": {"dummy_trs": dummy_trs}})]
+            acqs.append(acq)
+        self.session = self._add(id=SESSION_ID, label=session, container_type="session",
+                                 parents={"subject": SUBJECT_ID}, acquisitions=Finder(self, acqs))
+        self.analysis = self._add(id=DESTINATION_ID, label="hcp-icafix", container_type="analysis",
+                                  parents={"subject": SUBJECT_ID, "session": SESSION_ID},
+                                  parent={"id": SESSION_ID, "type": "session"},
+                                  gear_info={"name": "hcp-icafix", "version": "0.0.0"})
+
+    def get(self, container_id):
+        self._call("get")
+        return self._lookup(container_id)
+
+    def get_container(self, container_id):
+        self._call("get_container")
+        return self._lookup(container_id)
+
+    def get_analysis(self, container_id):
+        self._call("get_analysis")
+        return self._lookup(container_id)
+
+    def get_subject(self, container_id):
+        self._call("get_subject")
+        return self._lookup(container_id)
+
+    def get_session(self, container_id):
+        self._call("get_session")
+        return self._lookup(container_id)
+
+    def get_acquisition(self, container_id):
+        self._call("get_acquisition")
+        return self._lookup(container_id)
+
+    def stats(self):
+        """API call counts and simulated time."""
+        return {"calls": dict(self.calls), "total_calls": sum(self.calls.values()), "seconds": self.seconds}
+
+    def _add(self, **fields):
+        container = SimpleNamespace(**fields)
+        self.containers[container.id] = container
+        return container
+
+    def _lookup(self, container_id):
+        if container_id not in self.containers:
+            # e.g. the analysis which produced a previous results archive
+            return SimpleNamespace(id=container_id, parents={"subject": SUBJECT_ID, "session": SESSION_ID})
+        return self.containers[container_id]
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+            self.seconds += self.latency
+
+
+class FakeGearContext:
+    """
+    GearToolkitContext stand-in: config defaults from manifest.json, local inputs and directories.
+    Args:
+        client (FakeClient): flywheel client
+        inputs (dict): input name -> local file path
+        work_dir (str), output_dir (str): gear directories (created if missing)
+        config (dict): config values overriding the manifest defaults
+    """
+
+    def __init__(self, client, inputs, work_dir, output_dir, config=None):
+        with open(MANIFEST) as f:
+            manifest = json.load(f)
+        self.config = {k: v["default"] for k, v in manifest["config"].items() if "default" in v}
+        self.config.update(config or {})
+        self.client = client
+        self.inputs = inputs
+        self.destination = {"id": client.analysis.id, "type": "analysis"}
+        self.work_dir = _directory(work_dir)
+        self.output_dir = _directory(output_dir)
+
+    def get_input_path(self, name):
+        return self.inputs.get(name)
+
+
+def _directory(path):
+    os.makedirs(path, exist_ok=True)
+    return Path(path)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""Offline benchmark of the gear orchestration: GearArgs, main.run (task stages, report), filemapper and
+cleanup/archive, on a synthetic HCP archive with stub FSL/FIX/workbench executables and a local fake
+flywheel client (see synthetic_hcp.py, stub_tools.py and fake_flywheel.py).
+
+The external tools finish immediately (or after --stub-seconds), so the measured time is the gear's own
+overhead: unzipping, trimming / restitching, file searches, metadata, report rendering, file mapping and
+the output archive. Stage timings come from utils.profiling.
+
+Each run is appended to a results file (json lines) with the commit, parameters, per-stage wall time,
+flywheel API call counts and external command counts; the summary compares the median of this session
+with the most recent earlier session that used the same parameters.
+
+Usage:
+    python benchmarks/pipeline.py --mode hcpfix --runs 4 --timepoints 300 --repeat 3
+    python benchmarks/pipeline.py --mode fix-cleanup --config cleanup-engine=numpy --label numpy-engine
+"""
+
+import argparse
+import json
+import logging
+import os
+import os.path as op
+import statistics
+import subprocess as sp
+import sys
+import tempfile
+import time
+from collections import Counter, OrderedDict
+
+BENCHMARK_DIR = op.dirname(op.abspath(__file__))
+sys.path.insert(0, op.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import fake_flywheel  # noqa: E402
+import stub_tools  # noqa: E402
+import synthetic_hcp  # noqa: E402
+import utils.profiling as profiling  # noqa: E402
+from fw_gear_icafix.main import run  # noqa: E402
+from fw_gear_icafix.parser import GearArgs  # noqa: E402
+
+RESULTS_FILE = op.join(BENCHMARK_DIR, "results", "pipeline.jsonl")
+
+# gear input holding the archive in each mode
+MODE_INPUTS = {"hcpfix": "hcp_zip", "fix-cleanup": "previous-results"}
+
+
+def parse_config(items):
+    """KEY=VALUE pairs, values parsed as json where possible (numbers, true/false)."""
+    config = {}
+    for item in items or []:
+        key, value = item.split("=", 1)
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+
+def run_once(archive, tasks, args, config, tmpdir, index):
+    """Run the gear once in fresh directories; returns the result record."""
+    rundir = op.join(tmpdir, "run%02d" % index)
+    stub_log = op.join(rundir, "commands.tsv")
+    os.makedirs(rundir)
+
+    env = stub_tools.install(op.join(tmpdir, "stubs"))
+    env.update({"ICAFIX_STUB_LOG": stub_log, "ICAFIX_STUB_SECONDS": str(args.stub_seconds),
+                "ICAFIX_STUB_COMPONENTS": str(args.components)})
+    saved_environ, saved_cwd = dict(os.environ), os.getcwd()
+    os.environ.update(env)
+
+    client = fake_flywheel.FakeClient(
+        [(label, "sub-%s_ses-%s_%s_bold.nii.gz" % (synthetic_hcp.SUBJECT, synthetic_hcp.SESSION,
+                                                    label.replace("func-bold_", "")))
+         for label, _ in tasks],
+        dummy_trs=args.dummy_volumes, latency=args.latency)
+    gear_config = {"gear-writable-dir": op.join(tmpdir, "scratch"),
+                   "DropNonSteadyState": bool(args.dummy_volumes)}
+    gear_config.update(config)
+    context = fake_flywheel.FakeGearContext(client, {MODE_INPUTS[args.mode]: archive},
+                                            op.join(rundir, "work"), op.join(rundir, "output"), gear_config)
+
+    profiling.reset()
+    start = time.perf_counter()
+    try:
+        with profiling.stage("setup"):
+            gear_args = GearArgs(context)
+        exit_code = run(gear_args)
+    finally:
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_environ)
+    total = time.perf_counter() - start
+
+    stages = OrderedDict()
+    for record in profiling.records():
+        stages[record["stage"]] = round(stages.get(record["stage"], 0) + record["wall_s"], 3)
+
+    commands = Counter()
+    if op.exists(stub_log):
+        with open(stub_log) as f:
+            commands.update(line.split("\t")[0] for line in f)
+
+    return OrderedDict([
+        ("timestamp", time.strftime("%Y-%m-%dT%H:%M:%S")),
+        ("commit", git_commit()),
+        ("label", args.label),
+        ("params", benchmark_params(args, config)),
+        ("exit_code", exit_code),
+        ("total_s", round(total, 3)),
+        ("stages", stages),
+        ("api", client.stats()),
+        ("commands", dict(commands)),
+        ("output_mb", round(sum(op.getsize(op.join(context.output_dir, f))
+                                for f in os.listdir(context.output_dir)) / 1024 ** 2, 1)),
+    ])
+
+
+def benchmark_params(args, config):
+    return OrderedDict([("mode", args.mode), ("runs", args.runs), ("timepoints", args.timepoints),
+                        ("shape", list(args.shape)), ("grayordinates", args.grayordinates),
+                        ("components", args.components), ("dummy_volumes", args.dummy_volumes),
+                        ("latency", args.latency), ("stub_seconds", args.stub_seconds), ("config", config)])
+
+
+def git_commit():
+    try:
+        commit = sp.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR, stdout=sp.PIPE, stderr=sp.DEVNULL,
+                        universal_newlines=True, check=True).stdout.strip()
+        dirty = sp.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BENCHMARK_DIR, stdout=sp.PIPE,
+                       universal_newlines=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def load_results(filename):
+    if not op.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def medians(results):
+    """Median total and per-stage wall time of a list of result records."""
+    stages = OrderedDict()
+    for result in results:
+        for stage, seconds in result["stages"].items():
+            stages.setdefault(stage, []).append(seconds)
+    return (statistics.median(r["total_s"] for r in results),
+            OrderedDict((stage, statistics.median(values)) for stage, values in stages.items()))
+
+
+def print_summary(results, previous):
+    total, stages = medians(results)
+    print("\n%-28s %10s" % ("stage", "median s") + ("  %10s %8s" % ("previous", "change") if previous else ""))
+
+    prev_total, prev_stages = medians(previous) if previous else (None, {})
+    for stage, seconds in list(stages.items()) + [("total", total)]:
+        line = "%-28s %10.3f" % (stage, seconds)
+        before = prev_total if stage == "total" else prev_stages.get(stage)
+        if before:
+            line += "  %10.3f %+7.1f%%" % (before, 100.0 * (seconds - before) / before)
+        print(line)
+
+    if previous:
+        print("\nprevious: %s (%s, %s run(s))" % (previous[0]["timestamp"], previous[0]["commit"], len(previous)))
+    print("flywheel api calls: %s, external commands: %s" % (results[0]["api"]["total_calls"],
+                                                             sum(results[0]["commands"].values())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=sorted(MODE_INPUTS), default="hcpfix")
+    parser.add_argument("--runs", type=int, default=2, help="functional runs (task directories)")
+    parser.add_argument("--timepoints", type=int, default=200)
+    parser.add_argument("--shape", type=int, nargs=3, default=[32, 38, 32])
+    parser.add_argument("--grayordinates", type=int, default=5000)
+    parser.add_argument("--components", type=int, default=20)
+    parser.add_argument("--dummy-volumes", type=int, default=2, help="0 disables trimming")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every flywheel API call")
+    parser.add_argument("--stub-seconds", type=float, default=0.0, help="runtime of every external command")
+    parser.add_argument("--config", nargs="*", metavar="KEY=VALUE", help="gear config overrides")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--label", default="", help="free text stored with the results")
+    parser.add_argument("--results", default=RESULTS_FILE, help="results file (json lines)")
+    parser.add_argument("--no-record", action="store_true", help="do not append to the results file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the gear log")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="[%(asctime)s %(levelname)s %(name)s] %(message)s")
+    config = parse_config(args.config)
+    params = benchmark_params(args, config)
+    previous = [r for r in load_results(args.results) if r["params"] == json.loads(json.dumps(params))]
+    if previous:
+        # most recent earlier session: runs recorded with the same commit and label as the last one
+        last = previous[-1]
+        previous = [r for r in previous if (r["commit"], r["label"]) == (last["commit"], last["label"])]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        tree = op.join(tmpdir, "tree")
+        tasks = synthetic_hcp.hcp_tree(tree, args.runs, args.timepoints, tuple(args.shape), args.grayordinates,
+                                       previous_results=args.mode == "fix-cleanup", ncomp=args.components,
+                                       dummy_trs=args.dummy_volumes)
+        archive = op.join(tmpdir, "input.zip")
+        synthetic_hcp.write_archive(archive, tree)
+        print("input archive: %.1f MB (%.1f s to generate)" % (op.getsize(archive) / 1024 ** 2,
+                                                                time.perf_counter() - start))
+
+        results = []
+        for i in range(args.repeat):
+            result = run_once(archive, tasks, args, config, tmpdir, i)
+            print("run %s: %.2f s (exit code %s)" % (i + 1, result["total_s"], result["exit_code"]))
+            results.append(result)
+
+    if not args.no_record:
+        os.makedirs(op.dirname(op.abspath(args.results)), exist_ok=True)
+        with open(args.results, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    print_summary(results, previous)
+
+
+if __name__ == "__main__":
+    main()
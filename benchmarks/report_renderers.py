@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Benchmark per-component latency of the report component renderers (nilearn glass brain vs numpy MIP).
+
+Creates a synthetic melodic_IC.nii.gz / melodic_mix / mean.nii.gz in a temporary directory and renders
+the same components with each renderer.
+
+Usage:
+    python benchmarks/report_renderers.py --components 20 --shape 91 109 91 --timepoints 400
+"""
+
+import argparse
+import os
+import os.path as op
+import sys
+import tempfile
+import time
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+from utils.report.report import ComponentData, _render_components  # noqa: E402
+
+
+def synthetic_ica(outdir, shape, ncomp, ntime, seed=0):
+    """Write smooth random component maps, a mixing matrix and a mean image; returns the filenames."""
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing="ij"), axis=-1)
+
+    maps = np.zeros(shape + (ncomp,), dtype=np.float32)
+    for k in range(ncomp):
+        center = rng.uniform(0.2, 0.8, 3) * shape
+        dist = np.sum((grid - center) ** 2, axis=-1)
+        maps[..., k] = rng.choice([-1, 1]) * 10 * np.exp(-dist / (2 * (min(shape) / 8) ** 2))
+    maps += rng.normal(0, 0.1, maps.shape).astype(np.float32)
+
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    melodic_filename = op.join(outdir, "melodic_IC.nii.gz")
+    nib.save(nib.Nifti1Image(maps, affine), melodic_filename)
+
+    mean_filename = op.join(outdir, "mean.nii.gz")
+    nib.save(nib.Nifti1Image(np.abs(maps).sum(axis=-1), affine), mean_filename)
+
+    mix = rng.normal(size=(ntime, ncomp))
+    return melodic_filename, mean_filename, mix
+
+
+def benchmark(renderer, melodic_filename, mean_filename, mix, tr, outdir):
+    components = [(k, f"Comp. {k + 1} [Signal]: variance: 1.00%", "green",
+                   op.join(outdir, f"{renderer}_C{k + 1:02d}.png")) for k in range(mix.shape[1])]
+
+    start = time.perf_counter()
+    _render_components(ComponentData(melodic_filename, mix, tr), components, backend="Agg", renderer=renderer,
+                       background_filename=mean_filename)
+    return (time.perf_counter() - start) / len(components)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--components", type=int, default=20)
+    parser.add_argument("--shape", type=int, nargs=3, default=[91, 109, 91])
+    parser.add_argument("--timepoints", type=int, default=400)
+    parser.add_argument("--tr", type=float, default=0.8)
+    parser.add_argument("--renderers", nargs="+", default=["nilearn", "mip"])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as outdir:
+        melodic_filename, mean_filename, mix = synthetic_ica(outdir, tuple(args.shape), args.components,
+                                                             args.timepoints)
+        results = {}
+        for renderer in args.renderers:
+            results[renderer] = benchmark(renderer, melodic_filename, mean_filename, mix, args.tr, outdir)
+            print(f"{renderer:>8s}: {1000 * results[renderer]:8.1f} ms/component")
+
+        if "nilearn" in results and "mip" in results:
+            print(f"speedup: {results['nilearn'] / results['mip']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
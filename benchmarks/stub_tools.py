@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Stand-ins for the FSL / FIX / workbench executables the gear runs, for offline benchmarks.
+
+Each stub writes outputs with the names and formats the real tool writes (synthetic content, see
+synthetic_hcp.py), so the orchestration around it runs unchanged:
+  - hcp_fix <4D> <hp> <mot_reg> <training> <threshold> <del_intermediates>: high-pass filtered series,
+    <task>_hp<hp>.ica (melodic outputs, FIX features and labels) and the cleaned volume / CIFTI series
+  - fix -c <icadir> <training> <threshold>: features (only if missing, as fix) and labels
+  - fix -a <labels> [-m] [-h <hp>] [-A]: filtered_func_data_clean and Atlas_clean
+  - fslroi <in> <out> <tmin> <tsize>, fslmerge -t <out> <in>...: frame selection / concatenation
+  - wb_command -cifti-merge <out> -cifti <in> ...: copy of the first input
+
+Set ICAFIX_STUB_SECONDS to add a fixed runtime per call, ICAFIX_STUB_COMPONENTS for the number of ICA
+components and ICAFIX_STUB_LOG to record every call (tool, seconds, arguments; tab separated).
+
+install() writes wrapper scripts in the locations the gear uses ($FSL_FIXDIR/fix,
+$HCPPIPEDIR/ICAFIX/hcp_fix, and a bin directory on PATH) and returns the environment to run with.
+"""
+
+import os
+import os.path as op
+import shutil
+import stat
+import sys
+import time
+
+import nibabel as nib
+import numpy as np
+
+sys.path.insert(0, op.dirname(op.abspath(__file__)))
+
+import synthetic_hcp  # noqa: E402
+
+TOOLS = ["hcp_fix", "fix", "fslroi", "fslmerge", "wb_command"]
+
+
+def install(stub_dir, env=None):
+    """
+    Install wrappers for all TOOLS below stub_dir.
+    Args:
+        stub_dir (str): directory for the fix, HCP-Pipelines and bin trees
+        env (dict): environment to extend, default: os.environ
+    Returns:
+        dict: environment with FSL_FIXDIR, HCPPIPEDIR, FSL_FIX_WBC and PATH pointing at the stubs
+    """
+    locations = {
+        "fix": op.join(stub_dir, "fix"),
+        "hcp_fix": op.join(stub_dir, "HCP-Pipelines", "ICAFIX"),
+        "fslroi": op.join(stub_dir, "bin"),
+        "fslmerge": op.join(stub_dir, "bin"),
+        "wb_command": op.join(stub_dir, "bin"),
+    }
+    for tool, directory in locations.items():
+        os.makedirs(directory, exist_ok=True)
+        wrapper = op.join(directory, tool)
+        with open(wrapper, "w") as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (sys.executable, op.abspath(__file__), tool))
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    env = dict(os.environ if env is None else env)
+    env.update({
+        "FSL_FIXDIR": locations["fix"],
+        "HCPPIPEDIR": op.join(stub_dir, "HCP-Pipelines"),
+        "FSL_FIX_WBC": op.join(locations["wb_command"], "wb_command"),
+        "CARET7DIR": locations["wb_command"],
+        "PATH": locations["wb_command"] + os.pathsep + env.get("PATH", ""),
+    })
+    return env
+
+
+def hcp_fix(args):
+    input_file, highpass, training_file, threshold = args[0], args[1], args[3], args[4]
+    taskdir = op.dirname(op.abspath(input_file))
+    base = op.basename(input_file).replace(".nii.gz", "")
+
+    hpfile = op.join(taskdir, "%s_hp%s.nii.gz" % (base, highpass))
+    shutil.copyfile(input_file, hpfile)
+    atlas = op.join(taskdir, base + "_Atlas.dtseries.nii")
+    atlas_hp = op.join(taskdir, "%s_Atlas_hp%s.dtseries.nii" % (base, highpass))
+    if op.exists(atlas):
+        shutil.copyfile(atlas, atlas_hp)
+
+    icadir = hpfile.replace(".nii.gz", ".ica")
+    synthetic_hcp.write_ica(icadir, hpfile, _components())
+    _features(icadir)
+    synthetic_hcp.write_labels(icadir, training_file, threshold)
+
+    shutil.copyfile(hpfile, hpfile.replace(".nii.gz", "_clean.nii.gz"))
+    if op.exists(atlas_hp):
+        shutil.copyfile(atlas_hp, atlas_hp.replace(".dtseries.nii", "_clean.dtseries.nii"))
+
+
+def fix(args):
+    if args[0] == "-c":
+        icadir, training_file, threshold = args[1:4]
+        _features(icadir)
+        synthetic_hcp.write_labels(icadir, training_file, threshold)
+    elif args[0] == "-a":
+        icadir = op.dirname(op.abspath(args[1]))
+        shutil.copyfile(op.join(icadir, "filtered_func_data.nii.gz"),
+                        op.join(icadir, "filtered_func_data_clean.nii.gz"))
+        if op.exists(op.join(icadir, "Atlas.dtseries.nii")):
+            shutil.copyfile(op.join(icadir, "Atlas.dtseries.nii"), op.join(icadir, "Atlas_clean.dtseries.nii"))
+    else:
+        raise SystemExit("fix stub: unsupported arguments %s" % " ".join(args))
+
+
+def fslroi(args):
+    img = nib.load(args[0])
+    tmin, tsize = int(args[2]), int(args[3])
+    tsize = img.shape[3] - tmin if tsize < 0 else tsize
+    nib.save(img.slicer[..., tmin:tmin + tsize], _nifti_name(args[1]))
+
+
+def fslmerge(args):
+    if args[0] != "-t":
+        raise SystemExit("fslmerge stub: only -t is supported")
+    imgs = [nib.load(f) for f in args[2:]]
+    data = np.concatenate([np.asarray(img.dataobj).reshape(img.shape[:3] + (-1,)) for img in imgs], axis=3)
+    nib.save(nib.Nifti1Image(data, imgs[0].affine, imgs[0].header), _nifti_name(args[1]))
+
+
+def wb_command(args):
+    if args and args[0] == "-cifti-merge":
+        shutil.copyfile(args[args.index("-cifti") + 1], args[1])
+
+
+def _features(icadir):
+    features = op.join(icadir, "fix", "features.csv")
+    if op.exists(features):
+        return
+    os.makedirs(op.dirname(features), exist_ok=True)
+    ncomp = np.loadtxt(op.join(icadir, "filtered_func_data.ica", "melodic_mix"), ndmin=2).shape[1]
+    np.savetxt(features, np.random.default_rng(0).random((ncomp, 180)), fmt="%.6f", delimiter=",")
+
+
+def _components():
+    return int(os.environ.get("ICAFIX_STUB_COMPONENTS", 20))
+
+
+def _nifti_name(name):
+    return name if name.endswith((".nii", ".nii.gz")) else name + ".nii.gz"
+
+
+def main():
+    tool, args = sys.argv[1], sys.argv[2:]
+    if tool not in TOOLS:
+        raise SystemExit("unknown stub tool: %s" % tool)
+    start = time.perf_counter()
+    globals()[tool](args)
+    time.sleep(float(os.environ.get("ICAFIX_STUB_SECONDS", 0)))
+
+    log_file = os.environ.get("ICAFIX_STUB_LOG")
+    if log_file:
+        with open(log_file, "a") as f:
+            f.write("%s\t%.3f\t%s\n" % (tool, time.perf_counter() - start, " ".join(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""Synthetic HCP minimal preprocessing trees and gear input archives for offline benchmarks.
+
+Writes the files the gear reads from a bids-hcp result (MNINonLinear/Results/<task> directories with
+the volume series, SBRef, CIFTI dense timeseries and Movement_Regressors.txt, and the structural files
+mapped to the BIDS derivative tree) and, for previous results archives, the ICA-FIX outputs
+(<task>_hp<hp>.ica directories, high-pass filtered series and labels). Data are random but valid
+NIfTI-1 / CIFTI-2 files, so the gear (and nibabel) read them like real data.
+
+Usage:
+    python benchmarks/synthetic_hcp.py out.zip --runs 4 --timepoints 400 --shape 91 109 91 --grayordinates 91282
+    python benchmarks/synthetic_hcp.py out.zip --previous-results --components 60
+"""
+
+import argparse
+import json
+import os
+import os.path as op
+import sys
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+import nibabel as nib
+import numpy as np
+
+REPO_DIR = op.dirname(op.dirname(op.abspath(__file__)))
+
+SUBJECT = "01"
+SESSION = "01"
+TR = 0.8
+HIGHPASS = 2000
+TRAINING_FILE = "HCP_hp2000.RData"
+FIX_THRESHOLD = 10
+
+# 24 character top level directory, as in archives of flywheel analyses (stripped by the gear)
+ARCHIVE_PREFIX = "5f0c1d2e3a4b5c6d7e8f9a0b"
+
+
+def task_names(runs):
+    """Acquisition labels (reproin) and HCP task directory names of each run."""
+    tasks = []
+    for i in range(runs):
+        acq = "task-rest_run-%02d" % (i + 1)
+        tasks.append(("func-bold_" + acq, "ses-%s_%s_bold" % (SESSION, acq)))
+    return tasks
+
+
+def results_dir(root, subject=SUBJECT, session=SESSION):
+    return op.join(root, "HCPPipe", "sub-" + subject, "ses-" + session, "MNINonLinear", "Results")
+
+
+def write_series(filename, shape, ntime, tr=TR, seed=0):
+    """4D float32 NIfTI with a smooth baseline and noise."""
+    rng = np.random.default_rng(seed)
+    data = (1000 + rng.normal(0, 10, shape + (ntime,))).astype(np.float32)
+    img = nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0]))
+    img.header.set_zooms((2.0, 2.0, 2.0, tr))
+    img.header.set_xyzt_units("mm", "sec")
+    nib.save(img, filename)
+
+
+def write_dtseries(filename, ngray, ntime, tr=TR, seed=0):
+    """CIFTI-2 dense timeseries (grayordinates on a single cortical surface)."""
+    rng = np.random.default_rng(seed)
+    brain_models = nib.cifti2.BrainModelAxis.from_surface(np.arange(ngray), ngray, "CortexLeft")
+    series = nib.cifti2.SeriesAxis(start=0, step=tr, size=ntime, unit="second")
+    data = (1000 + rng.normal(0, 10, (ntime, ngray))).astype(np.float32)
+    nib.save(nib.Cifti2Image(data, header=(series, brain_models)), filename)
+
+
+def write_movement(filename, ntime, seed=0):
+    """HCP Movement_Regressors.txt: 3 translations (mm), 3 rotations (degrees) and their derivatives."""
+    rng = np.random.default_rng(seed)
+    par = np.cumsum(rng.normal(0, 0.02, (ntime, 6)), axis=0)
+    deriv = np.vstack([np.zeros((1, 6)), np.diff(par, axis=0)])
+    np.savetxt(filename, np.hstack([par, deriv]), fmt="%.6f", delimiter="  ")
+
+
+def write_ica(icadir, hpfile, ncomp, seed=0, dummy_trs=0):
+    """
+    Melodic outputs of an hcp_fix run in icadir (filtered_func_data.ica, mc/, symlinks to the series).
+    Args:
+        icadir (str): <task>_hp<hp>.ica directory
+        hpfile (str): high-pass filtered series the ICA was run on
+        ncomp (int): number of components
+        dummy_trs (int): initial frames removed before the ICA; the gear restitches them to the series
+            only, so melodic_mix and the motion parameters are shorter than the series
+    """
+    rng = np.random.default_rng(seed)
+    img = nib.load(hpfile)
+    shape, ntime = img.shape[:3], img.shape[3] - dummy_trs
+    tr = float(img.header.get_zooms()[3])
+    melodic = op.join(icadir, "filtered_func_data.ica")
+    os.makedirs(melodic, exist_ok=True)
+    os.makedirs(op.join(icadir, "mc"), exist_ok=True)
+
+    maps = rng.normal(0, 1, shape + (ncomp,)).astype(np.float32)
+    nib.save(nib.Nifti1Image(maps, img.affine), op.join(melodic, "melodic_IC.nii.gz"))
+    mean = nib.Nifti1Image(np.full(shape, 1000, dtype=np.float32), img.affine)
+    mean.header.set_zooms((2.0, 2.0, 2.0))
+    mean.header["pixdim"][4] = tr
+    nib.save(mean, op.join(melodic, "mean.nii.gz"))
+
+    np.savetxt(op.join(melodic, "melodic_mix"), rng.normal(size=(ntime, ncomp)), fmt="%.6f")
+    explained = np.sort(rng.uniform(0.1, 5, ncomp))[::-1]
+    np.savetxt(op.join(melodic, "melodic_ICstats"),
+               np.column_stack([explained, explained / 2, explained, explained / 2]), fmt="%.4f")
+    np.savetxt(op.join(icadir, "mc", "prefiltered_func_data_mcf.par"),
+               np.cumsum(rng.normal(0, 0.001, (ntime, 6)), axis=0), fmt="%.6f")
+
+    _relink(op.join(icadir, "filtered_func_data.nii.gz"), op.join("..", op.basename(hpfile)))
+    atlas = op.join(op.dirname(hpfile),
+                    op.basename(hpfile).replace("_hp", "_Atlas_hp").replace(".nii.gz", ".dtseries.nii"))
+    if op.exists(atlas):
+        _relink(op.join(icadir, "Atlas.dtseries.nii"), op.join("..", op.basename(atlas)))
+
+
+def write_labels(icadir, training_file, fix_threshold, seed=0):
+    """
+    fix4melview labels as written by `fix -c` (about a third of the components labelled noise).
+    Returns:
+        str: labels filename
+    """
+    rng = np.random.default_rng(seed)
+    ncomp = np.loadtxt(op.join(icadir, "filtered_func_data.ica", "melodic_mix"), ndmin=2).shape[1]
+    noise = rng.random(ncomp) < 0.35
+    name = op.basename(training_file).replace(".RData", "").replace(".Rdata", "")
+    labels_file = op.join(icadir, "fix4melview_%s_thr%s.txt" % (name, fix_threshold))
+    with open(labels_file, "w") as f:
+        f.write("filtered_func_data.ica\n")
+        for k in range(ncomp):
+            f.write("%d, %s, %s, %.3f\n" % (k + 1, "Unclassified Noise" if noise[k] else "Signal",
+                                          "True" if noise[k] else "False", rng.random()))
+        f.write("[" + ", ".join(str(k + 1) for k in np.flatnonzero(noise)) + "]\n")
+    return labels_file
+
+
+def hcp_tree(root, runs=2, ntime=200, shape=(32, 38, 32), ngray=5000, previous_results=False, ncomp=30,
+             highpass=HIGHPASS, seed=0, dummy_trs=0):
+    """
+    Write a bids-hcp result tree (and optionally ICA-FIX outputs) below root.
+    Args:
+        root (str): analysis directory (HCPPipe is created in it)
+        runs (int): number of functional runs
+        ntime (int): time points per run
+        shape (tuple): volume dimensions
+        ngray (int): grayordinates of the dense timeseries, 0 for none
+        previous_results (bool): add hcp_fix outputs (ICA, labels, high-pass filtered series)
+        ncomp (int): components of each ICA
+        dummy_trs (int): dummy volumes removed before the ICA of the previous results
+    Returns:
+        list: (acquisition label, task directory) of each run
+    """
+    tasks = task_names(runs)
+    write_anatomy(root, tuple(shape))
+    for i, (_, task) in enumerate(tasks):
+        taskdir = op.join(results_dir(root), task)
+        os.makedirs(taskdir, exist_ok=True)
+        write_series(op.join(taskdir, task + ".nii.gz"), tuple(shape), ntime, seed=seed + i)
+        write_series(op.join(taskdir, task + "_SBRef.nii.gz"), tuple(shape), 1, seed=seed + i)
+        write_movement(op.join(taskdir, "Movement_Regressors.txt"), ntime, seed=seed + i)
+        if ngray:
+            write_dtseries(op.join(taskdir, task + "_Atlas.dtseries.nii"), ngray, ntime, seed=seed + i)
+
+        if previous_results:
+            hpfile = op.join(taskdir, "%s_hp%s.nii.gz" % (task, highpass))
+            write_series(hpfile, tuple(shape), ntime, seed=seed + i + 1000)
+            if ngray:
+                write_dtseries(op.join(taskdir, "%s_Atlas_hp%s.dtseries.nii" % (task, highpass)), ngray, ntime,
+                               seed=seed + i + 1000)
+            icadir = hpfile.replace(".nii.gz", ".ica")
+            write_ica(icadir, hpfile, ncomp, seed=seed + i, dummy_trs=dummy_trs)
+            write_labels(icadir, TRAINING_FILE, FIX_THRESHOLD, seed=seed + i)
+
+    return tasks
+
+
+def write_anatomy(root, shape, subject=SUBJECT, session=SESSION):
+    """
+    Structural outputs mapped by utils/hcp_mapper.json (anat): small 3D NIfTI volumes, and placeholder
+    surface / dscalar files (only linked by the gear, never read).
+    """
+    with open(op.join(REPO_DIR, "utils", "hcp_mapper.json")) as f:
+        anat = json.load(f)["anat"]
+    bidspath = anat["bidspath"].format(PIPELINE="bids-hcp", SUBJECT=subject, SESSION=session)
+    for source in anat["files"]:
+        path = op.normpath(op.join(root, bidspath, source.format(SUBJECT=subject, SESSION=session)))
+        os.makedirs(op.dirname(path), exist_ok=True)
+        if path.endswith(".nii.gz"):
+            nib.save(nib.Nifti1Image(np.zeros(shape, dtype=np.float32), np.diag([2.0, 2.0, 2.0, 1.0])), path)
+        else:
+            with open(path, "w") as f:
+                f.write("synthetic placeholder\n")
+
+
+def write_archive(zip_filename, root, prefix=ARCHIVE_PREFIX, compress=True):
+    """
+    Archive the tree below root as a flywheel analysis output (<prefix>/HCPPipe/...), symlinks kept.
+    Returns:
+        int: number of members
+    """
+    count = 0
+    with ZipFile(zip_filename, "w", ZIP_DEFLATED if compress else ZIP_STORED, allowZip64=True) as zf:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = op.join(dirpath, name)
+                arcname = op.join(prefix, op.relpath(path, root))
+                if op.islink(path):
+                    info = ZipInfo(arcname)
+                    info.external_attr = 0o120777 << 16
+                    zf.writestr(info, os.readlink(path))
+                else:
+                    zf.write(path, arcname)
+                count += 1
+    return count
+
+
+def _relink(link, target):
+    if op.lexists(link):
+        os.remove(link)
+    os.symlink(target, link)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output", help="archive to write (.zip), or a directory for the tree only")
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--timepoints", type=int, default=200)
+    parser.add_argument("--shape", type=int, nargs=3, default=[32, 38, 32])
+    parser.add_argument("--grayordinates", type=int, default=5000)
+    parser.add_argument("--components", type=int, default=30)
+    parser.add_argument("--previous-results", action="store_true", help="include ICA-FIX outputs")
+    parser.add_argument("--dummy-volumes", type=int, default=0, help="frames removed before the ICA")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.output.endswith(".zip"):
+        hcp_tree(args.output, args.runs, args.timepoints, tuple(args.shape), args.grayordinates,
+                 args.previous_results, args.components, seed=args.seed, dummy_trs=args.dummy_volumes)
+        return
+
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        hcp_tree(tmpdir, args.runs, args.timepoints, tuple(args.shape), args.grayordinates,
+                 args.previous_results, args.components, seed=args.seed, dummy_trs=args.dummy_volumes)
+        count = write_archive(args.output, tmpdir)
+    print(f"{args.output}: {count} members, {op.getsize(args.output) / 1024 ** 2:.1f} MB")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+"""pytest configuration: the repository root is the import root of the gear (fw_gear_icafix, utils)."""
@@ -1,6 +1,7 @@
 """Main module."""
 
 import logging
+import multiprocessing
 import os
 import os.path as op
 import subprocess as sp
@@ -8,11 +9,14 @@ import sys
 import pandas as pd
 import shutil
 from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
 from zipfile import ZIP_DEFLATED, ZipFile
 
 from tempfile import NamedTemporaryFile
 
+import psutil
+
 from flywheel_gear_toolkit import GearToolkitContext
 from flywheel_gear_toolkit.interfaces.command_line import (
     build_command_list,
@@ -21,11 +25,29 @@ from flywheel_gear_toolkit.interfaces.command_line import (
 
 from fw_gear_icafix import metadata
 import utils.filemapper as filemapper
-from utils.report.report import report
+import utils.profiling as profiling
+import utils.scheduler as scheduler
+import utils.checkpoint as checkpoint
+import utils.confounds as confounds
+import utils.denoise as denoise
+from utils.feature_cache import CACHE_DIRNAME, FeatureCache, feature_key
+import utils.timeseries as timeseries
+from utils.report.report import FIGURE_DPI, report
+from utils.archive import zip_results
+from utils.filesearch import invalidate, search, searchfiles
 from utils.zip_htmls import zip_htmls
 
 log = logging.getLogger(__name__)
 
+# initial surface frames removed by drop_initial_volumes (written to each task directory)
+CIFTI_DUMMYVOLS_FILENAME = "tmp_cifti_initialvols.dtseries.nii"
+
+# persisted session acquisition index (tmp files are not included in the results zip)
+ACQUISITION_INDEX_FILENAME = "tmp_acquisition_index.json"
+
+# gear arguments shared with forked task workers (set by run_tasks_parallel)
+_worker_args = None
+
 
 def run(gear_args):
     """Main script to launch hcp_fix using configuration set by user and zip results for storage.
@@ -35,124 +57,522 @@ def run(gear_args):
     """
     log.info("This is the beginning of the run file")
 
-    # add a loop here**
-    for index, row in gear_args.files.iterrows():
+    # scan the session acquisitions once, shared by all tasks (and workers)
+    with profiling.stage("acquisition index"):
+        metadata.get_acquisition_index(gear_args, cache_file=op.join(gear_args.work_dir, ACQUISITION_INDEX_FILENAME))
+
+    parallel = gear_args.config.get("parallel-tasks") and len(gear_args.files) > 1
+    nworkers = task_pool_size(gear_args, len(gear_args.files)) if parallel else 1
+
+    failed = []
+    if nworkers > 1:
+        # estimate each task's peak memory and scratch from the series headers to admit tasks to the pool
+        estimates = scheduler.estimate_tasks(gear_args.files, gear_args.mode,
+                                             engine=gear_args.config.get("cleanup-engine") or "fix")
+        scheduler.log_plan(estimates, memory_budget(gear_args), nworkers,
+                           scratch_free=shutil.disk_usage(gear_args.work_dir).free)
+        failed = run_tasks_parallel(gear_args, estimates, nworkers)
+    else:
+        log.info("Running %s task(s) one at a time", len(gear_args.files))
+        for index in range(len(gear_args.files)):
+            run_task(gear_args.files.iloc[index], gear_args)
+
+    # cleanup gear and store outputs and logs...
+    with profiling.stage("cleanup"):
+        cleanup(gear_args)
+
+    # send the queued metadata (file info) updates together
+    with profiling.stage("metadata upload"):
+        gear_args.client.flush()
+    gear_args.client.log_stats()
+
+    profiling.write(gear_args.output_dir, "icafix_profile_" + gear_args.dest_id)
+
+    for error in gear_args.errors:
+        log.error("%s\n%s", error["message"], error["exception"])
 
-        if not os.path.exists(row["preprocessed_files"]):
-            log.fatal('Unable to locate correct functional file')
-            sys.exit(1)
+    if failed:
+        log.error("ICA-FIX failed for %s task(s): %s", len(failed), ", ".join(failed))
+        return 1
 
-        # fetch dummy volumes (use hard coded value if present, else grab from mriqc)
-        gear_args.config['AcqDummyVolumes'] = fetch_dummy_volumes(row["preprocessed_files"], gear_args)
+    return 0
+
+
+def run_task(row, gear_args):
+    """Run the full ICA-FIX workflow (trim, fix, restitch, metadata, report) for one task directory.
+
+    Files written by each stage are recorded in gear_args.manifest. Completed stages are recorded in the
+    task checkpoint file; with the 'resume' option stages that already completed with the same inputs
+    and options are skipped (see utils.checkpoint).
+
+    Args:
+        row (pd.Series): row of gear_args.files (taskdir, preprocessed_files, motion_files, surface_files)
+        gear_args (GearArgs): parsed gear arguments
+    """
+    if not os.path.exists(row["preprocessed_files"]):
+        log.fatal('Unable to locate correct functional file')
+        sys.exit(1)
 
-        #remove specified numner of inital volumes
-        temp_file = drop_initial_volumes(row, gear_args)
+    # fetch dummy volumes (use hard coded value if present, else grab from mriqc)
+    gear_args.config['AcqDummyVolumes'] = fetch_dummy_volumes(row["preprocessed_files"], gear_args)
 
-        # generate the hcp_fix command options from gear contex
-        if gear_args.mode == "hcpfix":
-            generate_icafix_command(row["preprocessed_files"], gear_args,"hcpfix")
+    ckpt = task_checkpoints(row, gear_args)
 
-            # execute hcp_fix command (inside this method checks for gear-dry-run)
-            fix_command = execute(gear_args)
+    #remove specified numner of inital volumes
+    temp_file = run_stage(ckpt, row, gear_args, "trim", drop_initial_volumes, row, gear_args)
 
-        elif gear_args.mode == "fix cleanup":
+    # generate the hcp_fix command options from gear contex
+    if gear_args.mode == "hcpfix":
+        fix_command = run_stage(ckpt, row, gear_args, "fix", run_hcpfix, row, gear_args)
+    else:
+        if gear_args.mode == "fix cleanup":
             # # first apply new training model
-            icadir = searchfiles(os.path.join(row["taskdir"],"*hp*.ica"), dryrun=False, find_first=True)
-            generate_icafix_command(icadir, gear_args, "classify")
-            fix_command = execute(gear_args)
+            run_stage(ckpt, row, gear_args, "classify", classify_components, row, gear_args)
+        fix_command = run_stage(ckpt, row, gear_args, "cleanup", apply_cleanup, row, gear_args)
+
+    # additional training file / threshold combinations (reuse the extracted features)
+    for training_file, fix_threshold, name in sweep_combinations(gear_args):
+        run_stage(ckpt, row, gear_args, "sweep " + name, run_sweep_combination, row, gear_args, training_file,
+                  fix_threshold, name)
+
+    run_stage(ckpt, row, gear_args, "restitch", restitch_task, row, temp_file, gear_args)
+
+    run_stage(ckpt, row, gear_args, "metadata", store_task_metadata, row, gear_args)
+
+    # generate report for ica classification
+    reportdir = run_stage(ckpt, row, gear_args, "report", report, row["taskdir"], fix_command,
+                          n_workers=int(gear_args.config.get("report-workers") or 1),
+                          renderer=gear_args.config.get("report-renderer") or "nilearn",
+                          dpi=int(gear_args.config.get("report-dpi") or FIGURE_DPI),
+                          image_format=gear_args.config.get("report-image-format") or "png",
+                          sprite_size=int(gear_args.config.get("report-sprite-size") or 0),
+                          labels_file=primary_labels_file(row, gear_args),
+                          clean_file=primary_clean_file(row, gear_args))
+
+    zip_htmls(gear_args.output_dir, gear_args.dest_id, reportdir)
+
+
+def task_checkpoints(row, gear_args):
+    """Stage markers for a task: stage order for the gear mode, with the options each stage depends on."""
+    config = gear_args.config
+    fix_params = [config.get(k) for k in ("TrainingFilePath", "HighPassFilter", "do_motion_regression",
+                                          "FixThreshold", "DeleteIntermediates")]
+
+    stages = [("trim", [config.get("AcqDummyVolumes")])]
+    if gear_args.mode == "hcpfix":
+        stages.append(("fix", fix_params))
+    elif gear_args.mode == "fix cleanup":
+        stages.append(("classify", fix_params))
+        stages.append(("cleanup", fix_params))
+    else:
+        stages.append(("cleanup", fix_params + [list(fetch_noise_labels(row["preprocessed_files"], gear_args))]))
+    stages += [("sweep " + name, [training_file, fix_threshold])
+               for training_file, fix_threshold, name in sweep_combinations(gear_args)]
+    stages += [("restitch", []), ("metadata", []),
+               ("report", [config.get("report-renderer") or "nilearn"] +
+                [config.get(k) for k in ("report-dpi", "report-image-format", "report-sprite-size")])]
 
-            # generate new clean dataset
-            hpfile = os.path.basename(icadir).replace(".ica",".nii.gz")
-            cmd = "ln -s ../" + hpfile + " " + "filtered_func_data.nii.gz"
-            execute_shell(cmd, dryrun=gear_args.config["dry-run"], cwd=icadir)
+    # archived inputs keep the CRC of their original content, even once trimmed in place
+    # (the gear mode is not part of the fingerprint: the stage names and parameters already differ per mode)
+    crc = gear_args.manifest.input_crc(row["preprocessed_files"])
+    fingerprint = [Path(row["preprocessed_files"]).name,
+                   crc if crc is not None else checkpoint.file_crc(row["preprocessed_files"])]
 
-            labels_file = searchfiles(os.path.join(row["taskdir"], "*hp*.ica", "fix4melview*.txt"), dryrun=False,
-                                      find_recent=True)
-            generate_icafix_command(labels_file, gear_args, "apply cleanup")
-            fix_command = execute(gear_args)
+    return checkpoint.TaskCheckpoints(row["taskdir"], stages, fingerprint, manifest=gear_args.manifest)
 
-            # unlink filtered func file
-            cmd = "unlink " + os.path.join(icadir, "filtered_func_data.nii.gz")
-            execute_shell(cmd, dryrun=gear_args.config["dry-run"])
 
-            # create output cleaned directory
-            cmd = "mv " + os.path.join(icadir,"filtered_func_data_clean.nii.gz") + " " + os.path.join(os.path.dirname(icadir),os.path.basename(icadir).replace(".ica","_"+Path(gear_args.config['TrainingFilePath']).stem+"_clean.nii.gz"))
-            execute_shell(cmd, dryrun=gear_args.config["dry-run"], cwd=icadir)
+def run_stage(ckpt, row, gear_args, stage, func, *args, **kwargs):
+    """Run one stage of a task, or return the recorded result if the stage is already complete.
 
-        elif gear_args.mode == "hand labeled":
+    Returns:
+        the stage result
+    """
+    task = Path(row["taskdir"]).name
+    if gear_args.config.get("resume") and ckpt.completed(stage):
+        log.info("Skipping stage '%s' of %s (completed with the same inputs)", stage, task)
+        return ckpt.result(stage)
+
+    with profiling.stage(stage, task), gear_args.manifest.stage(task, stage, row["taskdir"]):
+        result = func(*args, **kwargs)
 
-            # identify the hand labels for current acquisition
-            handlabels = fetch_noise_labels(row["preprocessed_files"], gear_args)
+    if not gear_args.config["dry-run"]:
+        written = [op.join(gear_args.manifest.root, name) for name in gear_args.manifest.stages[(task, stage)]]
+        ckpt.complete(stage, written, result)
 
-            # write hand_labels_noise.txt
-            icadir = searchfiles(os.path.join(row["taskdir"], "*hp*.ica"), dryrun=False, find_first=True)
-            handlabels_file = op.join(icadir,"hand_labels_noise.txt")
-            with open(handlabels_file,'w') as fid:
-                fid.write(" ,".join(handlabels))
+    return result
 
-            # generate new clean dataset
-            hpfile = os.path.basename(icadir).replace(".ica", ".nii.gz")
-            cmd = "ln -s ../" + hpfile + " " + "filtered_func_data.nii.gz"
-            execute_shell(cmd, dryrun=gear_args.config["dry-run"], cwd=icadir)
 
-            generate_icafix_command(handlabels_file, gear_args, "apply cleanup")
-            fix_command = execute(gear_args)
+def run_hcpfix(row, gear_args):
+    """Run hcp_fix (ICA, classification and cleanup) on the preprocessed series of a task.
 
-            # unlink filtered func file
-            cmd = "unlink " + os.path.join(icadir, "filtered_func_data.nii.gz")
-            execute_shell(cmd, dryrun=gear_args.config["dry-run"])
+    Returns:
+        list: the hcp_fix command
+    """
+    generate_icafix_command(row["preprocessed_files"], gear_args,"hcpfix")
 
-            # create output cleaned directory
-            cmd = "mv " + os.path.join(icadir, "filtered_func_data_clean.nii.gz") + " " + os.path.join(
-                os.path.dirname(icadir), os.path.basename(icadir).replace(".ica", "_" + "handlabel" + "_clean.nii.gz"))
-            execute_shell(cmd, dryrun=gear_args.config["dry-run"], cwd=icadir)
+    # execute hcp_fix command (inside this method checks for gear-dry-run)
+    return execute(gear_args)
 
 
-        # add dummy vols back to keep output same as input:
-        ica_files = searchfiles(os.path.join(row["taskdir"],"*hp*.nii.gz"), dryrun=False)
-        for ica_file in ica_files:
-            cleanup_volume_files(ica_file, temp_file, gear_args)
+def classify_components(row, gear_args, training_file=None, fix_threshold=None):
+    """Classify the components of an existing ICA with the selected training file (fix cleanup mode).
 
-        if row["surface_files"]:
-            ica_files_surface = searchfiles(os.path.join(row["taskdir"],"*Atlas*hp*.dtseries.nii"), dryrun=False)
-            for ica_file in ica_files_surface:
-                cleanup_surface_files(ica_file, temp_file, gear_args)
+    Args:
+        training_file (str): training file, defaults to the TrainingFile option
+        fix_threshold (int): threshold, defaults to the FixThreshold option
+    Returns:
+        list: the fix command
+    """
+    icadir = searchfiles(os.path.join(row["taskdir"],"*hp*.ica"), dryrun=False, find_first=True)
 
-        # remove all tmp files
-        cmd = "rm -Rf tmp*"
-        execute_shell(cmd, dryrun=gear_args.config["dry-run"], cwd=row["taskdir"])
+    # fix only extracts features if fix/features.csv is missing, reuse features of the same ICA
+    cache = feature_cache(gear_args)
+    if cache:
+        key = feature_key(icadir, icadir.replace(".ica", ".nii.gz"), gear_args.manifest,
+                                           extra=[gear_args.config.get("AcqDummyVolumes")])
+        if not op.exists(op.join(icadir, "fix", "features.csv")):
+            cache.restore(key, icadir)
 
-        # store metadata at the acquisition level
-        labels_file = searchfiles(os.path.join(row["taskdir"],"*hp*.ica","fix4melview*.txt"), dryrun=False, find_recent=True)
-        icstats_file = searchfiles(os.path.join(row["taskdir"], "*hp*.ica", "filtered_func_data.ica","melodic_ICstats"), dryrun=False,
-                                  find_first=True)
-        metrics = store_metadata(labels_file, icstats_file, row["preprocessed_files"], gear_args)
+    generate_icafix_command(icadir, gear_args, "classify", training_file=training_file, fix_threshold=fix_threshold)
+    fix_command = execute(gear_args)
 
-        # generate report for ica classification
-        reportdir = report(row["taskdir"], fix_command)
+    if cache and not gear_args.config["dry-run"]:
+        cache.store(key, icadir)
 
-        zip_htmls(gear_args.output_dir, gear_args.dest_id, reportdir)
+    return fix_command
 
-    # cleanup gear and store outputs and logs...
-    cleanup(gear_args)
 
-    return 0
+def feature_cache(gear_args):
+    """FIX feature cache on the gear writable directory, None if disabled or not writable."""
+    max_bytes = parse_memory(gear_args.config.get("feature-cache-size") or "0")
+    if not max_bytes:
+        return None
+    try:
+        return FeatureCache(op.join(gear_args.config["gear-writable-dir"], CACHE_DIRNAME), max_bytes)
+    except OSError as e:
+        log.warning("FIX feature cache disabled: %s", e)
+        return None
+
+
+def apply_cleanup(row, gear_args, training_file=None, fix_threshold=None, name=None):
+    """Remove the noise components from the high-pass filtered series: components classified by
+    classify_components (fix cleanup mode) or hand labeled components (hand labeled mode).
+
+    Args:
+        training_file (str): use the labels of this training file / threshold (sweep combinations),
+            default: the most recent labels
+        fix_threshold (int): threshold of the labels
+        name (str): name of the cleaned output (<name>_clean), defaults to the training file name
+    Returns:
+        list: the fix command
+    """
+    icadir = searchfiles(os.path.join(row["taskdir"], "*hp*.ica"), dryrun=False, find_first=True)
+
+    if gear_args.mode == "hand labeled":
+        # identify the hand labels for current acquisition
+        handlabels = fetch_noise_labels(row["preprocessed_files"], gear_args)
+
+        # write hand_labels_noise.txt
+        labels_file = op.join(icadir,"hand_labels_noise.txt")
+        with open(labels_file,'w') as fid:
+            fid.write(" ,".join(handlabels))
+        trainingname = "handlabel"
+    elif training_file:
+        labels_file = labels_filename(icadir, training_file, fix_threshold)
+        trainingname = name or training_name(training_file)
+    else:
+        labels_file = searchfiles(os.path.join(row["taskdir"], "*hp*.ica", "fix4melview*.txt"), dryrun=False,
+                                  find_recent=True)
+        trainingname = Path(gear_args.config['TrainingFilePath']).stem
+
+    # generate new clean dataset (keep a filtered func file left by hcp_fix)
+    hpfile = os.path.basename(icadir).replace(".ica",".nii.gz")
+    link_filtered_func = not op.lexists(os.path.join(icadir, "filtered_func_data.nii.gz"))
+    if link_filtered_func:
+        cmd = "ln -s ../" + hpfile + " " + "filtered_func_data.nii.gz"
+        execute_shell(cmd, dryrun=gear_args.config["dry-run"], cwd=icadir)
+
+    if gear_args.config.get("cleanup-engine") == "numpy":
+        # regression in-process (same model as fix -a, no MATLAB/MCR startup)
+        mot_reg = gear_args.config['do_motion_regression']
+        fix_command = ["denoise.apply_cleanup", labels_file] + (
+            ["-m", "-h", str(gear_args.config['HighPassFilter'])] if mot_reg else [])
+        log.info("\n %s", " ".join(fix_command))
+        if not gear_args.config["dry-run"]:
+            denoise.apply_cleanup(labels_file, motion=mot_reg, highpass=gear_args.config['HighPassFilter'])
+    else:
+        generate_icafix_command(labels_file, gear_args, "apply cleanup")
+        fix_command = execute(gear_args)
+
+    # unlink filtered func file
+    if link_filtered_func:
+        cmd = "unlink " + os.path.join(icadir, "filtered_func_data.nii.gz")
+        execute_shell(cmd, dryrun=gear_args.config["dry-run"])
+
+    # create output cleaned directory
+    cmd = "mv " + os.path.join(icadir, "filtered_func_data_clean.nii.gz") + " " + os.path.join(
+        os.path.dirname(icadir), os.path.basename(icadir).replace(".ica", "_" + trainingname + "_clean.nii.gz"))
+    execute_shell(cmd, dryrun=gear_args.config["dry-run"], cwd=icadir)
+
+    return fix_command
+
+
+def store_task_metadata(row, gear_args):
+    """Store the component classification summary at the acquisition level (one entry per sweep combination)."""
+    labels_file = primary_labels_file(row, gear_args)
+    icstats_file = searchfiles(os.path.join(row["taskdir"], "*hp*.ica", "filtered_func_data.ica","melodic_ICstats"), dryrun=False,
+                              find_first=True)
+    # stages completed so far (the metadata stage itself is not included)
+    profile = profiling.summary(Path(row["taskdir"]).name)
+    store_metadata(labels_file, icstats_file, row["preprocessed_files"], gear_args, profile=profile)
+
+    icadir = searchfiles(os.path.join(row["taskdir"], "*hp*.ica"), dryrun=False, find_first=True)
+    for training_file, fix_threshold, name in sweep_combinations(gear_args):
+        store_metadata(labels_filename(icadir, training_file, fix_threshold), icstats_file,
+                       row["preprocessed_files"], gear_args, name=name, profile=profile)
+
+
+def run_sweep_combination(row, gear_args, training_file, fix_threshold, name):
+    """Classify and clean a task with one additional training file / threshold combination."""
+    classify_components(row, gear_args, training_file=training_file, fix_threshold=fix_threshold)
+    apply_cleanup(row, gear_args, training_file=training_file, fix_threshold=fix_threshold, name=name)
+
+
+def sweep_combinations(gear_args):
+    """Training file / threshold combinations to run in addition to TrainingFile and FixThreshold.
+
+    Returns:
+        list: (training file, threshold, output name) tuples; output names are the training file name,
+            with _thr<threshold> appended when several thresholds are swept
+    """
+    config = gear_args.config
+    if gear_args.mode == "hand labeled":
+        return []
+
+    training_files = [config['TrainingFilePath']] + split_list(config.get("TrainingFileSweep"))
+    thresholds = [int(config['FixThreshold'])] + [int(x) for x in split_list(config.get("FixThresholdSweep"))]
+    training_files = list(OrderedDict.fromkeys(training_files))
+    thresholds = list(OrderedDict.fromkeys(thresholds))
+
+    combinations = []
+    for training_file in training_files:
+        for fix_threshold in thresholds:
+            if (training_file, fix_threshold) == (training_files[0], thresholds[0]):
+                continue
+            name = training_name(training_file)
+            if len(thresholds) > 1:
+                name += "_thr" + str(fix_threshold)
+            combinations.append((training_file, fix_threshold, name))
+
+    return combinations
+
+
+def split_list(text):
+    """Split a comma or space separated config list."""
+    return [x for x in str(text or "").replace(",", " ").split() if x]
+
+
+def training_name(training_file):
+    return Path(training_file).name.replace(".RData", "").replace(".Rdata", "")
+
+
+def labels_filename(icadir, training_file, fix_threshold):
+    """Labels written by fix -c for a training file and threshold."""
+    return op.join(icadir, "fix4melview_" + training_name(training_file) + "_thr" + str(fix_threshold) + ".txt")
+
+
+def primary_labels_file(row, gear_args):
+    """Labels of the TrainingFile / FixThreshold options (hand labels in hand labeled mode)."""
+    icadir = searchfiles(os.path.join(row["taskdir"], "*hp*.ica"), dryrun=False, find_first=True)
+    if icadir:
+        if gear_args.mode == "hand labeled" and op.exists(op.join(icadir, "hand_labels_noise.txt")):
+            return op.join(icadir, "hand_labels_noise.txt")
+        labels_file = labels_filename(icadir, gear_args.config['TrainingFilePath'], gear_args.config['FixThreshold'])
+        if op.exists(labels_file):
+            return labels_file
+    return searchfiles(os.path.join(row["taskdir"],"*hp*.ica","fix4melview*.txt"), dryrun=False, find_recent=True)
+
+
+def primary_clean_file(row, gear_args):
+    """Cleaned series of the TrainingFile / FixThreshold options, None if not found."""
+    icadir = searchfiles(os.path.join(row["taskdir"], "*hp*.ica"), dryrun=False, find_first=True)
+    if not icadir:
+        return None
+    if gear_args.mode == "hcpfix":
+        clean_file = icadir.replace(".ica", "_clean.nii.gz")
+    elif gear_args.mode == "hand labeled":
+        clean_file = icadir.replace(".ica", "_handlabel_clean.nii.gz")
+    else:
+        clean_file = icadir.replace(".ica", "_" + Path(gear_args.config['TrainingFilePath']).stem + "_clean.nii.gz")
+    return clean_file if op.exists(clean_file) else None
+
+
+def restitch_task(row, temp_file, gear_args):
+    """Add the initial volumes back to the cleaned outputs and remove temporary files."""
+    # add dummy vols back to keep output same as input:
+    ica_files = searchfiles(os.path.join(row["taskdir"],"*hp*.nii.gz"), dryrun=False)
+    for ica_file in ica_files:
+        cleanup_volume_files(ica_file, temp_file, gear_args)
+
+    if row["surface_files"]:
+        ica_files_surface = searchfiles(os.path.join(row["taskdir"],"*Atlas*hp*.dtseries.nii"), dryrun=False)
+        for ica_file in ica_files_surface:
+            cleanup_surface_files(ica_file, temp_file, gear_args)
+
+    # remove all tmp files
+    cmd = "rm -Rf tmp*"
+    execute_shell(cmd, dryrun=gear_args.config["dry-run"], cwd=row["taskdir"])
+
+
+def run_tasks_parallel(gear_args, estimates, nworkers):
+    """Run each task directory as an independent unit of work in a bounded process pool.
+
+    Workers are forked so the parsed gear arguments (including the flywheel client) are inherited
+    rather than pickled. Each task logs to its own file in the task directory, which is replayed to the
+    gear log once the task finishes. A failing task does not stop the remaining tasks.
+
+    Tasks are started largest first whenever their memory estimate fits in the unused part of the
+    memory budget (see utils.scheduler).
+
+    Args:
+        estimates (list): scheduler.TaskEstimate of each task
+        nworkers (int): pool size
+    Returns:
+        list: task directories which failed
+    """
+    global _worker_args
+    _worker_args = gear_args
+
+    budget = memory_budget(gear_args)
+    log.info("Running %s tasks in parallel using %s workers", len(gear_args.files), nworkers)
+
+    # no flywheel request may be in flight when forking: a child would inherit its locks held
+    gear_args.client.shutdown()
+
+    failed = []
+    pending = scheduler.admission_order(estimates)
+    futures = {}
+    ctx = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=nworkers, mp_context=ctx) as pool:
+        while pending or futures:
+            in_use = sum(estimates[idx].memory for idx in futures.values())
+            for idx in scheduler.admit(pending, estimates, budget - in_use, nworkers - len(futures), not futures):
+                pending.remove(idx)
+                futures[pool.submit(_task_worker, idx)] = idx
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                _task_finished(gear_args, gear_args.files.iloc[futures.pop(future)], future, failed)
+
+    _worker_args = None
+
+    return failed
+
+
+def _task_finished(gear_args, row, future, failed):
+    """Collect the result of a task worker (stage and profile records, reported errors, log, failure)."""
+    try:
+        result = future.result()
+        # records were made in the worker's copy of the manifest, profiler and flywheel client
+        error = result["error"]
+        gear_args.manifest.stages.update(result["stages"])
+        profiling.add_records(result["profile"])
+        gear_args.client.add_updates(result["updates"])
+        gear_args.client.add_stats(result["api"])
+        gear_args.errors.extend(result["errors"])
+    except Exception as e:
+        # worker process died (e.g. killed by the OOM killer)
+        error = repr(e)
+
+    log_file = task_log_file(row["taskdir"])
+    if op.exists(log_file):
+        with open(log_file) as f:
+            log.info("Log for task %s:\n%s", Path(row["taskdir"]).name, f.read())
+
+    if error:
+        log.error("Task %s failed: %s", Path(row["taskdir"]).name, error)
+        failed.append(row["taskdir"])
+    else:
+        log.info("Task %s completed", Path(row["taskdir"]).name)
+
+
+def _task_worker(index):
+    """Process pool entry point: run a single task with logging redirected to the task log file.
+
+    Returns:
+        dict: error (None on success), the manifest stage records, profile records, queued flywheel
+            updates, flywheel API statistics and errors reported by the commands of the task
+    """
+    row = _worker_args.files.iloc[index]
+    _worker_args.client.reset_stats()
+    nerrors = len(_worker_args.errors)
+
+    handler = logging.FileHandler(task_log_file(row["taskdir"]), mode="w")
+    handler.setFormatter(logging.Formatter("[%(asctime)s %(levelname)s %(name)s] %(message)s"))
+    root = logging.getLogger()
+    saved_handlers = root.handlers[:]
+    root.handlers = [handler]
+
+    error = None
+    try:
+        run_task(row, _worker_args)
+    except (Exception, SystemExit) as e:
+        log.exception("ICA-FIX failed for task %s", row["taskdir"])
+        error = repr(e)
+    finally:
+        handler.close()
+        root.handlers = saved_handlers
+
+    task = Path(row["taskdir"]).name
+    return {"error": error, "stages": _worker_args.manifest.task_stages(task), "profile": profiling.records(task),
+            "updates": _worker_args.client.take_updates(), "api": _worker_args.client.stats(),
+            "errors": _worker_args.errors[nerrors:]}
+
+
+def task_log_file(taskdir):
+    return op.join(taskdir, Path(taskdir).name + "_icafix.log")
+
+
+def task_pool_size(gear_args, ntasks):
+    """Size the task worker pool from the slurm-cpu configuration.
+
+    Each worker is given one cpu, limited by the cpus actually available on the node. Memory is not a
+    pool limit: tasks are admitted against the memory budget by their estimates (see memory_budget).
+    """
+    cpus = int(gear_args.config.get("slurm-cpu") or 1)
+    cpus = min(cpus, len(os.sched_getaffinity(0)))
+
+    return int(max(1, min(ntasks, cpus)))
+
+
+def memory_budget(gear_args):
+    """Memory for concurrent tasks: one 'slurm-ram' share per cpu (matching '--mem-per-cpu'), limited by
+    the memory actually available on the node."""
+    cpus = int(gear_args.config.get("slurm-cpu") or 1)
+    allocated = parse_memory(gear_args.config.get("slurm-ram") or "12G") * cpus
+
+    return int(min(allocated, psutil.virtual_memory().available))
+
+
+def parse_memory(text):
+    """Convert a slurm style memory string (e.g. '12G', '500M') to bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    text = str(text).strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    # slurm default unit is megabytes
+    return int(float(text) * units["M"])
 
 
 def check_input_files(workdir, suffix):
     # Look for tasks in HCP preprocessed file list
-    taskdirs = sp.Popen(
-        "ls -d " + workdir.absolute().as_posix() + "/HCPPipe/sub-*/ses-*/MNINonLinear/Results/*task*", shell=True, stdout=sp.PIPE,
-        stderr=sp.PIPE, universal_newlines=True
-    )
-
-    stdout, _ = taskdirs.communicate()
+    taskdirs = search(workdir.absolute().as_posix() + "/HCPPipe/sub-*/ses-*/MNINonLinear/Results/*task*")
     log.info("Running HCP Fix for the following directories: ")
-    log.info("\n %s", stdout)
+    log.info("\n %s", "\n".join(taskdirs))
 
     # quick manipulation to pull the task name (same as preprocessed image name)
     matches = []
-    for f in stdout.splitlines():
+    for f in taskdirs:
         pp = f.split('/')
         pp.append(pp[-1])
         matches.append("/" + os.path.join(*pp) + suffix)
@@ -165,14 +585,18 @@ def fetch_dummy_volumes(taskname, context):
     if context.config["DropNonSteadyState"] is False:
         return 0
 
+    if "DummyVolumes" in context.config:
+        log.info("Set by user....Using %s dummy volumes", context.config['DummyVolumes'])
+        return context.config['DummyVolumes']
+
     bids_name = fetch_acq_name(taskname)
 
     acq, f = metadata.find_matching_acq(bids_name, context)
 
-    if "DummyVolumes" in context.config:
-        log.info("Extracting dummy volumes from acquisition: %s", acq.label)
-        log.info("Set by user....Using %s dummy volumes", context.config['DummyVolumes'])
-        return context.config['DummyVolumes']
+    if acq is None:
+        raise ValueError("No functional acquisition of the session matches %s (%s), unable to read the dummy "
+                         "volumes from its mriqc metadata. Set the DummyVolumes option or disable "
+                         "DropNonSteadyState." % (bids_name, os.path.basename(taskname)))
 
     if f:
         IQMs = f.info["IQM"]
@@ -208,46 +632,30 @@ def drop_initial_volumes(input_files, context):
     dummyvars = context.config['AcqDummyVolumes']
 
     f = NamedTemporaryFile(delete=False, dir=input_files["taskdir"])
-    store_original_filename = f.name + "_" + os.path.basename(input_files["preprocessed_files"])
-    shutil.copyfile(input_files["preprocessed_files"], store_original_filename)
+    dummyvols_filename = f.name + "_" + os.path.basename(input_files["preprocessed_files"])
 
-    # create trimmed nifti
-    cmd = os.environ["FSLDIR"] + "/bin/fslroi " + store_original_filename + " " + input_files["preprocessed_files"] + " " + str(dummyvars) + " -1"
-    execute_shell(cmd, dryrun=context.config["dry-run"], cwd=input_files["taskdir"])
+    # create trimmed nifti (only the dummy frames are kept to restitch the outputs later)
+    log.info("Trimming %s, dummy frames stored in %s", os.path.basename(input_files["preprocessed_files"]),
+             os.path.basename(dummyvols_filename))
+    if not context.config["dry-run"]:
+        timeseries.split_volume_frames(input_files["preprocessed_files"], int(dummyvars), dummyvols_filename)
 
     # create trimmed Movement_Regressors.txt
     if input_files["motion_files"]:
         store_original_motionfile = f.name + "_" + os.path.basename(input_files["motion_files"])
-        shutil.copyfile(input_files["motion_files"], store_original_motionfile)
-
-        cmd = "tail -n +" + str(dummyvars+1) + " < " + store_original_motionfile + " > " + input_files["motion_files"]
-        execute_shell(cmd, dryrun=context.config["dry-run"], cwd=os.path.dirname(input_files["preprocessed_files"]))
+        log.info("Trimming %s", os.path.basename(input_files["motion_files"]))
+        if not context.config["dry-run"]:
+            shutil.copyfile(input_files["motion_files"], store_original_motionfile)
+            confounds.trim_motion_file(store_original_motionfile, int(dummyvars), out_file=input_files["motion_files"])
 
-    # create trimmed cifti (there may be a more direct way to do this...)
+    # create trimmed cifti (series axis trimmed directly, initial frames kept for the restitch)
     if input_files["surface_files"]:
-        store_original_ciftifile = f.name + "_" + os.path.basename(input_files["surface_files"])
-
-        # retrieve step-interval-size (TR)
-        cmd = os.environ["FSL_FIX_WBC"] + " -file-information " + input_files["surface_files"] + " -only-step-interval "
-        stepsize = execute_shell(cmd, dryrun=context.config["dry-run"], cwd=input_files["taskdir"])
-
-        # make copy of original file
-        shutil.copyfile(input_files["surface_files"], store_original_ciftifile)
-
-        # convert cifti to nifti
-        cmd = os.environ["FSL_FIX_WBC"] + " -cifti-convert -to-nifti " + input_files["surface_files"] + " tmp_cifti2nfiti.nii.gz"
-        execute_shell(cmd, dryrun=context.config["dry-run"], cwd=input_files["taskdir"])
+        log.info("Trimming %s", os.path.basename(input_files["surface_files"]))
+        if not context.config["dry-run"]:
+            timeseries.split_cifti_frames(input_files["surface_files"], int(dummyvars),
+                                          os.path.join(input_files["taskdir"], CIFTI_DUMMYVOLS_FILENAME))
 
-        # trim cifti2nifti file
-        cmd = os.environ["FSLDIR"] + "/bin/fslroi " + "tmp_cifti2nfiti.nii.gz" + " " + "tmp_cifti2nfiti_trimmed.nii.gz" + " " + str(
-            dummyvars) + " -1"
-        execute_shell(cmd, dryrun=context.config["dry-run"], cwd=input_files["taskdir"])
-
-        # convert back to cifti
-        cmd = os.environ["FSL_FIX_WBC"] + " -cifti-convert -from-nifti " + "tmp_cifti2nfiti_trimmed.nii.gz" + " " + store_original_ciftifile + " " + input_files["surface_files"] + " -reset-timepoints " + str(stepsize) + " 0"
-        execute_shell(cmd, dryrun=context.config["dry-run"], cwd=input_files["taskdir"])
-
-    return store_original_filename
+    return dummyvols_filename
 
 
 def cleanup_volume_files(ica_file, temp_file, context):
@@ -258,17 +666,10 @@ def cleanup_volume_files(ica_file, temp_file, context):
         return
 
     log.info("Adding dummy frames back to ICA cleaned output %s!", os.path.basename(ica_file))
-    dummyvars = context.config['AcqDummyVolumes']
 
-    # get the original dummy volumes
-    f = NamedTemporaryFile(delete=False, dir=os.path.dirname(temp_file))
-    dummyvols_filename = f.name + "_" + os.path.basename(temp_file)
-    cmd = os.environ["FSLDIR"] + "/bin/fslroi " + temp_file + " " + dummyvols_filename + " 0 " + str(dummyvars)
-    execute_shell(cmd, dryrun=context.config["dry-run"], cwd=os.getcwd())
-
-    # add original dummy vols back to cleaned (and filtered ica outputs)
-    cmd = os.environ["FSLDIR"] + "/bin/fslmerge -t " + ica_file + " " + dummyvols_filename + " " + ica_file
-    execute_shell(cmd, dryrun=context.config["dry-run"], cwd=os.getcwd())
+    # add original dummy vols (stored by drop_initial_volumes) back to cleaned (and filtered ica outputs)
+    if not context.config["dry-run"]:
+        timeseries.prepend_volume_frames(temp_file, ica_file)
 
 
 def cleanup_surface_files(cifti_file, temp_file, context):
@@ -279,39 +680,17 @@ def cleanup_surface_files(cifti_file, temp_file, context):
         return
 
     log.info("Adding dummy frames back to ICA cleaned output %s!", os.path.basename(cifti_file))
-    dummyvars = context.config['AcqDummyVolumes']
 
-    # get the original dummy volumes
-    f = NamedTemporaryFile(delete=False, dir=os.path.dirname(temp_file))
-    temp_cifti2nifti_filename = f.name + "_" + os.path.basename(cifti_file)
+    # add original dummy frames (stored by drop_initial_volumes) back to cleaned (and filtered ica outputs)
+    if not context.config["dry-run"]:
+        timeseries.prepend_cifti_frames(os.path.join(os.path.dirname(cifti_file), CIFTI_DUMMYVOLS_FILENAME), cifti_file)
 
-    # pull the original initial surface frames
-    cmd = os.environ["FSLDIR"] + "/bin/fslroi " + "tmp_cifti2nfiti.nii.gz" + " " + "tmp_cifti2nfiti_initalvols.nii.gz 0 " + str(dummyvars)
-    execute_shell(cmd, dryrun=context.config["dry-run"], cwd=os.path.dirname(cifti_file))
 
-    # merge original frames with cleaned cifti2nifti
-    cmd = os.environ["FSL_FIX_WBC"] + " -cifti-convert -to-nifti " + cifti_file + " " + temp_cifti2nifti_filename
-    execute_shell(cmd, dryrun=context.config["dry-run"], cwd=os.path.dirname(cifti_file))
-
-    # add original dummy frames back to cleaned (and filtered ica outputs)
-    cmd = os.environ["FSLDIR"] + "/bin/fslmerge -t " + "tmp_output" + " " + "tmp_cifti2nfiti_initalvols.nii.gz" + " " + temp_cifti2nifti_filename
-    execute_shell(cmd, dryrun=context.config["dry-run"], cwd=os.path.dirname(cifti_file))
-
-    # get original stepsize
-    cmd = os.environ["FSL_FIX_WBC"] + " -file-information " + cifti_file + " -only-step-interval "
-    stepsize = execute_shell(cmd, dryrun=context.config["dry-run"], cwd=os.path.dirname(cifti_file))
-
-    # finally, return to cifti format
-    cmd = os.environ["FSL_FIX_WBC"] + " -cifti-convert -from-nifti " + "tmp_output.nii.gz" + " " + cifti_file + " " + cifti_file + " -reset-timepoints " + str(stepsize) + " 0"
-    execute_shell(cmd, dryrun=context.config["dry-run"], cwd=os.path.dirname(cifti_file))
-
-
-
-def generate_icafix_command(input_file, context, stage):
-    training_file = context.config['TrainingFilePath']
+def generate_icafix_command(input_file, context, stage, training_file=None, fix_threshold=None):
+    training_file = training_file or context.config['TrainingFilePath']
     highpass = context.config['HighPassFilter']
     mot_reg = context.config['do_motion_regression']
-    fix_threshold = context.config['FixThreshold']
+    fix_threshold = fix_threshold if fix_threshold is not None else context.config['FixThreshold']
     del_intermediates = context.config['DeleteIntermediates']
 
     if stage == "hcpfix":
@@ -319,12 +698,13 @@ def generate_icafix_command(input_file, context, stage):
             [('input', input_file), ('highpass', highpass), ('mot_reg', str(mot_reg).upper()),
              ('training_file', training_file), ('fix_threshold', fix_threshold),
              ('del_intermediate', str(del_intermediates).upper())])
-        context.icafix["common_command"]= "/opt/HCP-Pipelines/ICAFIX/hcp_fix"
+        context.icafix["common_command"] = op.join(context.environ.get("HCPPIPEDIR", "/opt/HCP-Pipelines"), "ICAFIX",
+                                                   "hcp_fix")
     if stage == "classify":
         context.icafix["params"] = OrderedDict(
             [('flag', '-c'), ('input', input_file), ('training_file', training_file), ('fix_threshold', fix_threshold)]
         )
-        context.icafix["common_command"] = "/opt/fix/fix"
+        context.icafix["common_command"] = op.join(context.environ.get("FSL_FIXDIR", "/opt/fix"), "fix")
 
     if stage == "apply cleanup":
         context.icafix["params"] = OrderedDict(
@@ -335,7 +715,7 @@ def generate_icafix_command(input_file, context, stage):
             if highpass:
                 context.icafix["params"].update({'highpass', "-h " + highpass})
 
-        context.icafix["common_command"] = "/opt/fix/fix"
+        context.icafix["common_command"] = op.join(context.environ.get("FSL_FIXDIR", "/opt/fix"), "fix")
 
 
 def fetch_noise_labels(taskname, context):
@@ -371,11 +751,12 @@ def execute(gear_args):
             stdout_msg=stdout_msg,
             cont_output=True,
         )
+        invalidate()
         log.info("\n %s", stdout)
         log.info("\n %s", stderr)
 
         if "error" in stderr.lower() or returncode != 0:
-            gear_args["errors"].append(
+            gear_args.errors.append(
                 {"message": "hcp_fix failed. Check log", "exception": stderr}
             )
     except Exception as e:
@@ -388,39 +769,30 @@ def execute(gear_args):
 def cleanup(gear_args: GearToolkitContext):
 
     # create bids-derivative naming scheme
-    if gear_args.mode == "fix cleanup":
-        trainingname = "_"+Path(gear_args.config['TrainingFilePath']).stem
-        filemapper.main(gear_args.analysis_dir, gear_args.dest_id, gear_args.client, fix_trainingfile=trainingname)
-    elif gear_args.mode == "hand labeled":
-        trainingname = "_" + "handlabel"
-        filemapper.main(gear_args.analysis_dir, gear_args.dest_id, gear_args.client, fix_trainingfile=trainingname)
-    else:
-        filemapper.main(gear_args.analysis_dir, gear_args.dest_id, gear_args.client)
-
-    # locate new files from analysis
-    new = []
-    for path, subdirs, files in os.walk(gear_args.work_dir):
-        for name in files:
-            if "tmp" in name or "temp" in name:
-                continue  ## ignore temporary files...
-            new.append(os.path.join(path, name))
-
-    outfiles = [x for x in new if x not in set(gear_args.unzipped_files)]
+    confound_options = {"friston24": gear_args.config.get("friston24-confounds", False),
+                        "fd": gear_args.config.get("framewise-displacement", False)}
+    with profiling.stage("filemapper"):
+        if gear_args.mode == "fix cleanup":
+            trainingnames = ["_" + Path(gear_args.config['TrainingFilePath']).stem]
+        elif gear_args.mode == "hand labeled":
+            trainingnames = ["_" + "handlabel"]
+        else:
+            trainingnames = [""]
 
-    outfiles_rel = [i.replace(str(gear_args.work_dir) + os.sep, '') for i in outfiles]
+        # the cleaned outputs of each sweep combination are mapped in the same pass
+        trainingnames += ["_" + name for _, _, name in sweep_combinations(gear_args)]
+        filemapper.main(gear_args.analysis_dir, gear_args.dest_id, gear_args.client,
+                        dryrun=gear_args.config["dry-run"], fix_trainingfile=trainingnames, **confound_options)
 
-    with open(op.join(str(gear_args.work_dir),"files.txt"), 'w') as f:
-        f.write("\n".join(map(str, outfiles_rel)))
+    # locate new files from analysis and inputs changed in place (ignore temporary files...)
+    outfiles_rel = gear_args.manifest.outputs(exclude=lambda name: "tmp" in name or "temp" in name)
 
     # use new list for final output
-    # zip output files
-    os.chdir(gear_args.work_dir)
+    # zip output files (symlinks kept, compressed payloads stored as is)
     output_zipname = gear_args.output_dir.absolute().as_posix() + "/hcpfix_results_" + \
                      gear_args.gtk_context.destination["id"] + ".zip"
-
-    # NEW method to zip working directory using 'zip --symlinks -r outzip.zip data/'
-    cmd = "zip --symlinks -r " + output_zipname + " -@ < files.txt "
-    execute_shell(cmd, cwd=str(gear_args.work_dir))
+    with profiling.stage("archive"):
+        zip_results(output_zipname, str(gear_args.work_dir), outfiles_rel)
 
     # log final results size
     os.chdir(gear_args.output_dir)
@@ -433,7 +805,7 @@ def cleanup(gear_args: GearToolkitContext):
     return 0
 
 
-def store_metadata(labels_file, icstats_file, taskname, context):
+def store_metadata(labels_file, icstats_file, taskname, context, name=None, profile=None):
     # after successful completion of the gear, generate simple metadata on ica component classification
     # metadata:
     #   classification [total, signal, unknown, unclassified noise]
@@ -452,8 +824,10 @@ def store_metadata(labels_file, icstats_file, taskname, context):
 
     info_obj = metrics.to_dict()
     info_obj["job"] = context.gtk_context.destination["id"]
+    if profile:
+        info_obj["profile"] = profile
 
-    trainingfile = context.config['TrainingFile'].split(".")[0]
+    trainingfile = name or context.config['TrainingFile'].split(".")[0]
     info_obj = {trainingfile: info_obj}
 
     taskname_split = taskname.split("/")[-1].split(".")[0].split("_")
@@ -464,8 +838,8 @@ def store_metadata(labels_file, icstats_file, taskname, context):
     if fw_file:
         # B/c of 'info' being a flywheel.models.info_list_output.InfoListOutput,
         # deep_merge in `update_file` doesn't work.
-
-        fw_file.update_info({"ICAFIX": info_obj})
+        # queued and sent at the end of the job (entries of the same file are merged)
+        context.client.queue_info_update(acq.id, fw_file.name, {"ICAFIX": info_obj})
         # log.info(f"Updated metadata file: {fw_file.name}")
 
 
@@ -482,35 +856,11 @@ def execute_shell(cmd, dryrun=False, cwd=os.getcwd()):
             cwd=cwd
         )
         stdout, stderr = terminal.communicate()
+        # the command may have created files within the mtime tick of a cached listing
+        invalidate()
         log.debug("\n %s", stdout)
         log.debug("\n %s", stderr)
 
         return stdout.strip('\n')
 
 
-def searchfiles(path, dryrun=False, find_first=False, find_recent=False) -> list[str]:
-
-    if find_recent:
-        options=" -dt "
-    else:
-        options=" -d "
-    cmd = "ls" + options + path
-
-    log.debug("\n %s", cmd)
-
-    if not dryrun:
-        terminal = sp.Popen(
-            cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-        )
-        stdout, stderr = terminal.communicate()
-        log.debug("\n %s", stdout)
-        log.debug("\n %s", stderr)
-
-        files = stdout.strip("\n").split("\n")
-
-        if find_first or find_recent:
-            files = files[0]
-
-        return files
-
-
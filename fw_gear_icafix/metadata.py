@@ -1,6 +1,8 @@
 import os, sys
+import json
 import pandas as pd
 import logging
+from collections import OrderedDict
 
 log = logging.getLogger(__name__)
 
@@ -36,16 +38,123 @@ def find_matching_acq(bids_name, context):
         acquisition and file objects matching the original image file on which the
         metrics were completed.
     """
-    fw = context.gtk_context.client
-    dest_id = context.gtk_context.destination["id"]
-    destination = fw.get(dest_id)
-    session = fw.get_session(destination.parents["session"])
+    return get_acquisition_index(context).lookup(bids_name)
 
-    # assumes reproin naming scheme for acquisitions!
-    for acq in session.acquisitions.iter_find():
-        full_acq = fw.get_acquisition(acq.id)
-        if ("func-bold" in acq.label) and (bids_name in acq.label) and ("sbref" not in acq.label.lower()):
+
+def get_acquisition_index(context, cache_file=None):
+    """
+    Return the session acquisition index for this job, building it on first use. The index is stored on
+    the gear context so every caller (dummy volumes, noise labels, metadata) shares a single session scan.
+    Args:
+        context (obj): gear context
+        cache_file (str): optional json file used to persist the index (loaded if it matches the session)
+    Returns:
+        AcquisitionIndex
+    """
+    if getattr(context, "acquisition_index", None) is None:
+        fw = context.client
+        destination = fw.get(context.gtk_context.destination["id"])
+        session_id = destination.parents["session"]
+
+        index = AcquisitionIndex.load(fw, session_id, cache_file) if cache_file else None
+        if index is None:
+            index = AcquisitionIndex(fw, session_id).build()
+            if cache_file:
+                index.save(cache_file)
+
+        context.acquisition_index = index
+
+    return context.acquisition_index
+
+
+def bids_key(filename):
+    """
+    Reduce a BIDS filename to the entities HCPPipelines uses in task names, e.g.
+    'sub-01_ses-01_task-rest_run-01_bold.nii.gz' -> 'task-rest_run-01'
+    """
+    parts = os.path.basename(filename).split(".")[0].split("_")
+    if "bold" in parts:
+        parts = parts[:parts.index("bold")]
+    return "_".join(p for p in parts if not p.startswith(("sub-", "ses-")))
+
+
+class AcquisitionIndex:
+    """
+    Index of the functional (func-bold, non sbref) acquisitions and their image files in a session, keyed
+    by BIDS name. The session is scanned once; acquisitions are fetched from flywheel at most once each.
+    """
+
+    def __init__(self, client, session_id):
+        self.client = client
+        self.session_id = session_id
+        self.entries = OrderedDict()
+        self._acquisitions = {}
+
+    def build(self):
+        # assumes reproin naming scheme for acquisitions!
+        # (full acquisitions are usually prefetched, see utils.flywheel_client)
+        for acq in self.client.find_acquisitions(self.session_id):
+            if ("func-bold" not in acq.label) or ("sbref" in acq.label.lower()):
+                continue
+
+            full_acq = self.client.get_acquisition(acq.id)
+            self._acquisitions[acq.id] = full_acq
             for f in full_acq.files:
-                if bids_name in f.info.get("BIDS").get("Filename") and "nii" in f.name:
-                    return full_acq, f
+                bids = (f.info or {}).get("BIDS")
+                if not isinstance(bids, dict) or not bids.get("Filename") or "nii" not in f.name:
+                    continue
+                self.entries.setdefault(bids_key(bids["Filename"]), {
+                    "acquisition_id": acq.id,
+                    "acquisition_label": acq.label,
+                    "file_name": f.name,
+                    "bids_filename": bids["Filename"],
+                })
+
+        log.info("Indexed %s functional files in session %s", len(self.entries), self.session_id)
+
+        return self
+
+    def lookup(self, bids_name):
+        """Return (acquisition, file) matching bids_name, or (None, None)."""
+        entry = self.entries.get(bids_name)
+
+        if entry is None or bids_name not in entry["acquisition_label"]:
+            # partial names: same substring match as the original session scan, without api calls
+            entry = next((e for e in self.entries.values()
+                          if bids_name in e["acquisition_label"] and bids_name in e["bids_filename"]), None)
+
+        if entry is None:
+            log.warning("Unable to locate acquisition matching %s", bids_name)
+            return None, None
+
+        acq = self._acquisition(entry["acquisition_id"])
+        fw_file = next((f for f in acq.files if f.name == entry["file_name"]), None)
+
+        return acq, fw_file
+
+    def _acquisition(self, acq_id):
+        if acq_id not in self._acquisitions:
+            self._acquisitions[acq_id] = self.client.get_acquisition(acq_id)
+        return self._acquisitions[acq_id]
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"session_id": self.session_id, "entries": self.entries}, f, indent=2)
+
+    @classmethod
+    def load(cls, client, session_id, filename):
+        """Load a saved index, returns None if missing or saved for a different session."""
+        if not os.path.exists(filename):
+            return None
+
+        with open(filename) as f:
+            data = json.load(f, object_pairs_hook=OrderedDict)
+
+        if data.get("session_id") != session_id:
+            return None
+
+        index = cls(client, session_id)
+        index.entries = data["entries"]
+        log.info("Loaded acquisition index from %s", filename)
 
+        return index
@@ -8,12 +8,54 @@ import json
 from fw_gear_icafix.main import execute_shell
 import errorhandler
 import pandas as pd
-import subprocess as sp
 from pathlib import Path
 import csv
+import utils.filemapper as filemapper
+from utils.archive import extract_members
+from utils.filesearch import search
+from utils.flywheel_client import FlywheelClient
+from utils.manifest import FileManifest
 
 log = logging.getLogger(__name__)
 
+# archive members needed per gear mode (fnmatch patterns relative to the analysis directory, None: everything)
+# besides these, the files linked by the file mapper (see extract_patterns) and the targets of links in the
+# selection (e.g. the series hcp_fix links into its .ica directory) are extracted
+# previous iteration "clean" volumes are never needed
+CLEANUP_PATTERNS = [
+    "*/MNINonLinear/Results/*task*/*hp*.ica/*",
+    "*/MNINonLinear/Results/*task*/*_hp*.nii.gz",
+    "*/MNINonLinear/Results/*task*/*_Atlas_hp*.dtseries.nii",
+    "*/MNINonLinear/Results/*task*/*.txt",
+    "*/MNINonLinear/Results/*task*/*_icafix_checkpoints.json",
+]
+EXTRACT_PATTERNS = {
+    "hcpfix": None,
+    "fix cleanup": CLEANUP_PATTERNS,
+    "hand labeled": CLEANUP_PATTERNS,
+}
+EXTRACT_EXCLUDE = {
+    "hcpfix": None,
+    "fix cleanup": ["*clean.*", "*clean_vn*"],
+    "hand labeled": ["*clean.*", "*clean_vn*"],
+}
+
+# files located in each task directory (filename templates, {task} is the task directory name)
+TASK_FILE_ROLES = {
+    "preprocessed_files": "{task}.nii.gz",
+    "motion_files": "Movement_Regressors.txt",
+    "surface_files": "{task}_Atlas.dtseries.nii",
+}
+TASK_TABLE_COLUMNS = ["taskdir", "preprocessed_files", "motion_files", "surface_files"]
+
+
+def extract_patterns(mode):
+    """Archive members to extract in a gear mode: EXTRACT_PATTERNS and the sources of the file mapper links."""
+    if EXTRACT_PATTERNS[mode] is None:
+        return None
+    return EXTRACT_PATTERNS[mode] + filemapper.source_patterns()
+
+
 # Track if message gets logged with severity of error or greater
 error_handler = errorhandler.ErrorHandler()
 
@@ -67,11 +109,18 @@ class GearArgs:
         }
         self.config = gtk_context.config
         self.gtk_context = gtk_context
-        self.client = gtk_context.client
+        # cached, concurrent client shared by the whole job (see utils.flywheel_client)
+        self.client = FlywheelClient(gtk_context.client)
         self.work_dir = gtk_context.work_dir
         self.analysis_dir = Path(os.path.join(gtk_context.work_dir, self.gtk_context.destination["id"]))
         self.output_dir = gtk_context.output_dir
         self.dest_id = self.gtk_context.destination["id"]
+        self.acquisition_index = None  # built on first use, see metadata.get_acquisition_index
+        self.manifest = FileManifest(self.work_dir)
+        self.errors = []  # failures reported by the hcp_fix / fix commands (see main.execute)
+
+        # fetch the containers used by every task while the inputs are unzipped
+        self.client.prefetch(self.dest_id, acquisition_filter=lambda label: "func-bold" in label)
 
         os.makedirs(self.analysis_dir, exist_ok=True)
 
@@ -102,70 +151,46 @@ class GearArgs:
         log.info("Inputs file path, %s", self.input_zip)
         self.unzip_inputs(self.input_zip)
 
-        # pull original file structure
-        orig = []
-        for path, subdirs, files in os.walk(self.work_dir):
-            for name in files:
-                orig.append(os.path.join(path, name))
-
-        self.unzipped_files = orig
+        # pull original file structure (recorded while unzipping)
+        self.unzipped_files = self.manifest.input_paths()
 
         # pull file list for each iteration
         # 1. pull task dirs
         # Look for tasks in HCP preprocessed file list
-        taskdirs = sp.Popen(
-            "ls -d " + self.analysis_dir.absolute().as_posix() + "/HCPPipe/sub-*/ses-*/MNINonLinear/Results/*task*", shell=True,
-            stdout=sp.PIPE,
-            stderr=sp.PIPE, universal_newlines=True
-        )
-        stdout, _ = taskdirs.communicate()
-
-        if not stdout.splitlines():
+        taskdirs = search(self.analysis_dir.absolute().as_posix() + "/HCPPipe/sub-*/ses-*/MNINonLinear/Results/*task*")
+
+        if not taskdirs:
             # try old naming scheme
-            taskdirs = sp.Popen(
-                "ls -d " + self.analysis_dir.absolute().as_posix() + "/*/MNINonLinear/Results/*task*",
-                shell=True,
-                stdout=sp.PIPE,
-                stderr=sp.PIPE, universal_newlines=True
-            )
-            stdout, _ = taskdirs.communicate()
+            taskdirs = search(self.analysis_dir.absolute().as_posix() + "/*/MNINonLinear/Results/*task*")
 
         log.info("Running HCP Fix for the following directories: ")
-        log.info("\n %s", stdout)
-
-        taskdirs = stdout.splitlines()
+        log.info("\n %s", "\n".join(taskdirs))
 
-        self.files = pd.DataFrame()
-        
         if self.mode == "hand labeled" or self.mode == "fix cleanup":
-            for idx, d in enumerate(taskdirs):
-                basename = Path(d).stem
-                try:
-                    file1 = [s for s in self.unzipped_files if "_hp" + str(self.preproc_gear.job.config['config']['HighPassFilter']) + ".nii.gz" in s and basename in s][0]
-                except AttributeError:
-                    file1 = [s for s in self.unzipped_files if "_hp" + str(
-                        self.config['HighPassFilter']) + ".nii.gz" in s and basename in s][0]
-                tmp = pd.DataFrame({"taskdir": d, "preprocessed_files": file1, "motion_files": None, "surface_files": None}, index=[0])
-                self.files = pd.concat([self.files, tmp], ignore_index=True)
+            try:
+                highpass = self.preproc_gear.job.config['config']['HighPassFilter']
+            except AttributeError:
+                highpass = self.config['HighPassFilter']
+            roles = {"preprocessed_files": "{task}_hp" + str(highpass) + ".nii.gz"}
+            # the CIFTI series hcp_fix ran on (restitched to full length like the volume series) is trimmed
+            # with it, so both match the ICA again
+            optional = {"surface_files": "{task}_Atlas_hp" + str(highpass) + ".dtseries.nii"}
         else:
-            for idx, d in enumerate(taskdirs):
-                basename = Path(d).stem
-                file1 = [s for s in self.unzipped_files if basename + ".nii.gz" in s and d in s][0]
-                file2 = [s for s in self.unzipped_files if "Movement_Regressors.txt" in s and d in s][0]
-                file3 = [s for s in self.unzipped_files if "_Atlas.dtseries.nii" in s and d in s][0]
-                tmp = pd.DataFrame(
-                    {"taskdir": d, "preprocessed_files": file1, "motion_files": file2, "surface_files": file3}, index=[0])
-                self.files = pd.concat([self.files, tmp], ignore_index=True)
+            roles = TASK_FILE_ROLES
+            optional = None
+
+        self.files = build_task_table(self.unzipped_files, taskdirs, roles, optional)
 
         # remove previous iteration "clean volumes"
         files = [s for s in self.unzipped_files if "clean." in s or "clean_vn" in s]
         for f in files:
             os.remove(f)
+            self.manifest.discard(f)
 
     def unzip_inputs(self, zip_filename):
         """
         unzip_inputs unzips the contents of zipped gear output into the working
-        directory.
+        directory. Only the members needed for the gear mode are extracted (see EXTRACT_PATTERNS).
         Args:
             self: The gear context object
                 containing the 'gear_dict' dictionary attribute with key/value,
@@ -174,22 +199,26 @@ class GearArgs:
         """
         rc = 0
         outpath = []
-        # use linux "unzip" methods in shell in case symbolic links exist
         log.info("Unzipping file, %s", zip_filename)
-        cmd = "unzip -o " + zip_filename + " -d " + str(self.analysis_dir)
-        execute_shell(cmd, cwd=self.analysis_dir)
 
-        # if unzipped directory is a destination id - move all outputs one level up
+        # top level names from the central directory
         with ZipFile(zip_filename, "r") as f:
-            top = [item.split('/')[0] for item in f.namelist()]
-            top1 = [item.split('/')[1] for item in f.namelist()]
+            names = [item for item in f.namelist() if "/" in item]
+        top = [item.split('/')[0] for item in names]
+        top1 = [item.split('/')[1] for item in names]
+
+        # if unzipped directory is a destination id - extract all outputs one level up
+        strip_prefix = top[0] if top and len(top[0]) == 24 else None
+
+        extracted = extract_members(zip_filename, str(self.analysis_dir), include=extract_patterns(self.mode),
+                        exclude=EXTRACT_EXCLUDE[self.mode], strip_prefix=strip_prefix,
+                        n_workers=int(self.config.get("slurm-cpu") or 1), follow_links=True)
+        self.manifest.add_inputs(extracted)
 
         log.info("Done unzipping.")
 
-        if len(top[0]) == 24:
+        if strip_prefix:
             # directory starts with flywheel destination id - obscure this for now...
-            cmd = "mv " + top[0] + '/* . ; rm -R ' + top[0]
-            execute_shell(cmd, cwd=self.analysis_dir)
             for i in set(top1):
                 outpath.append(os.path.join(self.analysis_dir, i))
 
@@ -246,3 +275,57 @@ class GearArgs:
 
         else:
             return False
+
+
+def index_task_files(paths, taskdirs):
+    """
+    Index files by task directory and filename in a single pass over the file list.
+    Args:
+        paths (list): file paths (e.g. all unzipped files)
+        taskdirs (list): task directories of interest
+    Returns:
+        dict: {taskdir: {filename: path}} for files located directly in each task directory
+    """
+    index = {os.path.abspath(d): {} for d in taskdirs}
+    for path in paths:
+        files = index.get(os.path.dirname(os.path.abspath(path)))
+        if files is not None:
+            files.setdefault(os.path.basename(path), path)
+    return {d: index[os.path.abspath(d)] for d in taskdirs}
+
+
+def build_task_table(paths, taskdirs, roles, optional=None):
+    """
+    Build the task table (one row per task directory, one column per file role).
+    Args:
+        paths (list): file paths (e.g. all unzipped files)
+        taskdirs (list): task directories
+        roles (dict): column name -> filename template, {task} is replaced by the task directory name
+        optional (dict): as roles, for files that may be missing (None in the table)
+    Returns:
+        pd.DataFrame: columns TASK_TABLE_COLUMNS, roles not requested are None
+    Raises:
+        Exception: if a file is missing for any task directory (all missing files are logged first)
+    """
+    index = index_task_files(paths, taskdirs)
+
+    rows = []
+    missing = []
+    for d in taskdirs:
+        row = dict.fromkeys(TASK_TABLE_COLUMNS)
+        row["taskdir"] = d
+        for role, template in roles.items():
+            filename = template.format(task=Path(d).stem)
+            row[role] = index[d].get(filename)
+            if row[role] is None:
+                missing.append(os.path.join(d, filename))
+        for role, template in (optional or {}).items():
+            row[role] = index[d].get(template.format(task=Path(d).stem))
+        rows.append(row)
+
+    if missing:
+        for f in missing:
+            log.error("Required input file not found: %s", f)
+        raise Exception("Missing %s required input file(s), unable to set up tasks." % len(missing))
+
+    return pd.DataFrame(rows, columns=TASK_TABLE_COLUMNS)
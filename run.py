@@ -13,6 +13,7 @@ from flywheel_gear_toolkit import GearToolkitContext
 from fw_gear_icafix.main import run
 from fw_gear_icafix.parser import GearArgs
 from utils.singularity import run_in_tmp_dir
+import utils.profiling as profiling
 import errorhandler
 # The run.py should be as minimal as possible.
 # The gear is split up into 2 main components. The run.py file which is executed
@@ -54,7 +55,8 @@ def main(context: GearToolkitContext):  # pragma: no cover
     #Parse inputs to extract the args, kwargs from the context
     # (e.g. config.json).
     log.info("Populating gear arguments")
-    gear_args = GearArgs(context)
+    with profiling.stage("setup"):
+        gear_args = GearArgs(context)
 
     if error_handler.fired:
         log.critical('Failure: exiting with code 1 due to logged errors')
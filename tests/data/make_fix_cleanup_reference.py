@@ -0,0 +1,122 @@
+"""Reference outputs of FIX cleanup (fix -a) used by tests/test_denoise.py.
+
+MATLAB/MCR and FIX are not available where the tests run, so the reference is computed by a direct numpy
+transcription of FIX 1.06x fix_cleanup.m, functionmotionconfounds.m and functionnormalise.m, and of
+fslmaths -bptf (bandpass_temporal_filter in FSL newimagefns.cc), on whole matrices and without using
+utils.denoise. The dense series is cleaned as linked in the .ica directory (Atlas.dtseries.nii, already
+high-pass filtered by hcp_fix), with the same regression as the volume.
+
+Regenerate from the repository root:
+    python tests/data/make_fix_cleanup_reference.py
+"""
+
+import os.path as op
+
+import numpy as np
+
+OUT_FILE = op.join(op.dirname(op.abspath(__file__)), "fix_cleanup_reference.npz")
+
+NTIME = 60
+NCOMP = 8
+SHAPE = (3, 3, 2)
+NGRAY = 12
+TR = 0.72
+# small cutoff, so the -bptf kernel is truncated within the series (sigma * 3 = 20.8 frames)
+HIGHPASS = 10.0
+NOISE = [2, 3, 5, 8]
+
+
+def functionnormalise(x):
+    x = x - x.mean(axis=0)
+    return x / x.std(axis=0, ddof=1)
+
+
+def bptf(data, hp_sigma):
+    """fslmaths -bptf <hp_sigma> -1 on each column of data (time x n)."""
+    size = int(hp_sigma * 3)
+    hp_exp = np.exp(-0.5 * np.arange(-size, size + 1) ** 2 / hp_sigma ** 2)
+    ntime = data.shape[0]
+    out = np.empty_like(data)
+    for col in range(data.shape[1]):
+        array = data[:, col]
+        for t in range(ntime):
+            A = B = C = D = N = 0.0
+            for tt in range(max(t - size, 0), min(t + size, ntime - 1) + 1):
+                dt = tt - t
+                w = hp_exp[dt + size]
+                A += w * dt
+                B += w * array[tt]
+                C += w * dt * dt
+                D += w * dt * array[tt]
+                N += w
+            denom = C * N - A * A
+            c = (B * C - A * D) / denom if denom != 0 else B / N
+            out[t, col] = array[t] - c
+    return out
+
+
+def functionmotionconfounds(par, tr, hp):
+    confounds = par[:, :6]
+    diffs = np.vstack([np.zeros((1, 6)), confounds[1:] - confounds[:-1]])
+    confounds = functionnormalise(np.hstack([confounds, diffs]))
+    confounds = functionnormalise(np.hstack([confounds, confounds * confounds]))
+    if hp == 0:
+        t = np.vstack([np.ones(len(confounds)), np.arange(len(confounds))]).T
+        confounds = confounds - t @ np.linalg.lstsq(t, confounds, rcond=None)[0]
+    if hp > 0:
+        confounds = functionnormalise(bptf(confounds, 0.5 * hp / tr))
+    return confounds
+
+
+def matlab_pinv(a, tol=1e-6):
+    u, s, vt = np.linalg.svd(a, full_matrices=False)
+    keep = s > tol
+    return vt[keep].T @ np.diag(1 / s[keep]) @ u[:, keep].T
+
+
+def fix_cleanup(cts, ica, noise, aggressive, confounds=None):
+    """cts: time x voxels. Returns the cleaned series with the voxel means added back."""
+    meancts = cts.mean(axis=0)
+    cts = cts - meancts
+    if confounds is not None:
+        cts = cts - confounds @ (matlab_pinv(confounds) @ cts)
+        ica = ica - confounds @ (matlab_pinv(confounds) @ ica)
+    remove = [n - 1 for n in noise]
+    if aggressive:
+        cts = cts - ica[:, remove] @ (matlab_pinv(ica[:, remove]) @ cts)
+    else:
+        beta = matlab_pinv(ica) @ cts
+        cts = cts - ica[:, remove] @ beta[remove]
+    return cts + meancts
+
+
+def inputs(seed=0):
+    rng = np.random.default_rng(seed)
+    mix = rng.normal(size=(NTIME, NCOMP))
+    mix = mix - mix.mean(axis=0)
+    par = np.cumsum(rng.normal(0, 0.02, (NTIME, 6)), axis=0)
+    nvox = int(np.prod(SHAPE))
+    volume = 1000 + mix @ rng.normal(0, 5, (NCOMP, nvox)) + par @ rng.normal(0, 20, (6, nvox)) \
+        + rng.normal(0, 1, (NTIME, nvox))
+    dense = 500 + mix @ rng.normal(0, 5, (NCOMP, NGRAY)) + rng.normal(0, 1, (NTIME, NGRAY))
+    # stored as float32, as read from the NIfTI/CIFTI files
+    return mix, par, volume.astype(np.float32), dense.astype(np.float32)
+
+
+def main():
+    mix, par, volume, dense = inputs()
+    reference = {"mix": mix, "par": par, "volume": volume, "dense": dense, "noise": np.array(NOISE),
+                 "tr": TR, "highpass": HIGHPASS, "shape": np.array(SHAPE)}
+    confounds = functionmotionconfounds(par, TR, HIGHPASS)
+    for aggressive in (False, True):
+        for motion in (False, True):
+            name = ("aggressive" if aggressive else "soft") + ("_motion" if motion else "")
+            conf = confounds if motion else None
+            for key, data in (("volume", volume), ("dense", dense)):
+                clean = fix_cleanup(data.astype(np.float64), mix, NOISE, aggressive, conf)
+                reference[key + "_" + name] = clean.astype(np.float32)
+    np.savez_compressed(OUT_FILE, **reference)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+import os.path as op
+import stat
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+import pytest
+
+from utils import archive
+
+FILES = {
+    "sub-01/task/Movement_Regressors.txt": b"0.1 0.2 0.3\n" * 500,
+    "sub-01/task/bold.nii.gz": os.urandom(4096),
+    "sub-01/task/bold_Atlas.dtseries.nii": os.urandom(2048),
+    "sub-01/task/bold_hp2000.ica/fix4melview_HCP_thr10.txt": b"filtered_func_data.ica\n1, Signal, False\n",
+    "sub-01/task/bold_clean.nii.gz": os.urandom(512),
+}
+LINK = ("sub-01/task/bold_hp2000.ica/filtered_func_data.nii.gz", "../bold.nii.gz")
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / "tree"
+    for name, data in FILES.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    os.symlink(LINK[1], str(root / LINK[0]))
+    return str(root)
+
+
+def test_zip_results(tmp_path, tree):
+    zip_file = str(tmp_path / "results.zip")
+    names = sorted(FILES) + [LINK[0]]
+    stats = archive.zip_results(zip_file, tree, names)
+
+    assert stats["members"] == len(names)
+    assert stats["links"] == 1
+    with ZipFile(zip_file) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == names
+        for name, data in FILES.items():
+            assert zf.read(name) == data
+            expected = ZIP_STORED if name.endswith((".gz", ".dtseries.nii")) else ZIP_DEFLATED
+            assert zf.getinfo(name).compress_type == expected
+
+        # links are stored as links, as with zip --symlinks
+        link = zf.getinfo(LINK[0])
+        assert stat.S_ISLNK(link.external_attr >> 16)
+        assert zf.read(link) == LINK[1].encode()
+
+
+def test_extract_members(tmp_path, tree):
+    zip_file = str(tmp_path / "results.zip")
+    prefix = "64a1b2c3d4e5f6a7b8c9d0e1"
+    with ZipFile(zip_file, "w") as zf:
+        for name in FILES:
+            zf.write(op.join(tree, name), prefix + "/" + name)
+    archive.zip_results(str(tmp_path / "links.zip"), tree, [LINK[0]])
+    with ZipFile(str(tmp_path / "links.zip")) as src, ZipFile(zip_file, "a") as zf:
+        info = src.getinfo(LINK[0])
+        data = src.read(info)
+        info.filename = prefix + "/" + LINK[0]
+        zf.writestr(info, data)
+
+    outdir = str(tmp_path / "out")
+    extracted = archive.extract_members(zip_file, outdir, include=["*/task/*"], exclude=["*clean.*"],
+                                        strip_prefix=prefix, n_workers=2)
+
+    names = sorted(op.relpath(path, outdir) for path, _ in extracted)
+    assert names == sorted(n for n in list(FILES) + [LINK[0]] if "clean." not in n)
+    for name in names:
+        if name in FILES:
+            with open(op.join(outdir, name), "rb") as f:
+                assert f.read() == FILES[name]
+    assert os.readlink(op.join(outdir, LINK[0])) == LINK[1]
+    assert not op.exists(op.join(outdir, "sub-01/task/bold_clean.nii.gz"))
+
+
+def test_extract_skips_members_outside_directory(tmp_path):
+    zip_file = str(tmp_path / "evil.zip")
+    with ZipFile(zip_file, "w") as zf:
+        zf.writestr("../escape.txt", b"x")
+        zf.writestr("ok.txt", b"y")
+
+    extracted = archive.extract_members(zip_file, str(tmp_path / "out"))
+    assert [op.basename(path) for path, _ in extracted] == ["ok.txt"]
+    assert not op.exists(str(tmp_path / "escape.txt"))
+
+
+def test_extract_follows_links(tmp_path, tree):
+    zip_file = str(tmp_path / "results.zip")
+    archive.zip_results(zip_file, tree, sorted(FILES) + [LINK[0]])
+
+    outdir = str(tmp_path / "out")
+    include = ["*.ica/*"]
+    without = archive.extract_members(zip_file, outdir, include=include)
+    assert not op.exists(op.join(outdir, LINK[0]))
+    assert len(without) == 2
+
+    outdir = str(tmp_path / "followed")
+    extracted = archive.extract_members(zip_file, outdir, include=include, follow_links=True)
+    names = sorted(op.relpath(path, outdir) for path, _ in extracted)
+    assert names == sorted([LINK[0], "sub-01/task/bold.nii.gz", "sub-01/task/bold_hp2000.ica/fix4melview_HCP_thr10.txt"])
+    with open(op.join(outdir, LINK[0]), "rb") as f:
+        assert f.read() == FILES["sub-01/task/bold.nii.gz"]
+
+    # excluded targets stay excluded
+    outdir = str(tmp_path / "excluded")
+    archive.extract_members(zip_file, outdir, include=include, exclude=["*/bold.nii.gz"], follow_links=True)
+    assert not op.exists(op.join(outdir, "sub-01/task/bold.nii.gz"))
@@ -0,0 +1,15 @@
+import os.path as op
+import subprocess as sp
+import sys
+
+REPO_DIR = op.dirname(op.dirname(op.abspath(__file__)))
+
+
+def test_cleanup_benchmark_smoke():
+    # fix cleanup of a synthetic tree with dummy volumes, cleanup in-process (no FIX / MATLAB needed)
+    cmd = [sys.executable, op.join(REPO_DIR, "benchmarks", "pipeline.py"), "--no-record", "--mode", "fix-cleanup",
+           "--runs", "2", "--timepoints", "40", "--shape", "12", "12", "10", "--grayordinates", "500",
+           "--dummy-volumes", "2", "--config", "report-renderer=mip", "cleanup-engine=numpy"]
+    proc = sp.run(cmd, cwd=REPO_DIR, stdout=sp.PIPE, stderr=sp.STDOUT, universal_newlines=True)
+    assert proc.returncode == 0, proc.stdout
+    assert "run 1:" in proc.stdout and "(exit code 0)" in proc.stdout, proc.stdout
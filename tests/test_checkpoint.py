@@ -0,0 +1,103 @@
+import os
+import os.path as op
+
+from utils.checkpoint import TaskCheckpoints, checkpoint_file
+
+STAGES = [("trim", [2]), ("cleanup", ["HCP_hp2000", 10]), ("restitch", []), ("report", ["nilearn"])]
+
+
+def write(path, text):
+    with open(path, "w") as f:
+        f.write(text)
+    return str(path)
+
+
+TMP_FILES = ["tmpa1b2", "tmpa1b2_bold.nii.gz"]
+
+
+def run_until_restitch(taskdir, stages=STAGES, fingerprint="inputs"):
+    ckpt = TaskCheckpoints(str(taskdir), stages, fingerprint)
+    series = write(taskdir / "bold_hp2000.nii.gz", "trimmed")
+    ckpt.complete("trim", [series, write(taskdir / TMP_FILES[0], ""), write(taskdir / TMP_FILES[1], "dummy")],
+                  result=str(taskdir / TMP_FILES[1]))
+    ckpt.complete("cleanup", [write(taskdir / "bold_hp2000_clean.nii.gz", "clean"),
+                              write(taskdir / "task_icafix.log", "log")], result=["fix", "-a"])
+    return ckpt
+
+
+def run_stages(taskdir, stages=STAGES, fingerprint="inputs"):
+    """Complete every stage as the gear does: trim and restitch rewrite the series in place, trim keeps
+    the dummy frames in tmp files which restitch removes."""
+    ckpt = run_until_restitch(taskdir, stages, fingerprint)
+    series = str(taskdir / "bold_hp2000.nii.gz")
+    for name in TMP_FILES:
+        os.remove(str(taskdir / name))
+    ckpt.complete("restitch", [write(series, "restitched"), write(taskdir / "bold_hp2000_clean.nii.gz", "full")])
+    ckpt.complete("report", [write(taskdir / "report.html", "<html>")], result="reportdir")
+    return ckpt
+
+
+def test_resume_after_completed_stages(tmp_path):
+    run_stages(tmp_path)
+    assert op.exists(checkpoint_file(str(tmp_path)))
+
+    ckpt = TaskCheckpoints(str(tmp_path), STAGES, "inputs")
+    assert ckpt.resume_index == 4
+    assert all(ckpt.completed(name) for name, _ in STAGES)
+    # outputs rewritten by a later stage are checked against the later marker, ignored files not at all
+    assert ckpt.result("trim") == str(tmp_path / TMP_FILES[1])
+    assert ckpt.result("cleanup") == ["fix", "-a"]
+    write(tmp_path / "task_icafix.log", "another run")
+    assert TaskCheckpoints(str(tmp_path), STAGES, "inputs").resume_index == 4
+
+
+def test_changed_output_of_earlier_stage(tmp_path):
+    run_stages(tmp_path)
+    write(tmp_path / "report.html", "<html></html>")
+    assert TaskCheckpoints(str(tmp_path), STAGES, "inputs").resume_index == 3
+
+    # the series (written by trim and restitch) no longer matches any stage
+    write(tmp_path / "bold_hp2000.nii.gz", "edited")
+    assert TaskCheckpoints(str(tmp_path), STAGES, "inputs").resume_index == 0
+
+
+def test_options_and_inputs_invalidate_later_stages(tmp_path):
+    run_stages(tmp_path)
+    stages = list(STAGES)
+    stages[3] = ("report", ["mip"])
+    assert TaskCheckpoints(str(tmp_path), stages, "inputs").resume_index == 3
+    # the directory no longer holds the trimmed series the new cleanup would need
+    stages[1] = ("cleanup", ["HCP_hp2000", 20])
+    assert TaskCheckpoints(str(tmp_path), stages, "inputs").resume_index == 0
+    assert TaskCheckpoints(str(tmp_path), STAGES, "other inputs").resume_index == 0
+
+
+def test_missing_marker_of_earlier_stage(tmp_path):
+    ckpt = run_stages(tmp_path)
+    ckpt.markers.pop("trim")
+    ckpt._save()
+    assert TaskCheckpoints(str(tmp_path), STAGES, "inputs").resume_index == 0
+
+
+def test_rerun_stage_drops_later_markers(tmp_path):
+    ckpt = run_stages(tmp_path)
+    ckpt.complete("cleanup", [write(tmp_path / "bold_hp2000_clean.nii.gz", "clean again")])
+    assert sorted(ckpt.markers) == ["cleanup", "trim"]
+    # trim output was restitched since, so trim no longer describes the directory
+    assert TaskCheckpoints(str(tmp_path), STAGES, "inputs").resume_index == 0
+
+
+def test_files_removed_by_later_stages(tmp_path):
+    ckpt = run_stages(tmp_path)
+    # the tmp files written by trim were removed by restitch, which does not invalidate trim
+    assert ckpt.markers["restitch"]["removed"] == TMP_FILES
+    assert TaskCheckpoints(str(tmp_path), STAGES, "inputs").resume_index == 4
+
+
+def test_deleted_trim_output_before_resume(tmp_path):
+    # interrupted after cleanup: restitch needs the dummy frames kept by trim
+    run_until_restitch(tmp_path)
+    assert TaskCheckpoints(str(tmp_path), STAGES, "inputs").resume_index == 2
+
+    os.remove(str(tmp_path / TMP_FILES[1]))
+    assert TaskCheckpoints(str(tmp_path), STAGES, "inputs").resume_index == 0
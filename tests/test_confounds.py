@@ -0,0 +1,77 @@
+import os.path as op
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import confounds
+
+
+def write_motion(path, nframes=5):
+    # translations (mm), rotations (degrees), then backward differences
+    params = np.zeros((nframes, 6))
+    params[:, 0] = np.arange(nframes) * 0.1
+    params[:, 3] = np.arange(nframes) * 0.5
+    diffs = np.vstack([np.zeros((1, 6)), np.diff(params, axis=0)])
+    np.savetxt(str(path), np.hstack([params, diffs]), fmt="%.6f")
+    return str(path)
+
+
+def test_read_motion(tmp_path):
+    motion = confounds.read_motion(write_motion(tmp_path / "Movement_Regressors.txt"))
+    assert motion.shape == (5, 12)
+    np.testing.assert_allclose(confounds.to_radians(motion)[:, 3], np.deg2rad(motion[:, 3]))
+    np.testing.assert_allclose(confounds.to_radians(motion)[:, :3], motion[:, :3])
+
+    bad = tmp_path / "bad.txt"
+    np.savetxt(str(bad), np.zeros((3, 6)))
+    with pytest.raises(ValueError):
+        confounds.read_motion(str(bad))
+
+
+def test_friston24():
+    params = np.arange(12, dtype=float).reshape(4, 3)
+    expanded = confounds.friston24(params)
+    assert expanded.shape == (4, 12)
+    np.testing.assert_array_equal(expanded[0, 3:6], 0)
+    np.testing.assert_array_equal(expanded[1:, 3:6], 3)
+    np.testing.assert_array_equal(expanded[:, 6:], expanded[:, :6] ** 2)
+
+
+def test_framewise_displacement():
+    motion = np.zeros((3, 12))
+    motion[1, 0] = 0.2          # 0.2 mm translation
+    motion[2, 3] = 1.0          # 1 degree rotation: arc length on a 50 mm sphere
+    fd = confounds.framewise_displacement(motion)
+    assert np.isnan(fd[0])
+    np.testing.assert_allclose(fd[1:], [0.2, 0.2 + np.deg2rad(1.0) * 50])
+
+
+def test_write_confounds(tmp_path):
+    motion_file = write_motion(tmp_path / "Movement_Regressors.txt")
+    par_file, tsv_file = confounds.write_confounds(motion_file, expansion=True, fd=True)
+    assert par_file == op.join(str(tmp_path), "mc", "prefiltered_func_data_mcf.par")
+
+    par = np.loadtxt(par_file)
+    motion = confounds.read_motion(motion_file)
+    # mcflirt order: rotations (radians) then translations
+    np.testing.assert_allclose(par[:, :3], np.deg2rad(motion[:, 3:6]), atol=1e-6)
+    np.testing.assert_allclose(par[:, 3:], motion[:, :3], atol=1e-6)
+
+    table = pd.read_csv(tsv_file, sep="\t")
+    assert len(table.columns) == 12 + 12 + 1
+    assert list(table.columns[:6]) == confounds.MOTION_COLUMNS
+    assert "rot_x_derivative1_power2" in table.columns
+    assert table["framewise_displacement"].isna().tolist() == [True, False, False, False, False]
+
+
+def test_trim_motion_file(tmp_path):
+    motion_file = write_motion(tmp_path / "Movement_Regressors.txt")
+    with open(motion_file) as f:
+        rows = f.readlines()
+    confounds.trim_motion_file(motion_file, 2, str(tmp_path / "trimmed.txt"))
+    with open(str(tmp_path / "trimmed.txt")) as f:
+        assert f.readlines() == rows[2:]
+    confounds.trim_motion_file(motion_file, 1)
+    with open(motion_file) as f:
+        assert f.readlines() == rows[1:]
@@ -0,0 +1,150 @@
+import os
+import os.path as op
+import shutil
+import subprocess as sp
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils import denoise
+
+REFERENCE = op.join(op.dirname(op.abspath(__file__)), "data", "fix_cleanup_reference.npz")
+
+# absolute difference allowed between the cleaned series and the reference (intensities ~500-1000,
+# float32 outputs on both sides)
+TOLERANCE = 1e-3
+
+
+@pytest.fixture(scope="module")
+def reference():
+    with np.load(REFERENCE) as data:
+        return dict(data)
+
+
+def write_ica(icadir, ref):
+    """.ica directory with the inputs fix -a reads."""
+    os.makedirs(op.join(icadir, "filtered_func_data.ica"))
+    os.makedirs(op.join(icadir, "mc"))
+    shape = tuple(ref["shape"])
+    ntime = ref["volume"].shape[0]
+
+    img = nib.Nifti1Image(ref["volume"].T.reshape(shape + (ntime,)), np.eye(4))
+    img.header.set_zooms((2.0, 2.0, 2.0, float(ref["tr"])))
+    nib.save(img, op.join(icadir, "filtered_func_data.nii.gz"))
+
+    ngray = ref["dense"].shape[1]
+    series = nib.cifti2.SeriesAxis(start=0, step=float(ref["tr"]), size=ntime, unit="second")
+    brain_models = nib.cifti2.BrainModelAxis.from_surface(np.arange(ngray), ngray, "CortexLeft")
+    nib.save(nib.Cifti2Image(ref["dense"], header=(series, brain_models)), op.join(icadir, "Atlas.dtseries.nii"))
+
+    np.savetxt(op.join(icadir, "filtered_func_data.ica", "melodic_mix"), ref["mix"], fmt="%.17g")
+    np.savetxt(op.join(icadir, "mc", "prefiltered_func_data_mcf.par"), ref["par"], fmt="%.17g")
+    labels_file = op.join(icadir, "fix4melview_reference_thr10.txt")
+    with open(labels_file, "w") as f:
+        f.write("filtered_func_data.ica\n[" + ", ".join(str(n) for n in ref["noise"]) + "]\n")
+    return labels_file
+
+
+def read_outputs(icadir, ref):
+    ntime = ref["volume"].shape[0]
+    volume = nib.load(op.join(icadir, "filtered_func_data_clean.nii.gz")).get_fdata().reshape(-1, ntime).T
+    dense = nib.load(op.join(icadir, "Atlas_clean.dtseries.nii")).get_fdata()
+    return volume, dense
+
+
+@pytest.mark.parametrize("aggressive", [False, True], ids=["soft", "aggressive"])
+@pytest.mark.parametrize("motion", [False, True], ids=["", "motion"])
+def test_cleanup_matches_fix_reference(tmp_path, reference, aggressive, motion):
+    icadir = str(tmp_path / "bold_hp2000.ica")
+    labels_file = write_ica(icadir, reference)
+
+    outputs = denoise.apply_cleanup(labels_file, aggressive=aggressive, motion=motion,
+                                    highpass=float(reference["highpass"]))
+    assert [op.basename(f) for f in outputs] == ["filtered_func_data_clean.nii.gz", "Atlas_clean.dtseries.nii"]
+
+    name = ("aggressive" if aggressive else "soft") + ("_motion" if motion else "")
+    volume, dense = read_outputs(icadir, reference)
+    assert np.abs(volume - reference["volume_" + name]).max() < TOLERANCE
+    assert np.abs(dense - reference["dense_" + name]).max() < TOLERANCE
+    # the cleanup removes something: the reference is not the input
+    assert np.abs(reference["volume_" + name] - reference["volume"]).max() > 100 * TOLERANCE
+
+
+def test_motion_confounds_conventions(tmp_path, reference):
+    par_file = str(tmp_path / "prefiltered_func_data_mcf.par")
+    np.savetxt(par_file, reference["par"], fmt="%.17g")
+    tr, highpass = float(reference["tr"]), float(reference["highpass"])
+
+    conf = denoise.motion_confounds(par_file, tr, highpass)
+    assert conf.shape == (reference["par"].shape[0], 24)
+    # normalised after filtering (functionnormalise: zero mean, unit sample standard deviation)
+    np.testing.assert_allclose(conf.mean(axis=0), 0, atol=1e-10)
+    np.testing.assert_allclose(conf.std(axis=0, ddof=1), 1)
+
+    # -bptf kernel truncated to int(sigma * 3) frames: a constant and a line are removed exactly, and
+    # frames further apart than the truncated kernel do not influence each other
+    sigma = highpass / (2 * tr)
+    ntime = 4 * int(sigma * 3)
+    line = np.vstack([np.full(ntime, 3.0), np.linspace(-1, 1, ntime)]).T
+    np.testing.assert_allclose(denoise.highpass_filter(line, sigma), 0, atol=1e-10)
+    impulse = np.zeros((ntime, 1))
+    impulse[0] = 1
+    filtered = denoise.highpass_filter(impulse, sigma)
+    assert filtered[int(sigma * 3), 0] != 0
+    assert np.all(filtered[int(sigma * 3) + 1:, 0] == 0)
+
+    # hp 0 is a linear detrend, hp < 0 no filtering
+    detrended = denoise.motion_confounds(par_file, tr, 0)
+    np.testing.assert_allclose(np.polyfit(np.arange(len(detrended)), detrended, 1), 0, atol=1e-10)
+    unfiltered = denoise.motion_confounds(par_file, tr, -1)
+    np.testing.assert_allclose(unfiltered.std(axis=0, ddof=1), 1)
+
+
+def test_cleanup_keeps_voxel_means(reference):
+    # voxel time courses are demeaned before the regression and the mean added back, also for soft
+    # cleanup of all components
+    mix = reference["mix"]
+    remove = denoise.cleanup_matrix(mix, list(range(1, mix.shape[1] + 1)))
+    ts = reference["volume"].T
+    cleaned = denoise._clean_block(ts, remove, 1.0, 0.0)
+    np.testing.assert_allclose(cleaned.mean(axis=1), ts.mean(axis=1), rtol=1e-6)
+
+
+def test_cleanup_rejects_mismatched_ica(tmp_path, reference):
+    # ICA of a series trimmed by 2 dummy volumes, applied to the full series
+    icadir = str(tmp_path / "bold_hp2000.ica")
+    labels_file = write_ica(icadir, reference)
+    np.savetxt(op.join(icadir, "filtered_func_data.ica", "melodic_mix"), reference["mix"][2:], fmt="%.17g")
+
+    with pytest.raises(ValueError) as e:
+        denoise.apply_cleanup(labels_file, motion=True, highpass=float(reference["highpass"]))
+    message = str(e.value)
+    ntime = reference["volume"].shape[0]
+    assert "melodic_mix has %s" % (ntime - 2) in message
+    assert "filtered_func_data.nii.gz has %s" % ntime in message
+    assert "prefiltered_func_data_mcf.par has %s" % ntime in message
+    assert "AcqDummyVolumes" in message
+    assert not op.exists(op.join(icadir, "filtered_func_data_clean.nii.gz"))
+
+
+FIX = op.join(os.environ.get("FSL_FIXDIR", ""), "fix")
+
+
+@pytest.mark.skipif(not os.environ.get("FSL_FIXDIR") or not op.exists(FIX), reason="FIX is not installed")
+@pytest.mark.parametrize("aggressive", [False, True], ids=["soft", "aggressive"])
+@pytest.mark.parametrize("motion", [False, True], ids=["", "motion"])
+def test_cleanup_matches_fix(tmp_path, reference, aggressive, motion):
+    icadir = str(tmp_path / "bold_hp2000.ica")
+    labels_file = write_ica(icadir, reference)
+    cmd = [FIX, "-a", labels_file] + (["-m", "-h", str(reference["highpass"])] if motion else []) + \
+        (["-A"] if aggressive else [])
+    sp.run(cmd, check=True, cwd=icadir)
+    expected = read_outputs(icadir, reference)
+
+    ours = str(tmp_path / "ours.ica")
+    shutil.copytree(icadir, ours, ignore=shutil.ignore_patterns("*_clean*"))
+    denoise.apply_cleanup(op.join(ours, op.basename(labels_file)), aggressive=aggressive, motion=motion,
+                          highpass=float(reference["highpass"]))
+    for data, fix_data in zip(read_outputs(ours, reference), expected):
+        assert np.abs(data - fix_data).max() < TOLERANCE
@@ -0,0 +1,52 @@
+import os
+import os.path as op
+
+from utils.feature_cache import FeatureCache, feature_key
+
+
+def write(path, text):
+    os.makedirs(op.dirname(str(path)), exist_ok=True)
+    with open(str(path), "w") as f:
+        f.write(text)
+
+
+def make_ica(tmp_path):
+    icadir = tmp_path / "bold_hp2000.ica"
+    write(icadir / "filtered_func_data.ica" / "melodic_mix", "0.1 0.2\n")
+    write(icadir / "mc" / "prefiltered_func_data_mcf.par", "0 0 0 0 0 0\n")
+    write(tmp_path / "bold_hp2000.nii.gz", "series")
+    return str(icadir), str(tmp_path / "bold_hp2000.nii.gz")
+
+
+def test_key_ignores_outputs(tmp_path):
+    icadir, hpfile = make_ica(tmp_path)
+    key = feature_key(icadir, hpfile)
+
+    # fix, cleanup and report outputs written later in the same directory
+    write(op.join(icadir, "fix", "features.csv"), "1,2\n")
+    write(op.join(icadir, "fix4melview_HCP_hp2000_thr10.txt"), "1, Signal, False\n")
+    write(op.join(icadir, "figures", "IC_1.png"), "png")
+    write(op.join(icadir, "components", "IC_1.png"), "png")
+    write(op.join(icadir, "report_figures.json"), "{}")
+    assert feature_key(icadir, hpfile) == key
+
+    write(op.join(icadir, "filtered_func_data.ica", "melodic_mix"), "0.3 0.2\n")
+    assert feature_key(icadir, hpfile) != key
+    assert feature_key(icadir, hpfile, extra=[2]) != feature_key(icadir, hpfile, extra=[0])
+
+
+def test_store_restore_evict(tmp_path):
+    icadir, hpfile = make_ica(tmp_path)
+    write(op.join(icadir, "fix", "features.csv"), "x" * 100)
+    cache = FeatureCache(str(tmp_path / "cache"), max_bytes=150)
+
+    cache.store("a", icadir)
+    os.remove(op.join(icadir, "fix", "features.csv"))
+    assert cache.restore("a", icadir)
+    assert open(op.join(icadir, "fix", "features.csv")).read() == "x" * 100
+    assert not cache.restore("b", icadir)
+
+    # a second entry exceeds the limit: the least recently used one is evicted
+    os.utime(str(tmp_path / "cache" / "a"), (0, 0))
+    cache.store("b", icadir)
+    assert sorted(os.listdir(str(tmp_path / "cache"))) == ["b"]
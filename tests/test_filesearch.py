@@ -0,0 +1,71 @@
+import os
+import os.path as op
+import time
+
+from fw_gear_icafix import main
+from utils import filesearch
+
+
+def touch(path, mtime=None):
+    os.makedirs(op.dirname(path), exist_ok=True)
+    with open(path, "w"):
+        pass
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_search_patterns(tmp_path):
+    root = str(tmp_path)
+    old = touch(op.join(root, "Results/task-rest/task-rest_hp2000.ica/fix4melview_A_thr10.txt"), 1000)
+    new = touch(op.join(root, "Results/task-rest/task-rest_hp2000.ica/fix4melview_B_thr10.txt"), 2000)
+    touch(op.join(root, "Results/task-motor/.hidden"))
+    os.makedirs(op.join(root, "Results/rfMRI"))
+
+    assert filesearch.search(op.join(root, "Results/*task*")) == [op.join(root, "Results/task-motor"),
+                                                                 op.join(root, "Results/task-rest")]
+    assert filesearch.search(op.join(root, "Results/*/*hp*.ica/fix4melview*.txt")) == [old, new]
+    assert filesearch.search(op.join(root, "Results/*/*.ica/fix4melview*"), sort="mtime") == [new, old]
+    assert filesearch.find_first(op.join(root, "Results/*/*.ica/fix4melview*")) == old
+    assert filesearch.find_recent(op.join(root, "Results/*/*.ica/fix4melview*")) == new
+    # hidden files only match patterns starting with a dot, as in the shell
+    assert filesearch.search(op.join(root, "Results/task-motor/*")) == []
+    assert filesearch.search(op.join(root, "Results/task-motor/.*")) == [op.join(root, "Results/task-motor/.hidden")]
+    assert filesearch.search(op.join(root, "Missing/*")) == []
+    assert filesearch.find_first(op.join(root, "Missing/*")) is None
+
+    # compatibility wrapper
+    assert filesearch.searchfiles(op.join(root, "Results/*/*.ica/fix4melview*"), find_recent=True) == new
+    assert filesearch.searchfiles(op.join(root, "Results/*/*.ica/fix4melview*"), dryrun=True) is None
+
+
+def test_cached_listings_follow_changes(tmp_path):
+    directory = str(tmp_path / "task")
+    os.makedirs(directory)
+    assert filesearch.search(op.join(directory, "*_clean.nii.gz")) == []
+
+    # a new file changes the directory mtime, which revalidates the cached listing
+    time.sleep(0.01)
+    clean = touch(op.join(directory, "bold_clean.nii.gz"))
+    assert filesearch.search(op.join(directory, "*_clean.nii.gz")) == [clean]
+
+    # a change within the same mtime tick is only seen after invalidate
+    stat = os.stat(directory)
+    other = touch(op.join(directory, "bold_hp2000_clean.nii.gz"))
+    os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert filesearch.search(op.join(directory, "*_clean.nii.gz")) == [clean]
+    filesearch.invalidate(str(tmp_path))
+    assert filesearch.search(op.join(directory, "*_clean.nii.gz")) == [clean, other]
+
+
+def test_external_commands_invalidate_listings(tmp_path):
+    directory = str(tmp_path / "task.ica")
+    os.makedirs(directory)
+    assert filesearch.search(op.join(directory, "filtered_func_data.nii.gz")) == []
+
+    # a link made by a command within the mtime tick of the cached listing
+    stat = os.stat(directory)
+    main.execute_shell("ln -s ../bold_hp2000.nii.gz filtered_func_data.nii.gz", cwd=directory)
+    os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert filesearch.search(op.join(directory, "filtered_func_data.nii.gz")) == \
+        [op.join(directory, "filtered_func_data.nii.gz")]
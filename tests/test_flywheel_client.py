@@ -0,0 +1,73 @@
+import multiprocessing
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from utils.flywheel_client import FlywheelClient
+
+ACQUISITIONS = ["func-bold_task-rest_run-1", "func-bold_task-rest_run-2", "anat-T1w"]
+
+
+class SlowClient:
+    """SDK stand-in: every call takes a while, so prefetched requests are still running when shutdown starts."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def _call(self, name, value):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls[name] += 1
+        return value
+
+    def get(self, container_id):
+        return self._call("get", SimpleNamespace(id=container_id, parents={"subject": "sub", "session": "ses"}))
+
+    def get_container(self, container_id):
+        acqs = [SimpleNamespace(id=label, label=label) for label in ACQUISITIONS]
+        return self._call("get_container", SimpleNamespace(
+            id=container_id, acquisitions=SimpleNamespace(find=lambda *filters: acqs)))
+
+    get_session = get_container
+
+    def get_acquisition(self, container_id):
+        return self._call("get_acquisition", SimpleNamespace(id=container_id, files=[]))
+
+
+def _cached_lookups(client, queue):
+    client.get_acquisition(ACQUISITIONS[0])
+    client.get_session("ses")
+    queue.put(dict(client.client.calls))
+
+
+def test_shutdown_waits_for_prefetch():
+    sdk = SlowClient()
+    client = FlywheelClient(sdk)
+    client.prefetch("dest", acquisition_filter=lambda label: "func-bold" in label)
+    client.shutdown()
+
+    assert client._executor is None
+    assert sdk.calls == {"get": 1, "get_container": 2, "get_acquisition": 2}
+    assert all(future.done() for future in client._cache.values())
+
+    # a forked child finds everything in the inherited cache
+    queue = multiprocessing.get_context("fork").Queue()
+    child = multiprocessing.get_context("fork").Process(target=_cached_lookups, args=(client, queue))
+    child.start()
+    assert queue.get(timeout=10) == dict(sdk.calls)
+    child.join(10)
+    assert child.exitcode == 0
+
+    # the pool is started again on demand
+    client.get_acquisition(ACQUISITIONS[2])
+    client.flush()
+    assert sdk.calls["get_acquisition"] == 3
+
+
+def test_shutdown_without_requests():
+    client = FlywheelClient(SlowClient())
+    client.shutdown()
+    assert client._executor is None
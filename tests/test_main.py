@@ -0,0 +1,79 @@
+import logging
+import os
+from types import SimpleNamespace
+
+import pandas as pd
+
+from fw_gear_icafix import main
+from utils.flywheel_client import FlywheelClient
+from utils.manifest import FileManifest
+from utils.scheduler import GB, TaskEstimate
+
+TASKS = ["ses-01_task-rest_run-1_bold", "ses-01_task-rest_run-2_bold", "ses-01_task-motor_bold"]
+FAILING = TASKS[1]
+
+
+def gear_args(tmp_path):
+    taskdirs = []
+    for task in TASKS:
+        taskdir = tmp_path / "Results" / task
+        taskdir.mkdir(parents=True)
+        taskdirs.append(str(taskdir))
+    files = pd.DataFrame({"taskdir": taskdirs, "preprocessed_files": [d + "/bold.nii.gz" for d in taskdirs],
+                          "motion_files": "", "surface_files": ""})
+    return SimpleNamespace(files=files, manifest=FileManifest(str(tmp_path)), client=FlywheelClient(object()),
+                           config={"slurm-cpu": 2, "slurm-ram": "1G", "dry-run": False}, mode="fix cleanup",
+                           errors=[])
+
+
+def fake_run_task(row, args):
+    task = os.path.basename(row["taskdir"])
+    logging.getLogger("fw_gear_icafix.main").info("running %s", task)
+    if task == FAILING:
+        raise RuntimeError("melodic_mix not found")
+    with args.manifest.stage(task, "cleanup", row["taskdir"]):
+        with open(os.path.join(row["taskdir"], "clean.txt"), "w") as f:
+            f.write(task)
+    args.client.queue_info_update("acq-" + task, "bold.nii.gz", {"ICAFIX": {"done": True}})
+    args.errors.append({"message": "fix reported an error", "exception": task})
+
+
+def test_failing_task_does_not_stop_the_others(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(main, "run_task", fake_run_task)
+    args = gear_args(tmp_path)
+    estimates = [TaskEstimate(i, task, 1000, 0, 100, GB // 4, 0) for i, task in enumerate(TASKS)]
+
+    with caplog.at_level(logging.INFO):
+        failed = main.run_tasks_parallel(args, estimates, 2)
+
+    assert failed == [args.files.taskdir[1]]
+    for taskdir in args.files.taskdir:
+        task = os.path.basename(taskdir)
+        with open(main.task_log_file(taskdir)) as f:
+            text = f.read()
+        assert text.startswith("[") and "running " + task in text
+        if task == FAILING:
+            assert "RuntimeError: melodic_mix not found" in text
+        else:
+            assert os.path.exists(os.path.join(taskdir, "clean.txt"))
+            # the worker's records are merged into the parent
+            assert args.manifest.stages[(task, "cleanup")] == [os.path.relpath(os.path.join(taskdir, "clean.txt"),
+                                                                              str(tmp_path))]
+
+    assert sorted(u[0] for u in args.client.take_updates()) == sorted("acq-" + t for t in TASKS if t != FAILING)
+    # errors reported in the workers are collected too
+    assert sorted(e["exception"] for e in args.errors) == sorted(t for t in TASKS if t != FAILING)
+    assert "Task %s failed" % FAILING in caplog.text
+    assert main._worker_args is None
+
+
+def test_task_pool_and_memory_budget(monkeypatch):
+    monkeypatch.setattr(main.os, "sched_getaffinity", lambda pid: {0, 1, 2, 3})
+    args = SimpleNamespace(config={"slurm-cpu": 8, "slurm-ram": "2G"})
+    # the pool is sized by cpu only, memory is handled by admission
+    assert main.task_pool_size(args, 10) == 4
+    assert main.task_pool_size(args, 3) == 3
+    assert main.memory_budget(args) <= 16 * GB
+    assert main.parse_memory("500M") == 500 * 1024 ** 2
+    assert main.parse_memory("12g") == 12 * GB
+    assert main.parse_memory("2048") == 2 * GB
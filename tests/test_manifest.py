@@ -0,0 +1,74 @@
+import os
+import os.path as op
+import time
+from zipfile import ZipFile, ZipInfo
+
+from utils.archive import extract_members
+from utils.manifest import FileManifest, file_crc, scan
+
+
+def extracted_manifest(tmp_path):
+    zip_file = str(tmp_path / "inputs.zip")
+    with ZipFile(zip_file, "w") as zf:
+        zf.writestr("task/bold.nii.gz", b"a" * 100)
+        zf.writestr("task/Movement_Regressors.txt", b"0 0 0\n")
+        zf.writestr("task/hp.ica/melodic_mix", b"1 2\n")
+        info = ZipInfo("task/hp.ica/filtered_func_data.nii.gz")
+        info.external_attr = 0o120777 << 16
+        zf.writestr(info, "../bold.nii.gz")
+
+    root = str(tmp_path / "work")
+    manifest = FileManifest(root)
+    manifest.add_inputs(extract_members(zip_file, root))
+    return manifest, root
+
+
+def rewrite(path, data):
+    # make sure the modification time differs from the extraction
+    time.sleep(0.01)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_outputs_are_new_and_changed_files(tmp_path):
+    manifest, root = extracted_manifest(tmp_path)
+    assert sorted(manifest.inputs) == ["task/Movement_Regressors.txt", "task/bold.nii.gz",
+                                       "task/hp.ica/filtered_func_data.nii.gz", "task/hp.ica/melodic_mix"]
+    assert manifest.input_crc(op.join(root, "task/bold.nii.gz")) == file_crc(op.join(root, "task/bold.nii.gz"))
+
+    rewrite(op.join(root, "task/bold.nii.gz"), b"b" * 100)             # same size, new content
+    rewrite(op.join(root, "task/Movement_Regressors.txt"), b"0 0 0\n")   # rewritten, same content
+    os.remove(op.join(root, "task/hp.ica/filtered_func_data.nii.gz"))
+    os.symlink("../bold_clean.nii.gz", op.join(root, "task/hp.ica/filtered_func_data.nii.gz"))
+    rewrite(op.join(root, "task/bold_clean.nii.gz"), b"c")
+    rewrite(op.join(root, "task/tmp_file"), b"t")
+
+    outputs = manifest.outputs(exclude=lambda name: name.startswith("tmp"))
+    assert sorted(outputs) == ["task/bold.nii.gz", "task/bold_clean.nii.gz", "task/hp.ica/filtered_func_data.nii.gz"]
+
+    manifest.discard(op.join(root, "task/bold.nii.gz"))
+    assert "task/bold.nii.gz" in manifest.outputs()
+    assert manifest.input_crc(op.join(root, "task/bold.nii.gz")) is None
+
+
+def test_stage_records_written_files(tmp_path):
+    manifest, root = extracted_manifest(tmp_path)
+    taskdir = op.join(root, "task")
+    with manifest.stage("task", "cleanup", taskdir):
+        rewrite(op.join(taskdir, "bold_clean.nii.gz"), b"c")
+        rewrite(op.join(taskdir, "bold.nii.gz"), b"a" * 50)
+    with manifest.stage("task", "report", taskdir):
+        pass
+
+    assert manifest.stages[("task", "cleanup")] == ["task/bold.nii.gz", "task/bold_clean.nii.gz"]
+    assert manifest.task_stages("task") == {("task", "cleanup"): ["task/bold.nii.gz", "task/bold_clean.nii.gz"],
+                                            ("task", "report"): []}
+    assert manifest.task_stages("other") == {}
+
+
+def test_scan_does_not_follow_directory_links(tmp_path):
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "a" / "b" / "f.txt").write_text("x")
+    os.symlink("a", str(tmp_path / "link"))
+    assert sorted(scan(str(tmp_path))) == ["a/b/f.txt", "link"]
+    assert scan(str(tmp_path / "missing")) == {}
@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+import pytest
+
+from fw_gear_icafix import main
+from fw_gear_icafix.metadata import AcquisitionIndex
+
+TASKDIR = "/work/HCPPipe/sub-01/ses-01/MNINonLinear/Results/ses-01_task-rest_run-01_bold"
+
+
+class FakeClient:
+    """The session scan calls used by AcquisitionIndex."""
+
+    def __init__(self, acquisitions):
+        self.acquisitions = {acq.id: acq for acq in acquisitions}
+
+    def find_acquisitions(self, session_id):
+        return list(self.acquisitions.values())
+
+    def get_acquisition(self, acq_id):
+        return self.acquisitions[acq_id]
+
+
+def acquisition(acq_id, label, bids_filename, iqm):
+    f = SimpleNamespace(name=bids_filename, info={"BIDS": {"Filename": bids_filename}, "IQM": iqm})
+    return SimpleNamespace(id=acq_id, label=label, files=[f])
+
+
+def context(acquisitions, **config):
+    index = AcquisitionIndex(FakeClient(acquisitions), "session").build()
+    return SimpleNamespace(config=dict(DropNonSteadyState=True, **config), acquisition_index=index)
+
+
+REST = acquisition("a1", "func-bold_task-rest_run-01", "sub-01_ses-01_task-rest_run-01_bold.nii.gz",
+                   {"dummy_trs": 3})
+MOTOR = acquisition("a2", "func-bold_task-motor", "sub-01_ses-01_task-motor_bold.nii.gz",
+                    {"dummy_trs": 2, "dummy_trs_custom": 4})
+SBREF = acquisition("a3", "func-bold_task-rest_run-01_sbref", "sub-01_ses-01_task-rest_run-01_sbref.nii.gz", {})
+
+
+def test_lookup():
+    index = AcquisitionIndex(FakeClient([REST, MOTOR, SBREF]), "session").build()
+    assert sorted(index.entries) == ["task-motor", "task-rest_run-01"]
+    acq, f = index.lookup("task-rest_run-01")
+    assert acq is REST and f is REST.files[0]
+    assert index.lookup("task-nback") == (None, None)
+
+
+def test_dummy_volumes_from_mriqc():
+    assert main.fetch_dummy_volumes(TASKDIR + "/ses-01_task-rest_run-01_bold.nii.gz", context([REST, MOTOR])) == 3
+    motor = TASKDIR.replace("rest_run-01", "motor") + "/ses-01_task-motor_bold.nii.gz"
+    assert main.fetch_dummy_volumes(motor, context([REST, MOTOR])) == 4
+
+
+def test_dummy_volumes_without_matching_acquisition():
+    with pytest.raises(ValueError) as e:
+        main.fetch_dummy_volumes(TASKDIR + "/ses-01_task-rest_run-01_bold.nii.gz", context([MOTOR]))
+    assert "task-rest_run-01" in str(e.value) and "DummyVolumes" in str(e.value)
+
+    # the configured value does not need the acquisition
+    ctx = context([MOTOR], DummyVolumes=5)
+    assert main.fetch_dummy_volumes(TASKDIR + "/ses-01_task-rest_run-01_bold.nii.gz", ctx) == 5
+    ctx.config["DropNonSteadyState"] = False
+    assert main.fetch_dummy_volumes(TASKDIR + "/ses-01_task-rest_run-01_bold.nii.gz", ctx) == 0
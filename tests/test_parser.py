@@ -0,0 +1,87 @@
+import os
+import os.path as op
+from zipfile import ZipFile, ZipInfo
+
+from fw_gear_icafix import parser
+from utils.archive import extract_members
+
+PREFIX = "64a1b2c3d4e5f6a7b8c9d0e1"
+SESSION = "HCPPipe/sub-01/ses-01"
+TASKDIR = SESSION + "/MNINonLinear/Results/ses-01_task-rest_bold"
+TASK = "ses-01_task-rest_bold"
+
+FILES = [
+    SESSION + "/MNINonLinear/T1w_restore.nii.gz",
+    SESSION + "/MNINonLinear/T1w_restore_brain.nii.gz",
+    SESSION + "/T1w/aparc+aseg.nii.gz",
+    SESSION + "/MNINonLinear/fsaverage_LR32k/sub-01.L.midthickness.32k_fs_LR.surf.gii",
+    TASKDIR + "/" + TASK + ".nii.gz",
+    TASKDIR + "/" + TASK + "_SBRef.nii.gz",
+    TASKDIR + "/" + TASK + "_Atlas.dtseries.nii",
+    TASKDIR + "/" + TASK + "_hp2000.nii.gz",
+    TASKDIR + "/" + TASK + "_Atlas_hp2000.dtseries.nii",
+    TASKDIR + "/Movement_Regressors.txt",
+    TASKDIR + "/" + TASK + "_hp2000.ica/filtered_func_data.ica/melodic_mix",
+    TASKDIR + "/" + TASK + "_hp2000.ica/fix4melview_HCP_hp2000_thr10.txt",
+]
+LINKS = {
+    TASKDIR + "/" + TASK + "_hp2000.ica/filtered_func_data.nii.gz": "../" + TASK + "_hp2000.nii.gz",
+    TASKDIR + "/" + TASK + "_hp2000.ica/Atlas.dtseries.nii": "../" + TASK + "_Atlas_hp2000.dtseries.nii",
+}
+# not needed to clean up previous results
+UNUSED = [
+    SESSION + "/MNINonLinear/xfms/acpc_dc2standard.nii.gz",
+    SESSION + "/T1w/T1w.nii.gz",
+    TASKDIR + "/" + TASK + "_hp2000_clean.nii.gz",
+    TASKDIR + "/" + TASK + "_Atlas_hp2000_clean.dtseries.nii",
+]
+
+
+def write_results(zip_filename):
+    with ZipFile(zip_filename, "w") as zf:
+        for name in FILES + UNUSED:
+            zf.writestr(PREFIX + "/" + name, name.encode())
+        for name, target in LINKS.items():
+            info = ZipInfo(PREFIX + "/" + name)
+            info.external_attr = 0o120777 << 16
+            zf.writestr(info, target)
+
+
+def test_cleanup_extracts_linked_files(tmp_path):
+    zip_filename = str(tmp_path / "results.zip")
+    write_results(zip_filename)
+    outdir = str(tmp_path / "analysis")
+
+    extracted = extract_members(zip_filename, outdir, include=parser.extract_patterns("fix cleanup"),
+                                exclude=parser.EXTRACT_EXCLUDE["fix cleanup"], strip_prefix=PREFIX,
+                                follow_links=True)
+
+    names = sorted(op.relpath(path, outdir) for path, _ in extracted)
+    assert names == sorted(FILES + list(LINKS))
+    # the links hcp_fix made in the .ica directory resolve, so the CIFTI series is cleaned up too
+    for name in LINKS:
+        assert op.isfile(op.join(outdir, name))
+
+
+def test_extract_patterns_cover_file_mapper_sources():
+    assert parser.extract_patterns("hcpfix") is None
+    patterns = parser.extract_patterns("hand labeled")
+    assert patterns[:len(parser.CLEANUP_PATTERNS)] == parser.CLEANUP_PATTERNS
+    assert SESSION.replace("sub-01", "sub-*").replace("ses-01", "ses-*") + "/MNINonLinear/T1w_restore.nii.gz" \
+        in patterns
+    assert len(patterns) == len(set(patterns))
+
+
+def test_cleanup_task_table_includes_hp_cifti(tmp_path):
+    taskdir = str(tmp_path / TASK)
+    hpfile = op.join(taskdir, TASK + "_hp2000.nii.gz")
+    atlas = op.join(taskdir, TASK + "_Atlas_hp2000.dtseries.nii")
+    roles = {"preprocessed_files": "{task}_hp2000.nii.gz"}
+    optional = {"surface_files": "{task}_Atlas_hp2000.dtseries.nii"}
+
+    table = parser.build_task_table([hpfile, atlas], [taskdir], roles, optional)
+    assert table.loc[0, "preprocessed_files"] == hpfile
+    assert table.loc[0, "surface_files"] == atlas
+    # volume only results: the CIFTI series is not required
+    table = parser.build_task_table([hpfile], [taskdir], roles, optional)
+    assert table.loc[0, "surface_files"] is None
@@ -0,0 +1,33 @@
+import os
+import os.path as op
+import sys
+from zipfile import ZipFile
+
+from utils.archive import zip_results
+from utils.manifest import FileManifest
+from utils.report.report import report
+
+sys.path.insert(0, op.join(op.dirname(op.dirname(op.abspath(__file__))), "benchmarks"))
+import synthetic_hcp  # noqa: E402
+
+
+def test_sprite_report_archives_sheets_only(tmp_path):
+    taskdir = str(tmp_path / "task-rest_bold")
+    hpfile = op.join(taskdir, "task-rest_bold_hp2000.nii.gz")
+    os.makedirs(taskdir)
+    synthetic_hcp.write_series(hpfile, (8, 8, 6), 20)
+    icadir = hpfile.replace(".nii.gz", ".ica")
+    synthetic_hcp.write_ica(icadir, hpfile, 5)
+    synthetic_hcp.write_labels(icadir, "HCP_hp2000.RData", 10)
+    manifest = FileManifest(str(tmp_path))
+
+    report(taskdir, ["fix", "-a"], renderer="mip", sprite_size=2, clean_file=hpfile)
+
+    zip_file = str(tmp_path / "results.zip")
+    zip_results(zip_file, str(tmp_path), manifest.outputs())
+    with ZipFile(zip_file) as zf:
+        names = zf.namelist()
+    ica = "task-rest_bold/task-rest_bold_hp2000.ica/"
+    assert sorted(n for n in names if n.startswith(ica + "figures/components_")) == \
+        [ica + "figures/components_%02d.png" % n for n in range(3)]
+    assert not [n for n in names if "/components/" in n]
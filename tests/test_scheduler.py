@@ -0,0 +1,51 @@
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+from utils import scheduler
+from utils.scheduler import GB, TaskEstimate
+
+
+def estimates(*memory):
+    return [TaskEstimate(i, "task%s" % i, 0, 0, 0, int(m * GB), 0) for i, m in enumerate(memory)]
+
+
+def test_admission_order_largest_first():
+    tasks = estimates(2, 8, 4, 8)
+    assert scheduler.admission_order(tasks) == [1, 3, 2, 0]
+
+
+def test_admit_within_budget_and_slots():
+    tasks = estimates(2, 8, 4, 8)
+    order = scheduler.admission_order(tasks)
+    # smaller tasks fill the budget left by larger ones
+    assert scheduler.admit(order, tasks, 13 * GB, 4, True) == [1, 2]
+    assert scheduler.admit(order, tasks, 20 * GB, 2, True) == [1, 3]
+    assert scheduler.admit(order, tasks, 1 * GB, 4, False) == []
+    # a task larger than the whole budget runs alone once nothing else runs
+    assert scheduler.admit(order, tasks, 1 * GB, 4, True) == [1]
+    assert scheduler.admit(order, tasks, 100 * GB, 0, True) == []
+
+
+def test_estimate_tasks(tmp_path):
+    taskdir = tmp_path / "ses-01_task-rest_bold"
+    taskdir.mkdir()
+    volume = str(taskdir / "ses-01_task-rest_bold_hp2000.nii.gz")
+    nib.save(nib.Nifti1Image(np.zeros((4, 5, 6, 10), dtype=np.float32), np.eye(4)), volume)
+    series = nib.cifti2.SeriesAxis(start=0, step=0.8, size=10)
+    brain_models = nib.cifti2.BrainModelAxis.from_surface(np.arange(30), 30, "CortexLeft")
+    nib.save(nib.Cifti2Image(np.zeros((10, 30), dtype=np.float32), header=(series, brain_models)),
+             str(taskdir / "ses-01_task-rest_bold_Atlas_hp2000.dtseries.nii"))
+    files = pd.DataFrame({"taskdir": [str(taskdir), str(tmp_path / "missing")],
+                          "preprocessed_files": [volume, str(tmp_path / "missing" / "bold.nii.gz")],
+                          "surface_files": ["", ""]})
+
+    hcpfix, missing = scheduler.estimate_tasks(files, "hcpfix")
+    assert (hcpfix.voxels, hcpfix.grayordinates, hcpfix.timepoints) == (120, 30, 10)
+    assert hcpfix.memory >= scheduler.MCR_BYTES and hcpfix.scratch > 0
+    assert (missing.voxels, missing.timepoints, missing.scratch) == (0, 0, 0)
+
+    # the numpy cleanup engine does not scale with the series, the MATLAB runtime does
+    numpy_engine = scheduler.estimate_tasks(files, "hand labeled", engine="numpy")[0]
+    assert numpy_engine.memory < scheduler.MCR_BYTES < hcpfix.memory
+    assert scheduler.series_size(None) == (0, 0, 0)
@@ -0,0 +1,138 @@
+import os
+import os.path as op
+import shutil
+import subprocess as sp
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils import timeseries
+
+TR = 0.8
+
+
+def write_volume(filename, shape=(4, 5, 3), ntime=12, dtype=np.float32, slope=None):
+    rng = np.random.default_rng(0)
+    data = (100 * rng.random(shape + (ntime,))).astype(dtype)
+    img = nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0]))
+    img.header.set_zooms((2.0, 2.0, 2.0, TR))
+    img.header.set_xyzt_units("mm", "sec")
+    img.header["descrip"] = b"synthetic"
+    if slope:
+        img.header.set_data_dtype(np.int16)
+        img.header.set_slope_inter(slope, 1.0)
+    nib.save(img, filename)
+    return np.asanyarray(nib.load(filename).dataobj)
+
+
+def write_dtseries(filename, ngray=50, ntime=12, start=3.2):
+    rng = np.random.default_rng(0)
+    brain_models = nib.cifti2.BrainModelAxis.from_surface(np.arange(ngray), ngray, "CortexLeft")
+    series = nib.cifti2.SeriesAxis(start=start, step=TR, size=ntime, unit="second")
+    data = (1000 + rng.normal(0, 10, (ntime, ngray))).astype(np.float32)
+    img = nib.Cifti2Image(data, header=(series, brain_models))
+    img.header.matrix.metadata = nib.cifti2.Cifti2MetaData({"Description": "synthetic"})
+    img.nifti_header.set_intent("ConnDenseSeries")
+    nib.save(img, filename)
+    return data
+
+
+@pytest.mark.parametrize("suffix", [".nii", ".nii.gz"])
+def test_volume_split_prepend_round_trip(tmp_path, suffix):
+    in_file = str(tmp_path / ("bold" + suffix))
+    dummy_file = str(tmp_path / ("dummy" + suffix))
+    original = write_volume(in_file)
+    original_header, original_affine = nib.load(in_file).header, nib.load(in_file).affine
+
+    timeseries.split_volume_frames(in_file, 3, dummy_file)
+    trimmed, dummy = nib.load(in_file), nib.load(dummy_file)
+    np.testing.assert_array_equal(trimmed.get_fdata(), original[..., 3:])
+    np.testing.assert_array_equal(dummy.get_fdata(), original[..., :3])
+    assert trimmed.shape == (4, 5, 3, 9)
+
+    # header of the input with dim[4] updated (what fslroi keeps: affine, zooms, units, data type)
+    for img in (trimmed, dummy):
+        np.testing.assert_array_equal(img.affine, original_affine)
+        assert img.header.get_zooms() == original_header.get_zooms()
+        assert img.header.get_xyzt_units() == ("mm", "sec")
+        assert img.get_data_dtype() == np.float32
+        assert img.header["descrip"] == original_header["descrip"]
+
+    timeseries.prepend_volume_frames(dummy_file, in_file)
+    restored = nib.load(in_file)
+    np.testing.assert_array_equal(restored.get_fdata(), original)
+    assert restored.header.get_zooms() == original_header.get_zooms()
+
+
+def test_volume_prepend_converts_scaling(tmp_path):
+    in_file = str(tmp_path / "clean.nii.gz")
+    frames_file = str(tmp_path / "frames.nii.gz")
+    write_volume(in_file, ntime=5, slope=0.5)
+    frames = write_volume(frames_file, ntime=2)
+
+    timeseries.prepend_volume_frames(frames_file, in_file)
+    img = nib.load(in_file)
+    assert img.get_data_dtype() == np.int16
+    # frames are stored in the data type and scaling of the extended file
+    np.testing.assert_allclose(img.get_fdata()[..., :2], frames, atol=0.5)
+
+
+def test_volume_split_rejects_all_frames(tmp_path):
+    in_file = str(tmp_path / "bold.nii.gz")
+    write_volume(in_file, ntime=4)
+    with pytest.raises(ValueError):
+        timeseries.split_volume_frames(in_file, 4, str(tmp_path / "dummy.nii.gz"))
+
+
+def test_cifti_split_prepend_round_trip(tmp_path):
+    in_file = str(tmp_path / "bold_Atlas.dtseries.nii")
+    dummy_file = str(tmp_path / "dummy.dtseries.nii")
+    original = write_dtseries(in_file)
+    original_img = nib.load(in_file)
+
+    timeseries.split_cifti_frames(in_file, 3, dummy_file)
+    trimmed, dummy = nib.load(in_file), nib.load(dummy_file)
+    np.testing.assert_array_equal(trimmed.get_fdata(), original[3:])
+    np.testing.assert_array_equal(dummy.get_fdata(), original[:3])
+
+    for img, ntime in ((trimmed, 9), (dummy, 3)):
+        series, brain_models = img.header.get_axis(0), img.header.get_axis(1)
+        # as wb_command -cifti-convert -from-nifti ... -reset-timepoints <step> 0
+        assert (series.size, series.start, series.step, series.unit) == (ntime, 0, TR, "SECOND")
+        assert brain_models == original_img.header.get_axis(1)
+        assert img.header.matrix.metadata["Description"] == "synthetic"
+        assert img.get_data_dtype() == np.float32
+        assert img.nifti_header.get_intent()[0] == "ConnDenseSeries"
+
+    timeseries.prepend_cifti_frames(dummy_file, in_file)
+    restored = nib.load(in_file)
+    np.testing.assert_array_equal(restored.get_fdata(), original)
+    assert restored.header.get_axis(0).size == 12
+
+
+def test_cifti_prepend_rejects_other_grayordinates(tmp_path):
+    in_file = str(tmp_path / "a.dtseries.nii")
+    frames_file = str(tmp_path / "b.dtseries.nii")
+    write_dtseries(in_file, ngray=50)
+    write_dtseries(frames_file, ngray=40, ntime=2)
+    with pytest.raises(ValueError):
+        timeseries.prepend_cifti_frames(frames_file, in_file)
+
+
+WB_COMMAND = os.environ.get("FSL_FIX_WBC") or shutil.which("wb_command")
+
+
+@pytest.mark.skipif(not WB_COMMAND or not op.exists(WB_COMMAND), reason="wb_command is not available")
+def test_cifti_split_matches_wb_command(tmp_path):
+    in_file = str(tmp_path / "bold_Atlas.dtseries.nii")
+    write_dtseries(in_file)
+    reference = str(tmp_path / "wb.dtseries.nii")
+    sp.run([WB_COMMAND, "-cifti-merge", reference, "-cifti", in_file, "-column", "4", "-up-to", "12"], check=True)
+
+    timeseries.split_cifti_frames(in_file, 3, str(tmp_path / "dummy.dtseries.nii"))
+    ours, wb = nib.load(in_file), nib.load(reference)
+    np.testing.assert_array_equal(ours.get_fdata(), wb.get_fdata())
+    assert ours.header.get_axis(1) == wb.header.get_axis(1)
+    assert (ours.header.get_axis(0).size, ours.header.get_axis(0).step) == \
+           (wb.header.get_axis(0).size, wb.header.get_axis(0).step)
@@ -0,0 +1,178 @@
+"""Read and write gear archives in-process.
+
+zip_results replaces `zip --symlinks -r outzip.zip -@ < files.txt`:
+  - symbolic links are stored as links (unix mode + link target), as with `zip --symlinks`
+  - already compressed payloads (.nii.gz, .dtseries.nii, images, archives) are stored without recompression
+  - every member is streamed from disk by zipfile (no member is held in memory)
+  - ZIP64 is used automatically for large members and archives
+
+extract_members replaces `unzip -o`, extracting only the members matching an include list.
+"""
+
+import logging
+import os
+import os.path as op
+import shutil
+import stat
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+log = logging.getLogger(__name__)
+
+# members that gain (almost) nothing from deflate
+STORED_SUFFIXES = (".gz", ".zip", ".dtseries.nii", ".dscalar.nii", ".dlabel.nii", ".ptseries.nii", ".surf.gii",
+                   ".func.gii", ".png", ".jpg", ".jpeg", ".webp", ".RData", ".Rdata")
+
+COMPRESS_LEVEL = 6
+
+
+def compression_for(name):
+    """Compression policy for an archive member."""
+    return ZIP_STORED if name.endswith(STORED_SUFFIXES) else ZIP_DEFLATED
+
+
+def zip_results(output_zipname, root_dir, files):
+    """
+    Write `files` (paths relative to root_dir) to output_zipname.
+    Args:
+        output_zipname (str): archive to create
+        root_dir (str): directory the member names are relative to
+        files (list): relative paths of files and symbolic links to archive
+    Returns:
+        dict: archive statistics (members, bytes in/out, seconds)
+    """
+    start = time.time()
+    stats = {"members": 0, "stored": 0, "deflated": 0, "links": 0, "bytes_in": 0}
+
+    log.info("Creating results archive %s (%s members)", op.basename(output_zipname), len(files))
+    with ZipFile(output_zipname, "w", ZIP_DEFLATED, allowZip64=True, compresslevel=COMPRESS_LEVEL) as zf:
+        for name in files:
+            _write_member(zf, name, op.join(root_dir, name), stats)
+
+    stats["bytes_out"] = op.getsize(output_zipname)
+    stats["seconds"] = time.time() - start
+    log.info("Archived %s members (%s stored, %s deflated, %s links): %.1f MB -> %.1f MB in %.1f s (%.1f MB/s)",
+             stats["members"], stats["stored"], stats["deflated"], stats["links"], stats["bytes_in"] / 1024 ** 2,
+             stats["bytes_out"] / 1024 ** 2, stats["seconds"],
+             stats["bytes_in"] / 1024 ** 2 / max(stats["seconds"], 1e-6))
+
+    return stats
+
+
+def _write_member(zf, name, path, stats):
+    stats["members"] += 1
+
+    if op.islink(path):
+        # store the link itself (like zip --symlinks)
+        zinfo = ZipInfo(name, time.localtime(os.lstat(path).st_mtime)[:6])
+        zinfo.create_system = 3
+        zinfo.external_attr = (stat.S_IFLNK | 0o777) << 16
+        zinfo.compress_type = ZIP_STORED
+        zf.writestr(zinfo, os.readlink(path))
+        stats["links"] += 1
+        return
+
+    compression = compression_for(name)
+    zf.write(path, name, compress_type=compression)
+    stats["stored" if compression == ZIP_STORED else "deflated"] += 1
+    stats["bytes_in"] += zf.getinfo(name).file_size
+
+
+def extract_members(zip_filename, outdir, include=None, exclude=None, strip_prefix=None, n_workers=1,
+                    follow_links=False):
+    """
+    Extract selected members of an archive, driven by its central directory.
+
+    Replaces `unzip -o`: regular files are decompressed in parallel threads (zlib releases the GIL),
+    symbolic links are restored as links and file modes and modification times are kept.
+    Args:
+        zip_filename (str): archive to extract
+        outdir (str): directory to extract into
+        include (list): fnmatch patterns (on the member name after strip_prefix) to extract, default all
+        exclude (list): fnmatch patterns to skip, applied after include
+        strip_prefix (str): leading directory removed from member names (e.g. a flywheel destination id)
+        n_workers (int): threads used to decompress members
+        follow_links (bool): also extract the members that selected symbolic links point to (unless
+            excluded), so e.g. the links hcp_fix creates in its .ica directory do not dangle
+    Returns:
+        list: (extracted path, ZipInfo) tuples
+    """
+    start = time.time()
+    outdir = op.abspath(outdir)
+
+    with ZipFile(zip_filename, "r") as zf:
+        names = OrderedDict()
+        for zinfo in zf.infolist():
+            name = zinfo.filename
+            if strip_prefix and (name == strip_prefix + "/" or name.startswith(strip_prefix + "/")):
+                name = name[len(strip_prefix) + 1:]
+            if name and not zinfo.is_dir():
+                names[name] = zinfo
+
+        def excluded(name):
+            return bool(exclude) and any(fnmatch(name, p) for p in exclude)
+
+        selected = [name for name in names
+                    if (include is None or any(fnmatch(name, p) for p in include)) and not excluded(name)]
+
+        # add the targets of selected links (and of links among the targets)
+        queue = list(selected) if follow_links else []
+        selected = set(selected)
+        while queue:
+            name = queue.pop()
+            zinfo = names[name]
+            if not stat.S_ISLNK(zinfo.external_attr >> 16):
+                continue
+            target = op.normpath(op.join(op.dirname(name), zf.read(zinfo).decode("utf-8")))
+            if target in names and target not in selected and not excluded(target):
+                selected.add(target)
+                queue.append(target)
+
+        members = []
+        for name, zinfo in names.items():
+            if name not in selected:
+                continue
+            path = op.normpath(op.join(outdir, name))
+            if not path.startswith(outdir + os.sep):
+                log.warning("Skipping archive member outside of the extraction directory: %s", zinfo.filename)
+                continue
+            members.append((zinfo, path))
+
+        log.info("Extracting %s of %s members from %s", len(members), len(zf.infolist()),
+                 op.basename(zip_filename))
+
+        for d in sorted({op.dirname(path) for _, path in members}):
+            os.makedirs(d, exist_ok=True)
+
+        # ZipFile serialises reads of the shared file handle, decompression runs concurrently
+        with ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+            nbytes = sum(pool.map(lambda m: _extract_member(zf, *m), members))
+
+    seconds = time.time() - start
+    log.info("Extracted %.1f MB in %.1f s (%.1f MB/s)", nbytes / 1024 ** 2, seconds,
+             nbytes / 1024 ** 2 / max(seconds, 1e-6))
+
+    return [(path, zinfo) for zinfo, path in members]
+
+
+def _extract_member(zf, zinfo, path):
+    mode = zinfo.external_attr >> 16
+    if op.lexists(path) and (stat.S_ISLNK(mode) or op.islink(path)):
+        os.unlink(path)
+
+    if stat.S_ISLNK(mode):
+        os.symlink(zf.read(zinfo).decode("utf-8"), path)
+        return 0
+
+    with zf.open(zinfo) as src, open(path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 16 * 1024 ** 2)
+
+    if mode & 0o777:
+        os.chmod(path, mode & 0o777)
+    mtime = time.mktime(zinfo.date_time + (0, 0, -1))
+    os.utime(path, (mtime, mtime))
+
+    return zinfo.file_size
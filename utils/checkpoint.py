@@ -0,0 +1,175 @@
+"""Per-task, per-stage completion markers used to resume an interrupted or repeated run.
+
+Each task directory holds a marker file (<task>_icafix_checkpoints.json) with one entry per completed
+stage:
+  - key: hash of the task input fingerprint, the stage parameters and the keys of all previous stages,
+    so changing an input or an option invalidates the stage and every stage after it
+  - outputs: size and CRC of every file the stage wrote (relative to the task directory)
+  - removed: outputs of earlier stages the stage deleted (e.g. restitch removes the tmp* files holding
+    the trimmed dummy frames)
+  - result: value returned by the stage (e.g. the ICA-FIX command) to use when the stage is skipped
+
+Stages modify files in place (trimming and restitching the series), so the expected state of the task
+directory after a stage is the outputs of that stage and of every earlier stage, each file with the
+fingerprint recorded by the last stage that wrote it, less the files later stages removed. A run resumes after the last stage for which every
+stage up to it has a marker with the expected key and that expected state is unchanged on disk.
+
+Markers are only useful where the task directory outlives a job: a rerun in the same working directory,
+or previous results (which include the marker files) passed back to the gear in a cleanup mode. A new
+job on the original (untrimmed) inputs never matches the trim stage, so it starts from scratch. The
+'resume' option is off by default.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import time
+from pathlib import Path
+
+from utils.manifest import file_crc
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_SUFFIX = "_icafix_checkpoints.json"
+CHECKPOINT_VERSION = 1
+
+# files that change while a task runs without being stage outputs (task log, the markers themselves)
+IGNORED_SUFFIXES = (CHECKPOINT_SUFFIX, "_icafix.log")
+
+
+def checkpoint_file(taskdir):
+    return op.join(taskdir, Path(taskdir).name + CHECKPOINT_SUFFIX)
+
+
+class TaskCheckpoints:
+    """
+    Stage markers of one task directory.
+    Args:
+        taskdir (str): task directory (markers are stored in it)
+        stages (list): (stage name, parameters) in execution order, parameters must be json serializable
+        fingerprint: json serializable fingerprint of the task inputs
+        manifest (FileManifest): used to reuse archive CRCs of unchanged inputs, optional
+    """
+
+    def __init__(self, taskdir, stages, fingerprint, manifest=None):
+        self.taskdir = taskdir
+        self.filename = checkpoint_file(taskdir)
+        self.names = [name for name, _ in stages]
+        self.manifest = manifest
+
+        self.keys = {}
+        key = _hash(["inputs", fingerprint])
+        for name, params in stages:
+            key = _hash([key, name, params])
+            self.keys[name] = key
+
+        self.markers = {}
+        if op.exists(self.filename):
+            try:
+                with open(self.filename) as f:
+                    data = json.load(f)
+                if data.get("version") == CHECKPOINT_VERSION:
+                    self.markers = data.get("stages", {})
+            except (OSError, ValueError) as e:
+                log.warning("Ignoring unreadable checkpoint file %s: %s", self.filename, e)
+
+        self.resume_index = self._resume_index()
+        if self.resume_index:
+            log.info("Resuming %s after stage '%s' (skipping %s)", Path(taskdir).name,
+                     self.names[self.resume_index - 1], ", ".join(self.names[:self.resume_index]))
+
+    def completed(self, name):
+        """True if the stage can be skipped."""
+        return self.names.index(name) < self.resume_index
+
+    def result(self, name):
+        return self.markers[name].get("result")
+
+    def complete(self, name, written, result=None):
+        """
+        Record a completed stage. Markers of later stages are dropped (their inputs were just rewritten).
+        Args:
+            name (str): stage name
+            written (list): paths written by the stage
+            result: json serializable stage result
+        """
+        outputs = {}
+        for path in written:
+            rel = op.relpath(path, self.taskdir)
+            if rel.endswith(IGNORED_SUFFIXES) or not op.lexists(path):
+                continue
+            outputs[rel] = self._fingerprint(path)
+
+        index = self.names.index(name)
+        for later in self.names[index:]:
+            self.markers.pop(later, None)
+        # outputs of the earlier stages which are gone now were removed by this stage
+        removed = sorted(rel for rel in self._expected(index) if rel not in outputs
+                         and not op.lexists(op.join(self.taskdir, rel)))
+        self.markers[name] = {"key": self.keys[name], "outputs": outputs, "removed": removed, "result": result,
+                              "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        self._save()
+
+    def _resume_index(self):
+        """Index of the first stage to run: one past the last stage whose expected state is on disk."""
+        # markers with the expected key for the first stages, without gaps
+        valid = 0
+        while valid < len(self.names):
+            marker = self.markers.get(self.names[valid])
+            if not marker or marker.get("key") != self.keys[self.names[valid]]:
+                break
+            valid += 1
+
+        fingerprints = {}
+        for index in reversed(range(1, valid + 1)):
+            if self._unchanged(self._expected(index), fingerprints):
+                return index
+        return 0
+
+    def _expected(self, index):
+        """Expected files after the first index stages: relative path -> fingerprint."""
+        expected = {}
+        for name in self.names[:index]:
+            marker = self.markers.get(name)
+            if marker:
+                expected.update(marker["outputs"])
+                for rel in marker.get("removed", []):
+                    expected.pop(rel, None)
+        return expected
+
+    def _unchanged(self, outputs, fingerprints):
+        # compare sizes of all outputs before reading any content, file fingerprints are computed once
+        for rel, (size, _) in outputs.items():
+            path = op.join(self.taskdir, rel)
+            if not op.lexists(path) or (not op.islink(path) and op.getsize(path) != size):
+                return False
+        for rel, fp in outputs.items():
+            if rel not in fingerprints:
+                fingerprints[rel] = self._fingerprint(op.join(self.taskdir, rel))
+            if fingerprints[rel] != list(fp):
+                return False
+        return True
+
+    def _fingerprint(self, path):
+        if op.islink(path):
+            target = os.readlink(path)
+            return [len(target), _hash(target)]
+        crc = None
+        if self.manifest is not None:
+            # unchanged inputs keep the CRC from the archive central directory
+            name = self.manifest.relpath(path)
+            if name in self.manifest.inputs and not self.manifest.changed(name, os.lstat(path)):
+                crc = self.manifest.input_crc(path)
+        return [op.getsize(path), file_crc(path) if crc is None else crc]
+
+    def _save(self):
+        tmp = op.join(self.taskdir, "tmp" + Path(self.filename).name)
+        with open(tmp, "w") as f:
+            json.dump({"version": CHECKPOINT_VERSION, "stages": self.markers}, f, indent=2)
+        os.replace(tmp, self.filename)
+
+
+def _hash(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
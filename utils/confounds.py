@@ -0,0 +1,145 @@
+"""Motion confounds from HCP Movement_Regressors.txt, without subprocesses.
+
+Movement_Regressors.txt has 12 columns: translations x, y, z (mm), rotations x, y, z (degrees) and their
+backward differences. Each file is parsed once into an array, from which all outputs are written:
+  - FSL style parameters (mc/prefiltered_func_data_mcf.par, used by FIX motion regression): rotations in
+    radians followed by translations
+  - fMRIPrep style confounds (mc/confounds_timeseries.tsv): the 12 columns with rotations in radians,
+    optionally with the Friston 24-parameter expansion (squares of all 12 columns) and framewise
+    displacement (Power et al. 2012, 50 mm head radius)
+"""
+
+import logging
+import os
+import os.path as op
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+MOTION_COLUMNS = ["trans_x", "trans_y", "trans_z", "rot_x", "rot_y", "rot_z"]
+CONFOUND_COLUMNS = MOTION_COLUMNS + [c + "_derivative1" for c in MOTION_COLUMNS]
+ROTATIONS = slice(3, 6)
+
+# head radius used to convert rotations to displacement (mm)
+HEAD_RADIUS = 50.0
+
+
+def read_motion(filename):
+    """
+    Parse a Movement_Regressors.txt file.
+    Returns:
+        np.array: time x 12, rotations (and their derivatives) in degrees as stored
+    """
+    motion = np.loadtxt(filename, ndmin=2)
+    if motion.shape[1] != 12:
+        raise ValueError(f"Expected 12 columns in {filename}, found {motion.shape[1]}")
+    return motion
+
+
+def to_radians(motion):
+    """Copy of the motion array with the rotations and rotation derivatives converted to radians."""
+    out = np.array(motion, dtype=np.float64)
+    out[:, [3, 4, 5, 9, 10, 11]] = np.deg2rad(out[:, [3, 4, 5, 9, 10, 11]])
+    return out
+
+
+def friston24(params, derivatives=None):
+    """
+    Friston 24-parameter expansion: parameters, derivatives and their squares.
+    Args:
+        params (np.array): time x 6 motion parameters
+        derivatives (np.array): time x 6 derivatives, default: backward differences (first row 0)
+    Returns:
+        np.array: time x 24, [params, derivatives, params ** 2, derivatives ** 2]
+    """
+    if derivatives is None:
+        derivatives = np.vstack([np.zeros((1, params.shape[1])), np.diff(params, axis=0)])
+    expansion = np.hstack([params, derivatives])
+    return np.hstack([expansion, expansion ** 2])
+
+
+def framewise_displacement(motion, radius=HEAD_RADIUS):
+    """
+    Framewise displacement: sum of absolute frame to frame changes of the translations and of the
+    rotations as arc length on a sphere of the given radius.
+    Args:
+        motion (np.array): time x 12 (or 6) with rotations in degrees
+    Returns:
+        np.array: displacement per frame (mm), NaN for the first frame
+    """
+    params = np.array(motion[:, :6], dtype=np.float64)
+    params[:, ROTATIONS] = np.deg2rad(params[:, ROTATIONS]) * radius
+    fd = np.full(params.shape[0], np.nan)
+    fd[1:] = np.abs(np.diff(params, axis=0)).sum(axis=1)
+    return fd
+
+
+def write_fsl_par(motion, filename):
+    """Write FSL mcflirt style parameters: rotations (radians) then translations."""
+    par = np.hstack([np.deg2rad(motion[:, ROTATIONS]), motion[:, :3]])
+    np.savetxt(filename, par, fmt="%.6g", delimiter=" ")
+
+
+def write_confounds_tsv(motion, filename, expansion=False, fd=False):
+    """
+    Write fMRIPrep style confounds.
+    Args:
+        motion (np.array): time x 12 as read by read_motion
+        filename (str): output tsv
+        expansion (bool): add the squared terms of the Friston 24-parameter expansion
+        fd (bool): add framewise_displacement
+    """
+    radians = to_radians(motion)
+    columns = list(CONFOUND_COLUMNS)
+    data = [radians]
+    if expansion:
+        # same terms as friston24(params, derivatives), named as fMRIPrep does
+        data.append(friston24(radians[:, :6], radians[:, 6:])[:, 12:])
+        columns += [c + "_power2" for c in CONFOUND_COLUMNS]
+    if fd:
+        data.append(framewise_displacement(motion)[:, None])
+        columns.append("framewise_displacement")
+
+    table = pd.DataFrame(np.hstack(data), columns=columns)
+    table.to_csv(filename, sep="\t", header=True, index=False, float_format="%.5f", na_rep="n/a")
+
+
+def write_confounds(motion_file, expansion=False, fd=False):
+    """
+    Write mc/prefiltered_func_data_mcf.par and mc/confounds_timeseries.tsv next to a motion file.
+    Returns:
+        tuple: (par file, tsv file)
+    """
+    motion = read_motion(motion_file)
+    mcdir = op.join(op.dirname(op.abspath(motion_file)), "mc")
+    os.makedirs(mcdir, exist_ok=True)
+
+    par_file = op.join(mcdir, "prefiltered_func_data_mcf.par")
+    write_fsl_par(motion, par_file)
+    log.info("motion to fsl format: %s", par_file)
+
+    tsv_file = op.join(mcdir, "confounds_timeseries.tsv")
+    write_confounds_tsv(motion, tsv_file, expansion=expansion, fd=fd)
+    log.info("motion to fmriprep format: %s", tsv_file)
+
+    return par_file, tsv_file
+
+
+def trim_motion_file(motion_file, nframes, out_file=None):
+    """
+    Remove the rows of the first nframes frames (the original text is kept for the other rows).
+    Args:
+        motion_file (str): Movement_Regressors.txt
+        nframes (int): frames to remove
+        out_file (str): output, default: replace motion_file
+    """
+    out_file = out_file or motion_file
+    with open(motion_file) as f:
+        rows = [line for line in f if line.strip()]
+
+    tmp = op.join(op.dirname(op.abspath(out_file)), "tmp_" + op.basename(out_file))
+    with open(tmp, "w") as f:
+        f.writelines(rows[nframes:])
+    os.replace(tmp, out_file)
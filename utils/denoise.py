@@ -0,0 +1,314 @@
+"""In-process ICA-FIX cleanup: regress noise components (and optionally motion confounds) out of the
+high-pass filtered series, as `fix -a` does, without starting MATLAB/MCR.
+
+The regression follows fix_cleanup.m:
+  - soft (default): betas of all components are estimated together, only the noise components'
+    contribution is removed, ts = ts - mix[:, noise] @ pinv(mix)[noise] @ ts
+  - aggressive: the full variance explained by the noise components is removed,
+    ts = ts - mix[:, noise] @ pinv(mix[:, noise]) @ ts
+  - with motion regression, 24 motion confounds are removed from the data and from the mixing matrix
+    first, built as functionmotionconfounds.m does: the 6 parameters and their backward differences are
+    normalised, squared, normalised again and high-pass filtered (fslmaths -bptf, sigma = hp / (2 * TR);
+    hp = 0 is a linear detrend, hp < 0 no filtering) and normalised once more
+  - each voxel (grayordinate) time course is demeaned before the regression and its mean added back
+  - pseudo-inverses drop singular values below an absolute tolerance of 1e-6, as MATLAB pinv(x, 1e-6)
+
+tests/test_denoise.py checks these conventions against a reference computed by a direct transcription
+of fix_cleanup.m (tests/data/make_fix_cleanup_reference.py).
+
+Series are processed in blocks of voxels (grayordinates for CIFTI) read from a memory map of the
+uncompressed series, so memory use is bounded by the block size rather than the series size.
+"""
+
+import gzip
+import logging
+import os
+import os.path as op
+import re
+import shutil
+from collections import OrderedDict
+
+import nibabel as nib
+import numpy as np
+
+from utils.confounds import friston24
+from utils.timeseries import _disk_header, _scaling, _series_layout, _write_cifti_header, _write_header
+
+log = logging.getLogger(__name__)
+
+# bytes of (float64) series processed at a time
+BLOCK_BYTES = 256 * 1024 ** 2
+
+# gzip level of .nii.gz outputs (nibabel default, level 6 costs several times more for float data)
+COMPRESS_LEVEL = 1
+
+# pseudo-inverse tolerance used by fix_cleanup.m (absolute, singular values below it are dropped)
+PINV_TOL = 1e-6
+
+
+def read_noise_labels(labels_file):
+    """
+    Noise components (1-based) from a fix4melview file (last line, e.g. [1, 4, 7]) or a hand label list.
+    Returns:
+        list: component numbers
+    """
+    with open(labels_file) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    return [int(x) for x in re.findall(r"\d+", lines[-1])] if lines else []
+
+
+def pinv(a, tol=PINV_TOL):
+    """Pseudo-inverse with an absolute singular value tolerance, as MATLAB pinv(a, tol)."""
+    u, sv, vt = np.linalg.svd(a, full_matrices=False)
+    keep = sv > tol
+    return (vt[keep].T / sv[keep]) @ u[:, keep].T
+
+
+def cleanup_matrix(mix, noise, aggressive=False, confounds=None):
+    """
+    Regression applied to every voxel time course: clean = ts - ts @ P.T (ts as rows).
+    Args:
+        mix (np.array): melodic mixing matrix (time x components)
+        noise (list): noise components, 1-based
+        aggressive (bool): aggressive instead of soft cleanup
+        confounds (np.array): motion confounds (time x n), regressed out of the data and the mix first
+    Returns:
+        np.array: (time x time) projection of the data onto the removed subspace
+    """
+    ntime = mix.shape[0]
+    remove = np.zeros((ntime, ntime))
+
+    if confounds is not None:
+        conf_proj = confounds @ pinv(confounds)
+        mix = mix - conf_proj @ mix
+        remove = remove + conf_proj
+
+    idx = [n - 1 for n in noise]
+    if idx:
+        if aggressive:
+            noise_proj = mix[:, idx] @ pinv(mix[:, idx])
+        else:
+            noise_proj = mix[:, idx] @ pinv(mix)[idx]
+        if confounds is not None:
+            # noise is estimated from the motion cleaned data: (I - N)(I - C) = I - C - N(I - C)
+            noise_proj = noise_proj @ (np.eye(ntime) - conf_proj)
+        remove = remove + noise_proj
+
+    return remove
+
+
+def motion_confounds(par_file, tr, highpass):
+    """
+    24 motion confounds from an mcflirt .par file, as functionmotionconfounds.m: normalised parameters and
+    backward differences, their squares, normalised and high-pass filtered.
+    Args:
+        par_file (str): motion parameters (time x 6, further columns are ignored)
+        tr (float): repetition time in seconds
+        highpass (float): high-pass filter cutoff in seconds, 0 for a linear detrend, < 0 for none
+    Returns:
+        np.array: time x 24
+    """
+    params = np.loadtxt(par_file, ndmin=2)[:, :6]
+    conf = _normalise(friston24(params)[:, :12])
+    conf = _normalise(friston24(conf[:, :6], conf[:, 6:]))
+    if highpass == 0:
+        conf = _detrend(conf)
+    elif highpass > 0:
+        conf = _normalise(highpass_filter(conf, highpass / (2.0 * tr)))
+    return conf
+
+
+def highpass_filter(data, sigma):
+    """Remove a Gaussian weighted running line fit (as fslmaths -bptf) from each column of data (time x n)."""
+    ntime = data.shape[0]
+    t = np.arange(ntime)
+    # kernel half width truncated as in fslmaths (int)(sigma * 3)
+    half = int(sigma * 3)
+    out = np.empty_like(data, dtype=np.float64)
+    for i in range(ntime):
+        lo, hi = max(0, i - half), min(ntime, i + half + 1)
+        dt = t[lo:hi] - i
+        w = np.exp(-0.5 * (dt / sigma) ** 2)
+        sw, swt, swtt = w.sum(), (w * dt).sum(), (w * dt * dt).sum()
+        swy = w @ data[lo:hi]
+        swty = (w * dt) @ data[lo:hi]
+        denom = sw * swtt - swt ** 2
+        # weighted line evaluated at dt = 0 (the intercept)
+        intercept = (swtt * swy - swt * swty) / denom if denom > 0 else swy / sw
+        out[i] = data[i] - intercept
+    return out
+
+
+def clean_volume(in_file, out_file, remove, tmpdir=None):
+    """
+    Apply a cleanup projection to a 4D NIfTI, block by block.
+    Args:
+        in_file (str): 4D NIfTI (.nii or .nii.gz)
+        out_file (str): cleaned output (float32, same geometry)
+        remove (np.array): (time x time) projection from cleanup_matrix
+        tmpdir (str): directory for uncompressed intermediate files, default: next to out_file
+    """
+    tmpdir = tmpdir or op.dirname(op.abspath(out_file))
+    src_file = _uncompressed(in_file, tmpdir)
+    header = _disk_header(src_file)
+    shape = header.get_data_shape()
+    nvox, ntime = int(np.prod(shape[:3])), int(shape[3])
+    slope, inter = _scaling(header)
+
+    src = np.memmap(src_file, dtype=header.get_data_dtype(), mode="r", offset=int(header.get_data_offset()),
+                    shape=(nvox, ntime), order="F")
+
+    out_header = header.copy()
+    out_header.set_data_dtype(np.float32)
+    out_header.set_slope_inter(1, 0)
+    tmp_out = op.join(tmpdir, "tmp_clean_" + op.basename(out_file).replace(".nii.gz", ".nii"))
+    with open(tmp_out, "wb") as f:
+        _write_header(out_header, shape, f)
+        offset = f.tell()
+    dst = np.memmap(tmp_out, dtype=out_header.get_data_dtype(), mode="r+", offset=offset, shape=(nvox, ntime),
+                    order="F")
+
+    block = max(1, BLOCK_BYTES // (ntime * 8))
+    for start in range(0, nvox, block):
+        dst[start:start + block] = _clean_block(src[start:start + block], remove, slope, inter)
+    dst.flush()
+    del src, dst
+
+    _finalize(tmp_out, out_file)
+    if src_file != in_file:
+        os.remove(src_file)
+
+
+def clean_cifti(in_file, out_file, remove):
+    """
+    Apply a cleanup projection to a CIFTI-2 dtseries, block by block of grayordinates.
+    Args:
+        in_file (str): dense timeseries
+        out_file (str): cleaned output (float32, same CIFTI header)
+        remove (np.array): (time x time) projection from cleanup_matrix
+    """
+    header = _disk_header(in_file)
+    ntime, ncols, dtype = _series_layout(in_file, header)
+    slope, inter = _scaling(header)
+    src = np.memmap(in_file, dtype=dtype, mode="r", offset=int(header.get_data_offset()), shape=(ncols, ntime))
+
+    out_header = header.copy()
+    out_header.set_data_dtype(np.float32)
+    out_header.set_slope_inter(1, 0)
+    tmp_out = op.join(op.dirname(op.abspath(out_file)), "tmp_clean_" + op.basename(out_file))
+    with open(tmp_out, "wb") as f:
+        _write_cifti_header(in_file, out_header, ntime, f)
+        block = max(1, BLOCK_BYTES // (ntime * 8))
+        for start in range(0, ncols, block):
+            cleaned = _clean_block(src[start:start + block], remove, slope, inter)
+            f.write(cleaned.astype(out_header.get_data_dtype(), copy=False).tobytes())
+    del src
+
+    os.replace(tmp_out, out_file)
+
+
+def apply_cleanup(labels_file, aggressive=False, motion=False, highpass=None, cifti=True):
+    """
+    Clean the ICA directory containing labels_file, as `fix -a labels_file [-m [-h highpass]] [-A]`:
+    filtered_func_data -> filtered_func_data_clean and Atlas.dtseries.nii -> Atlas_clean.dtseries.nii.
+    Args:
+        labels_file (str): fix4melview / hand labels file in the .ica directory
+        aggressive (bool): aggressive instead of soft cleanup
+        motion (bool): also regress out 24 motion confounds (mc/prefiltered_func_data_mcf.par)
+        highpass (float): high-pass cutoff (s) applied to the motion confounds (see motion_confounds),
+            None for no filtering
+        cifti (bool): also clean Atlas.dtseries.nii if present
+    Returns:
+        list: cleaned files
+    """
+    icadir = op.dirname(op.abspath(labels_file))
+    noise = read_noise_labels(labels_file)
+    mix_file = op.join(icadir, "filtered_func_data.ica", "melodic_mix")
+    mix = np.loadtxt(mix_file, ndmin=2)
+    log.info("Cleanup of %s noise components of %s (%s)", len(noise), mix.shape[1],
+             "aggressive" if aggressive else "soft")
+
+    in_file = op.join(icadir, "filtered_func_data.nii.gz")
+    par_file = op.join(icadir, "mc", "prefiltered_func_data_mcf.par")
+    atlas = op.join(icadir, "Atlas.dtseries.nii")
+    img = nib.load(in_file)
+    lengths = OrderedDict([(mix_file, mix.shape[0]), (in_file, img.shape[3])])
+    if motion:
+        lengths[par_file] = np.loadtxt(par_file, ndmin=2).shape[0]
+    if cifti and op.exists(atlas):
+        lengths[atlas] = nib.load(atlas).shape[0]
+    check_lengths(lengths)
+
+    confounds = None
+    if motion:
+        tr = float(img.header.get_zooms()[3])
+        confounds = motion_confounds(par_file, tr, float(highpass) if highpass is not None else -1)
+
+    remove = cleanup_matrix(mix, noise, aggressive=aggressive, confounds=confounds)
+
+    outputs = [op.join(icadir, "filtered_func_data_clean.nii.gz")]
+    clean_volume(in_file, outputs[0], remove)
+
+    if cifti and op.exists(atlas):
+        outputs.append(op.join(icadir, "Atlas_clean.dtseries.nii"))
+        clean_cifti(atlas, outputs[1], remove)
+
+    return outputs
+
+
+def check_lengths(lengths):
+    """
+    Check that the series, the ICA mixing matrix and the motion parameters have the same number of frames.
+    Args:
+        lengths (OrderedDict): filename -> number of frames
+    Raises:
+        ValueError: naming each file and its length
+    """
+    if len(set(lengths.values())) <= 1:
+        return
+    raise ValueError(
+        "Frame counts differ: %s. The ICA (melodic_mix, mc/prefiltered_func_data_mcf.par) covers the "
+        "frames left after the dummy volumes were removed, so the series must be trimmed by the same "
+        "number of dummy volumes (AcqDummyVolumes) as in the run that produced the ICA."
+        % ", ".join("%s has %s" % (op.basename(name), n) for name, n in lengths.items()))
+
+
+def _clean_block(block, remove, slope, inter):
+    ts = np.asarray(block, dtype=np.float64)
+    if slope != 1.0 or inter != 0.0:
+        ts = ts * slope + inter
+    mean = ts.mean(axis=1, keepdims=True)
+    ts = ts - mean
+    return (ts - ts @ remove.T + mean).astype(np.float32)
+
+
+def _normalise(data):
+    # functionnormalise.m: zero mean, unit (sample) standard deviation per column
+    data = data - data.mean(axis=0)
+    std = data.std(axis=0, ddof=1) if data.shape[0] > 1 else np.zeros(data.shape[1])
+    return data / np.where(std > 0, std, 1)
+
+
+def _detrend(data):
+    # MATLAB detrend: remove the least squares line from each column
+    t = np.vstack([np.ones(data.shape[0]), np.arange(data.shape[0])]).T
+    return data - t @ np.linalg.lstsq(t, data, rcond=None)[0]
+
+
+def _uncompressed(filename, tmpdir):
+    """Uncompressed copy of a .nii.gz (memory mapping needs an uncompressed file)."""
+    if not filename.endswith(".gz"):
+        return op.realpath(filename)
+    out = op.join(tmpdir, "tmp_" + op.basename(filename)[:-3])
+    with gzip.open(filename, "rb") as src, open(out, "wb") as dst:
+        shutil.copyfileobj(src, dst, 16 * 1024 ** 2)
+    return out
+
+
+def _finalize(tmp_file, out_file):
+    if out_file.endswith(".gz"):
+        with open(tmp_file, "rb") as src, gzip.open(out_file, "wb", compresslevel=COMPRESS_LEVEL) as dst:
+            shutil.copyfileobj(src, dst, 16 * 1024 ** 2)
+        os.remove(tmp_file)
+    else:
+        os.replace(tmp_file, out_file)
@@ -0,0 +1,133 @@
+"""Persistent cache of FIX feature extraction results, shared between jobs.
+
+`fix -c` only extracts features (the slow MATLAB/MCR step) when <icadir>/fix/features.csv is missing,
+so restoring a cached `fix` directory leaves only the R classification to run. Entries are addressed
+by a hash of the files feature extraction reads: the melodic outputs, motion parameters, registration
+and masks in the .ica directory, and the high-pass filtered series. Archive CRCs recorded by the file
+manifest are used where available, so hashing rarely has to read the data.
+
+The cache lives in <gear-writable-dir>/icafix-feature-cache (one subdirectory per entry), so it is only
+shared by jobs that see the same gear writable directory. It is disabled unless 'feature-cache-size' is
+set. Hits refresh the entry modification time, and the least recently used entries are evicted once the
+total size exceeds the configured limit.
+"""
+
+import hashlib
+import logging
+import os
+import os.path as op
+import shutil
+import tempfile
+from fnmatch import fnmatch
+
+from utils.manifest import file_crc, scan
+
+log = logging.getLogger(__name__)
+
+CACHE_DIRNAME = "icafix-feature-cache"
+FEATURES_DIRNAME = "fix"
+
+# .ica contents which are not feature extraction inputs (outputs of fix, the gear and the report)
+FEATURE_INPUT_EXCLUDE = ("fix/*", "figures/*", "components/*", "fix4melview*", "hand_labels_noise.txt", "*clean*",
+                         "*report*", "tmp*", ".fix*")
+
+
+def feature_key(icadir, hpfile, manifest=None, extra=None):
+    """
+    Content hash of the feature extraction inputs of an ICA directory.
+    Args:
+        icadir (str): melodic .ica directory
+        hpfile (str): high-pass filtered series the ICA was run on
+        manifest (FileManifest): reuse archive CRCs of extracted inputs, optional
+        extra (list): additional values to include in the key (e.g. the number of trimmed frames)
+    Returns:
+        str: hex digest
+    """
+    sha = hashlib.sha256()
+    for name, st in sorted(scan(icadir).items()):
+        if any(fnmatch(name, p) for p in FEATURE_INPUT_EXCLUDE):
+            continue
+        sha.update(("%s:%s\n" % (name, _content_id(op.join(icadir, name), manifest))).encode("utf-8"))
+    sha.update(("hp:%s\n" % _content_id(hpfile, manifest)).encode("utf-8"))
+    sha.update(("extra:%s\n" % (extra,)).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class FeatureCache:
+    """
+    Size limited LRU cache of `fix` feature directories.
+    Args:
+        cache_dir (str): cache location (created if missing)
+        max_bytes (int): total size limit, entries are evicted least recently used first
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def restore(self, key, icadir):
+        """
+        Copy cached features into icadir/fix.
+        Returns:
+            bool: True on a cache hit
+        """
+        entry = op.join(self.cache_dir, key)
+        if not op.isfile(op.join(entry, FEATURES_DIRNAME, "features.csv")):
+            return False
+
+        target = op.join(icadir, FEATURES_DIRNAME)
+        if op.lexists(target):
+            shutil.rmtree(target)
+        shutil.copytree(op.join(entry, FEATURES_DIRNAME), target, symlinks=True)
+
+        os.utime(entry)
+        log.info("Restored FIX features from cache (%s)", key[:12])
+        return True
+
+    def store(self, key, icadir):
+        """Add icadir/fix to the cache (no-op if already cached or features are missing)."""
+        source = op.join(icadir, FEATURES_DIRNAME)
+        entry = op.join(self.cache_dir, key)
+        if op.exists(entry) or not op.isfile(op.join(source, "features.csv")):
+            return
+
+        # copy to a private directory first, concurrent jobs may store the same entry
+        tmp = tempfile.mkdtemp(prefix="tmp", dir=self.cache_dir)
+        try:
+            shutil.copytree(source, op.join(tmp, FEATURES_DIRNAME), symlinks=True)
+            os.rename(tmp, entry)
+            log.info("Stored FIX features in cache (%s)", key[:12])
+        except OSError as e:
+            log.debug("Feature cache entry not stored: %s", e)
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir() and not entry.name.startswith("tmp"):
+                size = sum(st.st_size for st in scan(entry.path).values())
+                entries.append((entry.stat().st_mtime, size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            log.info("Evicted FIX feature cache entry %s", op.basename(path)[:12])
+
+
+def _content_id(path, manifest):
+    if op.islink(path):
+        path = op.realpath(path)
+    if not op.exists(path):
+        return None
+    if manifest is not None:
+        crc = manifest.input_crc(path)
+        if crc is not None:
+            return crc
+    return file_crc(path)
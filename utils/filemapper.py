@@ -1,30 +1,19 @@
 from pathlib import Path
 import os, logging
-import subprocess as sp
-import pandas as pd
-import math
-import numpy as np
+import functools
 import json
-import shutil
+import re
+import string
+from collections import Counter, OrderedDict, namedtuple
+
+import utils.confounds as confounds
 
 log = logging.getLogger(__name__)
 
-def execute_shell(cmd, dryrun=False, cwd=os.getcwd()):
-    log.info("\n %s", cmd)
-    if not dryrun:
-        terminal = sp.Popen(
-            cmd,
-            shell=True,
-            stdout=sp.PIPE,
-            stderr=sp.PIPE,
-            universal_newlines=True,
-            cwd=cwd
-        )
-        stdout, stderr = terminal.communicate()
-        log.info("\n %s", stdout)
-        log.info("\n %s", stderr)
+Link = namedtuple("Link", ["bidspath", "source", "dest"])
 
-        return stdout.strip('\n')
+# motion file of each functional run (relative to the analysis directory), confounds are generated from it
+MOTION_FILE_PATTERN = "HCPPipe/sub-{SUBJECT}/ses-{SESSION}/MNINonLinear/Results/ses-{SESSION}_{ACQ}_bold/Movement_Regressors.txt"
 
 
 def build_lookup(analysis, fw):
@@ -38,142 +27,184 @@ def build_lookup(analysis, fw):
 
 
 def apply_lookup(text, lookup_table):
-    if '{' in text and '}' in text:
-        for lookup in lookup_table:
-            text = text.replace('{' + lookup + '}', lookup_table[lookup])
-    return text
-
-
-def motion_to_fmripreplike(filepath):
-    os.makedirs(os.path.join(filepath.parent, "mc"), exist_ok=True)
+    return compile_template(text)(lookup_table)
 
-    data = pd.read_csv(filepath, header=None, delim_whitespace=True)
 
-    data.columns = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z', 'trans_x_derivative1',
-                    'trans_y_derivative1', 'trans_z_derivative1', 'rot_x_derivative1', 'rot_y_derivative1',
-                    'rot_z_derivative1']
-
-    # convert rotation to radians (consistent with fmriprep)
-    data2 = data.copy()
+@functools.lru_cache(maxsize=None)
+def compile_template(text):
+    """
+    Parse a mapper template ("{SUBJECT}" style fields) once.
+    Returns:
+        callable: lookup table -> text, unknown fields are left as is
+    """
+    parts = []
+    for literal, field, _, _ in string.Formatter().parse(text):
+        parts.append((literal, field))
 
-    radians_ = np.vectorize(math.radians)
-    cols_to_convert = ["rot_x", "rot_y", "rot_z", "rot_x_derivative1", "rot_y_derivative1", "rot_z_derivative1"]
-    for col in cols_to_convert:
-        data2[col] = radians_(data[col])
+    def render(lookup_table):
+        return "".join(literal + ("" if field is None else lookup_table.get(field, "{" + field + "}"))
+                       for literal, field in parts)
 
-    # save output as tsv (fmriprep format)
-    outpath = os.path.join(filepath.parent, "mc", "confounds_timeseries.tsv")
-    data2.to_csv(outpath, sep='\t', header=True, index=False, float_format='%.5f')
-    log.info("motion to fmriprep format: %s", outpath)
+    return render
 
 
-def motion_to_fsllike(filepath):
-    cwd = os.getcwd()
-    os.chdir(filepath.parent)
-    os.makedirs(os.path.join(filepath.parent, "mc"), exist_ok=True)
+@functools.lru_cache(maxsize=None)
+def _raw_mapper():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(dir_path, "hcp_mapper.json")) as f:
+        data = json.load(f)
+    return {k: (m["bidspath"], list(m["files"].items())) for k, m in data.items()}
 
-    # reorder outputs and convert rotation units to radians
-    cmd = """cat Movement_Regressors.txt | awk '{ print $4/57.29 " " $5/57.29 " " $6/57.29 " " $1 " " $2 " " $3}' > mc/prefiltered_func_data_mcf.par"""
-    execute_shell(cmd, cwd=filepath.parent)
-    log.info("motion to fsl format: %s", os.path.join(filepath.parent, "mc", "prefiltered_func_data_mcf.par"))
-    os.chdir(cwd)
 
+@functools.lru_cache(maxsize=None)
+def load_mapper():
+    """hcp_mapper.json with every template compiled: {modality: (bidspath, [(source, dest)])}."""
+    return {k: (compile_template(bidspath), [(compile_template(s), compile_template(d)) for s, d in files])
+            for k, (bidspath, files) in _raw_mapper().items()}
 
-def copy_hcp_to_fmripreplike(root_dir, bidspath, source, dest):
-    os.chdir(os.path.join(root_dir, bidspath))
-    if os.path.islink(dest):
-        os.unlink(dest)
-    if not os.path.exists(source):
-        log.warning("source file does not exist.")
-        return
-    log.info("copy... %s -> %s", source, os.path.join(bidspath, dest))
-    shutil.copy(source, dest)
 
+def source_patterns():
+    """
+    fnmatch patterns, relative to the analysis directory, of every file the mapper links to (and of the
+    motion files the confounds are generated from), e.g. to select the archive members a job needs.
+    """
+    patterns = [MOTION_FILE_PATTERN]
+    for bidspath, files in _raw_mapper().values():
+        for source, _ in files:
+            patterns.append(os.path.normpath(os.path.join(bidspath, source)))
+    return [re.sub(r"\{[A-Z]+\}", "*", p) for p in dict.fromkeys(patterns)]
 
-def symlink_hcp_to_fmripreplike(root_dir, bidspath, source, dest):
-    os.chdir(os.path.join(root_dir, bidspath))
-    if os.path.islink(dest):
-        os.unlink(dest)
-    if not os.path.exists(source):
-        log.warning("source file does not exist.")
-        return
-    log.info("linking... %s -> %s", source, os.path.join(bidspath, dest))
-    os.symlink(source, dest)
 
+def build_plan(lookup_table, acquisitions, trainingfiles=("",)):
+    """
+    Every link of the session.
+    Args:
+        lookup_table (dict): PIPELINE, SUBJECT and SESSION
+        acquisitions (list): functional acquisition names (label without "func-bold_")
+        trainingfiles (list): training file names used to differentiate ICA cleaned timeseries
+    Returns:
+        list: Link(bidspath, source, dest), source relative to bidspath; unique destinations
+    """
+    plan = OrderedDict()
+    for k, (bidspath, files) in load_mapper().items():
+        lookups = [dict(lookup_table, ACQ=acq, TRAININGFILE=t) for acq in acquisitions for t in trainingfiles] \
+            if k == "func" else [dict(lookup_table, TRAININGFILE=t) for t in trainingfiles]
+        for lookup in lookups:
+            path = bidspath(lookup)
+            for source, dest in files:
+                link = Link(path, source(lookup), dest(lookup))
+                plan.setdefault((link.bidspath, link.dest), link)
+    return list(plan.values())
+
+
+def link_status(dir_fd, link):
+    """State of a planned link: "ok" (already correct), "missing" (no source), "exists" (dest is not a
+    link), "relink" (dest links elsewhere) or "new"."""
+    try:
+        current = os.readlink(link.dest, dir_fd=dir_fd)
+    except FileNotFoundError:
+        current = None
+    except OSError:
+        return "exists"
+
+    try:
+        os.stat(link.source, dir_fd=dir_fd)
+    except FileNotFoundError:
+        return "missing"
+
+    if current is None:
+        return "new"
+    return "ok" if current == link.source else "relink"
+
+
+def apply_plan(root_dir, plan, dryrun=False):
+    """
+    Create the links of a plan: relative symlinks created from a descriptor of each bids directory, links
+    which are already correct are kept.
+    Args:
+        root_dir: Parent directory containing "HCPPipe" and "ICAFIX" results
+        plan (list): Link entries (see build_plan)
+        dryrun (bool): only log the plan
+    Returns:
+        Counter: number of links per status
+    """
+    counts = Counter()
+    directories = OrderedDict()
+    for link in plan:
+        directories.setdefault(link.bidspath, []).append(link)
+
+    for bidspath, links in directories.items():
+        directory = os.path.join(str(root_dir), bidspath)
+        if not dryrun:
+            os.makedirs(directory, exist_ok=True)
+        elif not os.path.isdir(directory):
+            for link in links:
+                log.info("[new] %s -> %s", os.path.join(bidspath, link.dest), link.source)
+                counts["new"] += 1
+            continue
+
+        dir_fd = os.open(directory, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+        try:
+            for link in links:
+                status = link_status(dir_fd, link)
+                counts[status] += 1
+                if dryrun:
+                    log.info("[%s] %s -> %s", status, os.path.join(bidspath, link.dest), link.source)
+                    continue
 
-def main(root_dir, anlys_id, fw, dryrun= False, fix_trainingfile=''):
+                if status in ("relink", "missing"):
+                    # stale link (or a link to a file that is gone)
+                    try:
+                        os.unlink(link.dest, dir_fd=dir_fd)
+                    except FileNotFoundError:
+                        pass
+                if status == "missing":
+                    log.warning("source file does not exist: %s", os.path.join(bidspath, link.source))
+                elif status == "exists":
+                    log.warning("%s exists and is not a link, not replaced", os.path.join(bidspath, link.dest))
+                elif status != "ok":
+                    log.info("linking... %s -> %s", link.source, os.path.join(bidspath, link.dest))
+                    os.symlink(link.source, link.dest, dir_fd=dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    log.info("File mapper: %s", ", ".join("%s %s" % (n, status) for status, n in sorted(counts.items())))
+    return counts
+
+
+def main(root_dir, anlys_id, fw, dryrun= False, fix_trainingfile='', friston24=False, fd=False):
     """
     file mapper is used to arrange human connectome minimal preprocesisng pipeline (HCPPipe and ICAFIX) into a bids-derivateive format.
     All outputs are symbolically linked to reduce excess file storage costs. Always retain the original HCPPipe directory.
     Args:
         root_dir: Parent directory containing "HCPPipe" and "ICAFIX" results
         anlys_id: flywheel analysis id
-        dryrun: test functionality without running
-        fix_trainingfile: training file name used to differentiate ICA cleaned timeseries.
+        dryrun: log the links (and their state) without touching the filesystem
+        fix_trainingfile: training file name used to differentiate ICA cleaned timeseries, or a list of names
+        friston24: add the squared terms of the Friston 24-parameter expansion to the confounds
+        fd: add framewise displacement to the confounds
 
     Returns:
-
+        list: the plan (Link entries)
     """
-
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    with open(os.path.join(dir_path, "hcp_mapper.json")) as f:
-        data = json.load(f)
+    trainingfiles = [fix_trainingfile] if isinstance(fix_trainingfile, str) else list(fix_trainingfile)
 
     # ------
     analysis = fw.get_analysis(anlys_id)
     lookup_table = build_lookup(analysis, fw)
     lookup_table["PIPELINE"] = "bids-hcp"
 
-    # relevant when running after icafix
-    lookup_table["TRAININGFILE"] = fix_trainingfile
-
-    for k in data.keys():
-        modality = data[k]
-
-        bidspath = apply_lookup(modality["bidspath"], lookup_table)
-        os.makedirs(os.path.join(root_dir, bidspath), exist_ok=True)
-
-        # functional modalities are treated different because covariates are also generated from motion file
-        if k == "func":
-            # grab all functional bold acquisitions
-            acqs = fw.get_session(analysis.parent["id"]).acquisitions.find('label=~^func-bold')
-
-            for idx, x in enumerate(acqs):
-
-                #skip sbref files
-                if "sbref" in x.label.lower():
-                    continue
-
-                # build lookup table with acquisition information
-                lookup_table_itr = lookup_table
-                lookup_table_itr["ACQ"] = acqs[idx].label.replace("func-bold_", "")
-
-                # create movement files to match fsl and fmriprep formats (not sure which is better to use generically)
-                motion_file_pattern = os.path.join(str(root_dir), "HCPPipe/sub-{SUBJECT}/ses-{SESSION}/MNINonLinear/Results/ses-{SESSION}_{ACQ}_bold/Movement_Regressors.txt")
-                motion_file = Path(apply_lookup(motion_file_pattern, lookup_table_itr))
-
-                if not dryrun and motion_file.exists():
-                    motion_to_fsllike(motion_file)
-                    motion_to_fmripreplike(motion_file)
-
-                # apply symbolic linking
-                for s in modality["files"].keys():
-
-                    source = apply_lookup(s, lookup_table_itr)
-                    dest = apply_lookup(modality["files"][s], lookup_table_itr)
-
-                    if not dryrun:
-                        symlink_hcp_to_fmripreplike(root_dir, bidspath, source, dest)
-
-        # all other acquisition modalities
-        else:
-
-            # apply symbolic linking
-            for s in modality["files"].keys():
-
-                source = apply_lookup(s, lookup_table)
-                dest = apply_lookup(modality["files"][s], lookup_table)
+    # grab all functional bold acquisitions (skip sbref files)
+    acqs = [x.label.replace("func-bold_", "") for x in fw.find_acquisitions(analysis.parent["id"], 'label=~^func-bold')
+            if "sbref" not in x.label.lower()]
 
-                if not dryrun:
-                    symlink_hcp_to_fmripreplike(root_dir, bidspath, source, dest)
+    # create movement files to match fsl and fmriprep formats (not sure which is better to use generically)
+    motion_file_pattern = compile_template(os.path.join(str(root_dir), MOTION_FILE_PATTERN))
+    for acq in acqs:
+        motion_file = Path(motion_file_pattern(dict(lookup_table, ACQ=acq)))
+        if not dryrun and motion_file.exists():
+            confounds.write_confounds(motion_file, expansion=friston24, fd=fd)
 
+    plan = build_plan(lookup_table, acqs, trainingfiles)
+    apply_plan(root_dir, plan, dryrun=dryrun)
+    return plan
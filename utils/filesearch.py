@@ -0,0 +1,139 @@
+"""In-process file search, replacing `ls -d` / `ls -dt` subprocesses.
+
+Directory listings are cached and revalidated against the directory modification time, so repeated
+lookups in the same directories (several per task) cost one stat per directory instead of a process
+spawn. The mtime misses entries created within the same timestamp tick as the cached listing, so
+`invalidate` drops cached listings after every external command (see fw_gear_icafix.main) and at the
+end of each pipeline stage (see utils.manifest).
+
+Patterns use shell wildcards (`*`, `?`, `[...]`) in any path component, as with `ls -d`. Results are
+lists of paths; sorting by name (as `ls -d`) or by modification time, newest first (as `ls -dt`).
+"""
+
+import logging
+import os
+import os.path as op
+import threading
+from fnmatch import fnmatch
+from typing import List, Optional
+
+log = logging.getLogger(__name__)
+
+_cache = {}  # directory -> (st_mtime_ns, entry names)
+_lock = threading.Lock()
+
+
+def search(pattern: str, sort: str = "name") -> List[str]:
+    """
+    Find paths matching a shell wildcard pattern.
+    Args:
+        pattern (str): path pattern, wildcards allowed in any component
+        sort (str): "name" (as `ls -d`) or "mtime" (newest first, as `ls -dt`)
+    Returns:
+        list: matching paths, empty if nothing matches
+    """
+    if op.isabs(pattern):
+        matches = [os.sep]
+        parts = pattern.lstrip(os.sep).split(os.sep)
+    else:
+        matches = [""]
+        parts = pattern.split(os.sep)
+
+    for part in parts:
+        if not part:
+            continue
+        found = []
+        for parent in matches:
+            names = _listdir(parent or os.curdir)
+            if _has_magic(part):
+                found.extend(op.join(parent, name) for name in names
+                             if fnmatch(name, part) and (part.startswith(".") or not name.startswith(".")))
+            elif part in names or part in (os.curdir, os.pardir):
+                found.append(op.join(parent, part))
+        matches = found
+        if not matches:
+            break
+
+    if sort == "mtime":
+        return sorted(matches, key=lambda p: (-_mtime(p), p))
+    return sorted(matches)
+
+
+def find_first(pattern: str) -> Optional[str]:
+    """First match by name, or None."""
+    matches = search(pattern)
+    return matches[0] if matches else None
+
+
+def find_recent(pattern: str) -> Optional[str]:
+    """Most recently modified match, or None."""
+    matches = search(pattern, sort="mtime")
+    return matches[0] if matches else None
+
+
+def invalidate(directory: Optional[str] = None):
+    """Drop cached listings of `directory` and everything below it (all listings if None)."""
+    with _lock:
+        if directory is None:
+            _cache.clear()
+            return
+        directory = op.abspath(directory)
+        for key in [k for k in _cache if k == directory or k.startswith(directory + os.sep)]:
+            del _cache[key]
+
+
+def searchfiles(path, dryrun=False, find_first=False, find_recent=False):
+    """
+    Compatibility wrapper with the former `ls` based search.
+    Args:
+        path (str): path pattern
+        dryrun (bool): return None without searching
+        find_first (bool): return the first match by name (str or None)
+        find_recent (bool): return the most recently modified match (str or None)
+    Returns:
+        list or str: all matches, or a single match with find_first / find_recent
+    """
+    log.debug("search %s", path)
+    if dryrun:
+        return None
+
+    files = search(path, sort="mtime" if find_recent else "name")
+    log.debug("found %s", files)
+
+    if find_first or find_recent:
+        return files[0] if files else None
+
+    return files
+
+
+def _listdir(directory):
+    key = op.abspath(directory)
+    try:
+        mtime = os.stat(key).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return frozenset()
+
+    with _lock:
+        cached = _cache.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        names = frozenset(entry.name for entry in os.scandir(key))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return frozenset()
+
+    with _lock:
+        _cache[key] = (mtime, names)
+    return names
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _has_magic(part):
+    return any(c in part for c in "*?[")
@@ -0,0 +1,249 @@
+"""Caching, concurrent wrapper around the flywheel SDK client.
+
+The gear reads the same few containers many times (destination analysis, its subject and session, the
+session's functional acquisitions) from the parser, the acquisition index, the file mapper and every
+task. The wrapper:
+  - keeps one SDK client, and so one HTTP session, for the whole job; its connection pool is sized for
+    the prefetch threads
+  - caches containers by id (get, get_container, get_analysis, get_subject, get_session,
+    get_acquisition all share the cache) and acquisition listings by session and filter; concurrent
+    requests for the same id wait for a single API call
+  - prefetches the destination, its subject and session and the session's acquisitions on a thread pool
+    while the job continues (e.g. while the inputs are unzipped)
+  - queues file info updates and sends them together at the end of the job; updates of the same file
+    are merged one level below the top level key, so e.g. every training file entry of ICAFIX is kept
+  - counts API calls, cache hits and time spent per method
+
+Other attributes are passed through to the SDK client. Containers are shared: callers must not modify
+them. Forked processes (parallel tasks) inherit the cache and get a new thread pool; their queued
+updates and call statistics are handed back to the parent (take_updates, stats). Call shutdown() before
+forking, so no request holds SDK or connection pool locks that would stay locked in the child.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+CACHED_GETTERS = ("get", "get_container", "get_analysis", "get_subject", "get_session", "get_acquisition")
+
+
+class FlywheelClient:
+    """
+    Args:
+        client: flywheel SDK client (flywheel.Client, or any object with the same getters)
+        n_workers (int): threads used for prefetching and sending updates
+    """
+
+    def __init__(self, client, n_workers=4):
+        self.client = client
+        self.n_workers = max(1, int(n_workers))
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._updates = OrderedDict()
+        self._calls = Counter()
+        self._seconds = Counter()
+        self._hits = 0
+        self._pid = os.getpid()
+        self._executor = None
+        self._prefetching = None
+        _size_connection_pool(client, self.n_workers)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name == "client":
+            raise AttributeError(name)
+        if name in CACHED_GETTERS:
+            return lambda container_id: self._get(name, container_id)
+        return getattr(self.client, name)
+
+    def find_acquisitions(self, session_id, *filters):
+        """Acquisitions of a session (session.acquisitions.find(*filters)), cached by session and filters."""
+        return self._cached(("acquisitions", session_id) + filters, "acquisitions.find",
+                            lambda: self._get("get_session", session_id).acquisitions.find(*filters))
+
+    def prefetch(self, destination_id, acquisition_filter=None):
+        """
+        Start fetching the destination, its subject and session and the session's acquisitions in the
+        background; later getters return the cached containers (or wait for the pending request).
+        Args:
+            destination_id (str): gear destination container id
+            acquisition_filter (callable): acquisition label -> bool, acquisitions to fetch in full
+        Returns:
+            Future: resolves once all requests are started
+        """
+        future = self._pool().submit(self._prefetch, destination_id, acquisition_filter)
+        self._prefetching = future
+        return future
+
+    def shutdown(self):
+        """Wait for the prefetch and all pending requests, then stop the thread pool (later requests start
+        a new one)."""
+        prefetching, self._prefetching = self._prefetching, None
+        if prefetching is not None:
+            try:
+                prefetching.result()
+            except Exception as e:
+                log.warning("Prefetch failed: %s", e)
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def queue_info_update(self, acquisition_id, file_name, info):
+        """Queue file.update_info(info) for a file of an acquisition, sent by flush()."""
+        key = (acquisition_id, file_name)
+        with self._lock:
+            queued = self._updates.setdefault(key, {})
+            for k, v in info.items():
+                if isinstance(v, dict) and isinstance(queued.get(k), dict):
+                    queued[k] = dict(queued[k], **v)
+                else:
+                    queued[k] = v
+
+    def take_updates(self):
+        """Remove and return the queued updates, as a list of (acquisition id, file name, info)."""
+        with self._lock:
+            updates = [key + (info,) for key, info in self._updates.items()]
+            self._updates.clear()
+        return updates
+
+    def add_updates(self, updates):
+        """Queue updates taken from another process."""
+        for acquisition_id, file_name, info in updates:
+            self.queue_info_update(acquisition_id, file_name, info)
+
+    def flush(self):
+        """
+        Send all queued file info updates (concurrently).
+        Returns:
+            int: number of failed updates
+        """
+        updates = self.take_updates()
+        if not updates:
+            return 0
+
+        start = time.perf_counter()
+        futures = [self._pool().submit(self._send_update, *update) for update in updates]
+        failed = 0
+        for (acquisition_id, file_name, _), future in zip(updates, futures):
+            try:
+                future.result()
+            except Exception as e:
+                log.warning("Unable to update info of %s (acquisition %s): %s", file_name, acquisition_id, e)
+                failed += 1
+        log.info("Sent %s file info update(s) in %.2f s", len(updates) - failed, time.perf_counter() - start)
+        return failed
+
+    def stats(self):
+        """API call counts, cache hits and seconds spent per method."""
+        with self._lock:
+            return {"calls": dict(self._calls), "seconds": {k: round(v, 3) for k, v in self._seconds.items()},
+                    "cache_hits": self._hits}
+
+    def reset_stats(self):
+        with self._lock:
+            self._calls.clear()
+            self._seconds.clear()
+            self._hits = 0
+
+    def add_stats(self, stats):
+        """Add statistics collected in another process."""
+        with self._lock:
+            self._calls.update(stats["calls"])
+            self._seconds.update(stats["seconds"])
+            self._hits += stats["cache_hits"]
+
+    def log_stats(self):
+        stats = self.stats()
+        ncalls = sum(stats["calls"].values())
+        log.info("Flywheel API: %s call(s) in %.2f s, %s cache hit(s)\n%s", ncalls, sum(stats["seconds"].values()),
+                 stats["cache_hits"], "\n".join("  %-20s %5s calls %8.3f s" % (name, n, stats["seconds"][name])
+                                                for name, n in sorted(stats["calls"].items())))
+
+    def _prefetch(self, destination_id, acquisition_filter):
+        # runs on the pool: queue the dependent requests without waiting for them (no pool deadlock)
+        destination = self._get("get", destination_id)
+        parents = getattr(destination, "parents", None) or {}
+        ids = [parents[level] for level in ("subject", "session") if parents.get(level)]
+        for container_id in ids:
+            self._pool().submit(self._get, "get_container", container_id)
+
+        if parents.get("session"):
+            for acq in self.find_acquisitions(parents["session"]):
+                if acquisition_filter is None or acquisition_filter(acq.label):
+                    self._pool().submit(self._get, "get_acquisition", acq.id)
+
+    def _send_update(self, acquisition_id, file_name, info):
+        acquisition = self._get("get_acquisition", acquisition_id)
+        fw_file = next((f for f in acquisition.files if f.name == file_name), None)
+        if fw_file is None:
+            raise ValueError("file not found")
+        self._timed("file.update_info", lambda: fw_file.update_info(info))
+
+    def _get(self, method, container_id):
+        return self._cached(("container", container_id), method,
+                            lambda: getattr(self.client, method)(container_id))
+
+    def _cached(self, key, name, fetch):
+        self._check_fork()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                entry = self._cache[key] = Future()
+                owner = True
+            else:
+                self._hits += 1
+                owner = False
+
+        if not owner:
+            return entry.result()
+
+        try:
+            entry.set_result(self._timed(name, fetch))
+        except Exception as e:
+            # do not cache failures
+            with self._lock:
+                self._cache.pop(key, None)
+            entry.set_exception(e)
+        return entry.result()
+
+    def _timed(self, name, call):
+        start = time.perf_counter()
+        try:
+            return call()
+        finally:
+            with self._lock:
+                self._calls[name] += 1
+                self._seconds[name] += time.perf_counter() - start
+
+    def _pool(self):
+        self._check_fork()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.n_workers, thread_name_prefix="flywheel")
+            return self._executor
+
+    def _check_fork(self):
+        # threads do not survive fork: start a new pool and drop requests pending in the parent
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._executor = None
+            self._prefetching = None
+            self._cache = {k: f for k, f in self._cache.items() if f.done() and f.exception() is None}
+
+
+def _size_connection_pool(client, n_workers):
+    """Let the SDK's requests session keep a connection per thread (the SDK adapter and its retry settings
+    are kept, only its pool is enlarged)."""
+    session = getattr(getattr(getattr(client, "api_client", None), "rest_client", None), "session", None)
+    if session is None or not hasattr(session, "adapters"):
+        return
+    for adapter in session.adapters.values():
+        maxsize = getattr(adapter, "_pool_maxsize", None)
+        if maxsize is not None and maxsize < n_workers and hasattr(adapter, "init_poolmanager"):
+            adapter.init_poolmanager(n_workers, n_workers, block=getattr(adapter, "_pool_block", False))
@@ -0,0 +1,164 @@
+"""Track which files in the work directory are gear inputs and which were created or changed by the gear.
+
+Inputs are recorded from the archive central directory (name, size, CRC) when they are extracted, with
+the size and modification time found on disk right after extraction. Files written by each pipeline
+stage are recorded by scanning the stage directory before and after the stage runs. The outputs of the
+gear (new files and inputs changed in place) are then found with a single scan of the work directory.
+"""
+
+import logging
+import os
+import os.path as op
+import zlib
+from contextlib import contextmanager
+
+from utils import filesearch
+
+log = logging.getLogger(__name__)
+
+CRC_CHUNK_SIZE = 16 * 1024 ** 2
+
+
+class FileManifest:
+    """
+    Record of the files in a directory tree.
+    Args:
+        root (str): directory all paths are recorded relative to
+    """
+
+    def __init__(self, root):
+        self.root = op.abspath(str(root))
+        # relative path -> (size, mtime_ns, crc, symlink target or None)
+        self.inputs = {}
+        # (task, stage) -> relative paths created or rewritten by the stage
+        self.stages = {}
+
+    def relpath(self, path):
+        return op.relpath(op.abspath(str(path)), self.root)
+
+    def add_inputs(self, members):
+        """
+        Record extracted archive members.
+        Args:
+            members (list): (extracted path, ZipInfo) tuples, see utils.archive.extract_members
+        """
+        for path, zinfo in members:
+            st = os.lstat(path)
+            target = os.readlink(path) if op.islink(path) else None
+            self.inputs[self.relpath(path)] = (st.st_size, st.st_mtime_ns, zinfo.CRC, target)
+
+    def discard(self, path):
+        """Forget an input (e.g. removed by the gear)."""
+        self.inputs.pop(self.relpath(path), None)
+
+    def input_paths(self):
+        """Absolute paths of all recorded inputs."""
+        return [op.join(self.root, name) for name in self.inputs]
+
+    def changed(self, name, st):
+        """
+        Check if an input was changed in place: size and mtime are compared first, the CRC is only
+        computed if the file was rewritten with the same size.
+        Args:
+            name (str): relative path of the input
+            st (os.stat_result): current lstat of the file
+        Returns:
+            bool: True if the content differs from the extracted member
+        """
+        size, mtime_ns, crc, target = self.inputs[name]
+        path = op.join(self.root, name)
+
+        if target is not None or op.islink(path):
+            return not op.islink(path) or os.readlink(path) != target
+        if st.st_size != size:
+            return True
+        if st.st_mtime_ns == mtime_ns:
+            return False
+
+        return file_crc(path) != crc
+
+    @contextmanager
+    def stage(self, task, stage, directory):
+        """
+        Record the files created or rewritten in `directory` while the context is active.
+        Args:
+            task (str): task name
+            stage (str): pipeline stage name (e.g. trim, fix, restitch)
+            directory (str): directory the stage writes to
+        """
+        before = {name: (st.st_size, st.st_mtime_ns) for name, st in scan(directory).items()}
+        try:
+            yield
+        finally:
+            # stages write through subprocesses, drop cached directory listings
+            filesearch.invalidate(directory)
+            written = [self.relpath(op.join(directory, name)) for name, st in scan(directory).items()
+                       if before.get(name) != (st.st_size, st.st_mtime_ns)]
+            self.stages[(task, stage)] = sorted(written)
+            log.debug("Stage %s of %s wrote %s files", stage, task, len(written))
+
+    def input_crc(self, path):
+        """CRC of an input as extracted from the archive (None if the file is not an input)."""
+        entry = self.inputs.get(self.relpath(path))
+        return entry[2] if entry else None
+
+    def task_stages(self, task):
+        return {key: value for key, value in self.stages.items() if key[0] == task}
+
+    def outputs(self, exclude=None):
+        """
+        Files to store as gear outputs: files not extracted from the inputs and inputs changed in place.
+        Args:
+            exclude (callable): filename -> True to leave out a file (e.g. temporary files)
+        Returns:
+            list: paths relative to root
+        """
+        new, changed = [], []
+        for name, st in scan(self.root).items():
+            if exclude and exclude(op.basename(name)):
+                continue
+            if name not in self.inputs:
+                new.append(name)
+            elif self.changed(name, st):
+                changed.append(name)
+
+        log.info("Found %s new and %s changed files (%s inputs)", len(new), len(changed), len(self.inputs))
+        for name in changed:
+            log.info("Input changed in place: %s", name)
+
+        for (task, stage), written in self.stages.items():
+            log.debug("%s %s: %s files written", task, stage, len(written))
+
+        return new + changed
+
+
+def scan(directory):
+    """
+    Recursively list files and symbolic links below `directory` (symlinked directories are not followed).
+    Returns:
+        dict: relative path -> os.stat_result (lstat)
+    """
+    found = {}
+    stack = [""]
+    while stack:
+        rel = stack.pop()
+        try:
+            entries = os.scandir(op.join(directory, rel))
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                name = op.join(rel, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(name)
+                else:
+                    found[name] = entry.stat(follow_symlinks=False)
+    return found
+
+
+def file_crc(path):
+    crc = 0
+    with open(path, "rb") as f:
+        for buf in iter(lambda: f.read(CRC_CHUNK_SIZE), b""):
+            crc = zlib.crc32(buf, crc)
+    return crc
@@ -0,0 +1,135 @@
+"""Per-stage timing and resource profile of a gear run.
+
+Each profiled stage records:
+  - wall_s: elapsed wall time
+  - cpu_s / child_cpu_s: user + system CPU time of the gear process and of the commands it waited
+    for (hcp_fix, fix, workbench, ...)
+  - peak_rss_mb / child_peak_rss_mb: resident memory high-water mark of the gear process and of the
+    largest child at the end of the stage (the kernel does not reset it between stages)
+  - read_mb / write_mb: storage I/O of the gear process, including children it waited for
+
+Records are kept in memory for the process (task workers return theirs to the parent) and written as
+JSON and CSV with the job outputs.
+"""
+
+import csv
+import json
+import logging
+import os.path as op
+import resource
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+FIELDS = ["task", "stage", "wall_s", "cpu_s", "child_cpu_s", "peak_rss_mb", "child_peak_rss_mb", "read_mb",
+          "write_mb"]
+
+_records = []
+
+
+@contextmanager
+def stage(name, task=None):
+    """
+    Profile the enclosed block.
+    Args:
+        name (str): stage name
+        task (str): task name, None for job level stages
+    """
+    start = _sample()
+    try:
+        yield
+    finally:
+        end = _sample()
+        record = OrderedDict([
+            ("task", task or ""),
+            ("stage", name),
+            ("wall_s", round(end["wall"] - start["wall"], 3)),
+            ("cpu_s", round(end["cpu"] - start["cpu"], 3)),
+            ("child_cpu_s", round(end["child_cpu"] - start["child_cpu"], 3)),
+            ("peak_rss_mb", round(end["rss"], 1)),
+            ("child_peak_rss_mb", round(end["child_rss"], 1)),
+            ("read_mb", _delta(start, end, "read")),
+            ("write_mb", _delta(start, end, "write")),
+        ])
+        _records.append(record)
+        log.info("Profile %s%s: %.1f s wall, %.1f s cpu, %.1f s child cpu, peak rss %.0f MB",
+                 (task + " ") if task else "", name, record["wall_s"], record["cpu_s"], record["child_cpu_s"],
+                 max(record["peak_rss_mb"], record["child_peak_rss_mb"]))
+
+
+def records(task=None):
+    """Profile records (all, or only those of a task)."""
+    return [r for r in _records if task is None or r["task"] == task]
+
+
+def add_records(new_records):
+    """Add records made in another process (e.g. a task worker)."""
+    _records.extend(new_records)
+
+
+def reset():
+    """Drop all records (e.g. between benchmark runs in one process)."""
+    del _records[:]
+
+
+def summary(task=None):
+    """
+    Compact per-stage summary, e.g. for file info.
+    Returns:
+        dict: {stage: {wall_s, cpu_s, peak_rss_mb}}, cpu and memory include children
+    """
+    return {r["stage"]: {"wall_s": r["wall_s"], "cpu_s": round(r["cpu_s"] + r["child_cpu_s"], 3),
+                         "peak_rss_mb": max(r["peak_rss_mb"], r["child_peak_rss_mb"])}
+            for r in records(task)}
+
+
+def write(output_dir, basename):
+    """
+    Write all records to <output_dir>/<basename>.json and .csv.
+    Returns:
+        list: written files
+    """
+    json_file = op.join(output_dir, basename + ".json")
+    with open(json_file, "w") as f:
+        json.dump(_records, f, indent=2)
+
+    csv_file = op.join(output_dir, basename + ".csv")
+    with open(csv_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(_records)
+
+    log.info("Stage profile written to %s", op.basename(json_file))
+    return [json_file, csv_file]
+
+
+def _sample():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    sample = {
+        "wall": time.perf_counter(),
+        "cpu": own.ru_utime + own.ru_stime,
+        "child_cpu": children.ru_utime + children.ru_stime,
+        # ru_maxrss is in kilobytes on linux
+        "rss": own.ru_maxrss / 1024,
+        "child_rss": children.ru_maxrss / 1024,
+        "read": None,
+        "write": None,
+    }
+    try:
+        io = psutil.Process().io_counters()
+        sample["read"], sample["write"] = io.read_bytes, io.write_bytes
+    except (AttributeError, psutil.Error, OSError):
+        # not available on all platforms / containers
+        pass
+    return sample
+
+
+def _delta(start, end, key):
+    if start[key] is None or end[key] is None:
+        return None
+    return round((end[key] - start[key]) / 1024 ** 2, 1)
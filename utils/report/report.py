@@ -1,4 +1,4 @@
-from nilearn import image, plotting
+from nilearn import plotting
 from matplotlib import colormaps, rcParams
 import numpy as np
 import matplotlib.pyplot as plt
@@ -6,13 +6,44 @@ import pandas as pd
 import nibabel as nib
 import os
 import os.path as op
+import gzip
+import hashlib
+import json
+import re
+import glob
+import io
+import multiprocessing
 import shutil
-import subprocess as sp
 import logging
+import time
 import bs4
+from PIL import Image
+from utils.filesearch import searchfiles
+from concurrent.futures import ProcessPoolExecutor
 
 log = logging.getLogger(__name__)
 
+# components projected at once by the "mip" renderer
+MIP_BATCH = 16
+
+# carpet plot size limits (rows, columns) and bytes of the series read at a time
+CARPET_MAX_VOXELS = 10000
+CARPET_MAX_FRAMES = 1200
+CARPET_CHUNK_BYTES = 256 * 1024 ** 2
+
+# fingerprints of the inputs of each figure (in the ICA directory), figures are only redrawn when they change
+FIGURE_CACHE = "report_figures.json"
+# bump when the figure layout changes, so every figure is redrawn once
+FIGURE_VERSION = 1
+
+# default figure resolution (matplotlib's default) and image formats written by save_image
+FIGURE_DPI = 100
+IMAGE_FORMATS = ("png", "webp")
+
+# component figures are rendered here when combined in sprite sheets, and removed once the sheets are built
+COMPONENTS_DIR = "components"
+SPRITE_PREFIX = "components_"
+
 def get_spectrum(data: np.array, tr: float = 1.0):
     """
     Return the power spectrum and corresponding frequencies.
@@ -33,11 +64,242 @@ def get_spectrum(data: np.array, tr: float = 1.0):
     return power_spectrum[idx], freqs[idx]
 
 
-def component_images(analysis_dir, labels_file):
+def get_spectra(data: np.array, tr: float = 1.0):
+    """
+    Return the power spectra of every column of a 2D (time, component) array and corresponding frequencies,
+    computed with a single rfft (column i matches get_spectrum(data[:, i], tr)).
+    """
+    power_spectra = np.abs(np.fft.rfft(data, axis=0)) ** 2
+    freqs = np.fft.rfftfreq(power_spectra.shape[0] * 2 - 1, tr)
+    idx = np.argsort(freqs)
+    return power_spectra[idx], freqs[idx]
+
+
+def decompress_image(filename, outdir):
+    """
+    Write an uncompressed copy of a .nii.gz image so it can be memory-mapped. The copy is reused while it is
+    newer than the source. Returns the uncompressed filename.
+    """
+    out_filename = op.join(outdir, "tmp_" + op.basename(filename).replace(".nii.gz", ".nii"))
+    if not op.exists(out_filename) or op.getmtime(out_filename) < op.getmtime(filename):
+        with gzip.open(filename, "rb") as src, open(out_filename, "wb") as dst:
+            shutil.copyfileobj(src, dst, 16 * 1024 ** 2)
+    return out_filename
+
+
+class ComponentData:
+    """
+    Report inputs for a set of ICA components: time courses, power spectra (one batched rfft over the mixing
+    matrix) and lazy access to the component maps. Maps are read one at a time from the (memory-mapped) IC
+    image, so a subset can be sent to a worker without loading the 4D image.
+    """
+
+    def __init__(self, melodic_filename, mix, tr, indices=None, spectra=None, freqs=None):
+        self.melodic_filename = melodic_filename
+        self.mix = np.asarray(mix)
+        self.tr = tr
+        self.indices = list(range(self.mix.shape[1])) if indices is None else list(indices)
+        if spectra is None:
+            spectra, freqs = get_spectra(self.mix, tr)
+        self.spectra = spectra
+        self.freqs = freqs
+        self.time = np.linspace(0, self.mix.shape[0] * tr, self.mix.shape[0])
+        self._img = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_img"] = None
+        return state
+
+    @property
+    def img(self):
+        if self._img is None:
+            self._img = nib.load(self.melodic_filename, mmap=True)
+        return self._img
+
+    def subset(self, indices):
+        cols = [self.indices.index(i) for i in indices]
+        return ComponentData(self.melodic_filename, self.mix[:, cols], self.tr, indices, self.spectra[:, cols],
+                             self.freqs)
+
+    def timecourse(self, idx):
+        return self.mix[:, self.indices.index(idx)]
+
+    def spectrum(self, idx):
+        return self.spectra[:, self.indices.index(idx)]
+
+    def component_map(self, idx):
+        """3D image of one component."""
+        return self.img.slicer[..., idx]
+
+    def component_maps(self, indices):
+        """4D array of the (sorted) components in indices, read as one contiguous slab (or one map at a time
+        when the components are far apart, e.g. only a few figures are redrawn)."""
+        first = indices[0]
+        if indices[-1] - first + 1 > 2 * len(indices):
+            return np.stack([np.asanyarray(self.img.dataobj[..., i]) for i in indices], axis=-1)
+        data = np.asanyarray(self.img.dataobj[..., first:indices[-1] + 1])
+        return data[..., [i - first for i in indices]]
+
+
+def signed_mip(data, axis):
+    """
+    Signed maximum intensity projection: the value with the largest magnitude along `axis`.
+    Works on any number of trailing (component) dimensions at once.
+    """
+    idx = np.expand_dims(np.abs(data).argmax(axis=axis), axis)
+    return np.take_along_axis(data, idx, axis=axis).squeeze(axis)
+
+
+def glass_brain_projections(data):
+    """
+    Sagittal, coronal and axial signed projections of every component in a 4D (x, y, z, component) array.
+    Returns:
+        list of arrays shaped (y, z, n), (x, z, n), (x, y, n)
+    """
+    return [signed_mip(data, axis) for axis in (0, 1, 2)]
+
+
+def plot_mip(ax, projections, zooms, vmax, threshold, background=None):
+    """
+    Draw three orthogonal projections (see glass_brain_projections) side by side in `ax`, a lightweight
+    alternative to nilearn plot_glass_brain.
+    """
+    ax.axis("off")
+    # vertical / horizontal voxel size for sagittal (y, z), coronal (x, z) and axial (x, y) views
+    aspects = [zooms[2] / zooms[1], zooms[2] / zooms[0], zooms[1] / zooms[0]]
+
+    for i, proj in enumerate(projections):
+        sub = ax.inset_axes([i / 3, 0, 1 / 3, 0.8])
+        if background is not None:
+            sub.imshow(background[i].T, origin="lower", cmap="Greys", alpha=0.3, aspect=aspects[i],
+                       interpolation="nearest")
+        sub.imshow(np.ma.masked_inside(proj, -threshold, threshold).T, origin="lower", cmap=colormaps['jet'],
+                   vmin=-vmax, vmax=vmax, aspect=aspects[i], interpolation="nearest")
+        sub.axis("off")
+
+
+def load_figure_cache(analysis_dir):
+    """Fingerprints of the figures in analysis_dir/figures, by figure filename."""
+    filename = op.join(analysis_dir, FIGURE_CACHE)
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+        return cache if cache.get("version") == FIGURE_VERSION else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_figure_cache(analysis_dir, cache):
+    filename = op.join(analysis_dir, FIGURE_CACHE)
+    cache["version"] = FIGURE_VERSION
+    with open(filename + ".tmp", "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(filename + ".tmp", filename)
+
+
+def is_current(cache, fname, fingerprint):
+    """True if the figure exists and was drawn from the same inputs."""
+    return cache.get(op.basename(fname)) == fingerprint and op.exists(fname)
+
+
+def component_fingerprint(data, idx, title, color, renderer, background=None, dpi=FIGURE_DPI):
+    """
+    Hash of everything drawn in a component figure: the component map, its time course, the TR, the title
+    (number, label and variance), the colour, the renderer (and mip background image) and the resolution.
+    """
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(data.img.dataobj[..., idx]).tobytes())
+    h.update(np.ascontiguousarray(data.timecourse(idx)).tobytes())
+    h.update(json.dumps([float(data.tr), title, color, renderer, background, dpi]).encode())
+    return h.hexdigest()
+
+
+def file_fingerprint(*filenames):
+    """Hash of the path, size and modification time of files (series too large to hash in full)."""
+    stats = [(op.abspath(f), op.getsize(f), op.getmtime(f)) for f in filenames]
+    return hashlib.sha1(json.dumps(stats).encode()).hexdigest()
+
+
+def save_image(img, fname):
+    """
+    Write a PIL image flattened to RGB, encoded by extension: optimized PNG or lossless WebP (both lossless;
+    figures are plots on a white background, so the alpha channel is dropped).
+    """
+    img = img.convert("RGB")
+    if fname.endswith(".webp"):
+        img.save(fname, format="WEBP", lossless=True, quality=80, method=4)
+    else:
+        img.save(fname, format="PNG", optimize=True)
+
+
+def save_figure(fig, fname, dpi=FIGURE_DPI, **kwargs):
+    """Save a matplotlib figure with save_image (kwargs are passed to savefig, e.g. bbox_inches)."""
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=dpi, **kwargs)
+    buf.seek(0)
+    with Image.open(buf) as img:
+        save_image(img, fname)
+
+
+def build_sprites(files, outdir, per_sheet, image_format="png"):
+    """
+    Stack component figures vertically into sprite sheets of per_sheet figures, so the report loads a few
+    images instead of one per component. A sheet is only rewritten when one of its figures is newer.
+    Args:
+        files (list): component figures, in report order
+        outdir (str): directory of the sheets
+        per_sheet (int): figures per sheet
+        image_format (str): "png" or "webp"
+    Returns:
+        list: (sheet filename, vertical offset, width, height) of each figure
+    """
+    entries = []
+    for n, start in enumerate(range(0, len(files), per_sheet)):
+        members = files[start:start + per_sheet]
+        sheet = op.join(outdir, "%s%02d.%s" % (SPRITE_PREFIX, n, image_format))
+
+        sizes = []
+        for f in members:
+            with Image.open(f) as img:
+                sizes.append(img.size)
+
+        offset = 0
+        for w, h in sizes:
+            entries.append((sheet, offset, w, h))
+            offset += h
+
+        if op.exists(sheet) and op.getmtime(sheet) >= max(op.getmtime(f) for f in members):
+            with Image.open(sheet) as img:
+                if img.size == (max(w for w, _ in sizes), offset):
+                    continue
+
+        canvas = Image.new("RGB", (max(w for w, _ in sizes), offset), "white")
+        y = 0
+        for f, (_, h) in zip(members, sizes):
+            with Image.open(f) as img:
+                canvas.paste(img.convert("RGB"), (0, y))
+            y += h
+        save_image(canvas, sheet)
+
+    return entries
+
+
+def component_images(analysis_dir, labels_file, n_workers=1, backend="Agg", renderer="nilearn", dpi=FIGURE_DPI,
+                     image_format="png", figures_dir="figures"):
     """
     Creates static figure of component classification and features. Used for visual inspection of the results.
     Inputs:
         analysis_dir - Pathlike or sting
+        labels_file - fix4melview or hand_labels_noise file
+        n_workers - number of processes used to render component figures
+        backend - (headless) matplotlib backend used for rendering
+        renderer - component map renderer: "nilearn" (plot_glass_brain) or "mip" (numpy projections)
+        dpi - figure resolution
+        image_format - "png" or "webp"
+        figures_dir - output directory (relative to analysis_dir)
+    Returns:
+        list of component figure filenames, in component order (None if the ICA results are missing)
     """
     # all filename are consistent across runs
     melodic_filename = op.join(analysis_dir, 'filtered_func_data.ica', 'melodic_IC.nii.gz')
@@ -58,7 +320,6 @@ def component_images(analysis_dir, labels_file):
     mmix = pd.read_csv(mmix_filename, delim_whitespace=True, header=None)
     mean_func = nib.load(meanfunc_filename)
     tr = mean_func.header["pixdim"][4]
-    time = np.linspace(0, mmix.shape[0] * tr, mmix.shape[0])
 
     stats = pd.read_csv(stats_filename, delim_whitespace=True, header=None)
 
@@ -71,16 +332,10 @@ def component_images(analysis_dir, labels_file):
             s = f.read()
         noise_comps = s.replace("[", "").replace("]", "").replace("\n", "").split(", ")
 
-    # loop through all components in 4D melodicIC file and create plot
-    for idx, img in enumerate(image.iter_img(melodic_filename)):
-
-        # compute values for plotting...
-        imgmax = 0.75 * np.abs(img.get_fdata()).max()
-        imgmin = imgmax * -1
-
-        allplot = plt.figure(figsize=(12, 3))
-        plt.subplots_adjust(hspace=0.8)
-        ax1 = plt.subplot2grid((2, 2), (0, 0), rowspan=2, colspan=1, fig=allplot)
+    # one entry per component in 4D melodicIC file: (index, title, color, output file)
+    os.makedirs(op.join(analysis_dir, figures_dir), exist_ok=True)
+    components = []
+    for idx in range(mmix.shape[1]):
 
         # add label
         # CXX [noise]: Tot. var. expl XX%
@@ -94,16 +349,94 @@ def component_images(analysis_dir, labels_file):
             comp_label = "Noise" if str(idx+1) in noise_comps else "Signal"
             compnum = str(idx + 1)
 
-        if comp_type == True:
-            plt_title = (
-                f"Comp. {compnum} [{comp_label}]: variance: {comp_var}%"
-            )
-            plotcolor = 'red'
-        elif comp_type == False:
-            plt_title = (
-                f"Comp. {compnum} [{comp_label}]: variance: {comp_var}%"
-            )
-            plotcolor = 'green'
+        plt_title = f"Comp. {compnum} [{comp_label}]: variance: {comp_var}%"
+        plotcolor = 'red' if comp_type == True else 'green'
+
+        fname = os.path.join(analysis_dir, figures_dir, "C" + str(compnum).zfill(2) + "." + image_format)
+        components.append((idx, plt_title, plotcolor, fname))
+
+    # decompress the IC maps once so components can be read lazily from a memory map
+    melodic_nii = decompress_image(melodic_filename, analysis_dir)
+    data = ComponentData(melodic_nii, mmix.to_numpy(), tr)
+
+    # only redraw figures whose inputs changed (e.g. relabeled components when rerunning a cleanup)
+    cache = load_figure_cache(analysis_dir)
+    background = file_fingerprint(meanfunc_filename) if renderer == "mip" else None
+    fingerprints = {fname: component_fingerprint(data, idx, plt_title, plotcolor, renderer, background, dpi)
+                    for idx, plt_title, plotcolor, fname in components}
+    files = [c[3] for c in components]
+    stale = [c for c in components if not is_current(cache, c[3], fingerprints[c[3]])]
+    log.info("Component figures: %s up to date, %s to render", len(components) - len(stale), len(stale))
+    if not stale:
+        os.remove(melodic_nii)
+        return files
+    components = stale
+
+    # split components into contiguous chunks, each worker only loads its own component maps
+    nchunks = 1 if n_workers <= 1 else min(len(components), n_workers * 4)
+    size = -(-len(components) // max(nchunks, 1))
+    chunks = [components[i:i + size] for i in range(0, len(components), size)]
+    jobs = [(data.subset([x[0] for x in c]), c, backend, renderer, meanfunc_filename, dpi) for c in chunks]
+
+    try:
+        if n_workers <= 1:
+            for job in jobs:
+                _render_components(*job)
+        else:
+            log.info("Rendering %s component figures using %s workers", len(components), n_workers)
+            ctx = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as pool:
+                for future in [pool.submit(_render_components, *job) for job in jobs]:
+                    future.result()
+    finally:
+        os.remove(melodic_nii)
+
+    cache.update({op.basename(fname): fingerprints[fname] for _, _, _, fname in components})
+    save_figure_cache(analysis_dir, cache)
+
+    return files
+
+
+def _render_components(data, components, backend="Agg", renderer="nilearn", background_filename=None,
+                       dpi=FIGURE_DPI):
+    """
+    Render the figures for a contiguous subset of components (runs in a worker process when rendering in parallel).
+    Inputs:
+        data - ComponentData for (at least) these components
+        components - list of (index, title, color, output file)
+    """
+    plt.switch_backend(backend)
+
+    if renderer == "mip":
+        zooms = data.img.header.get_zooms()[:3]
+        background = None
+        if background_filename and op.exists(background_filename):
+            mean_func = np.abs(nib.load(background_filename).get_fdata())
+            background = [mean_func.max(axis=axis) for axis in (0, 1, 2)]
+
+    for col, (idx, plt_title, plotcolor, fname) in enumerate(components):
+        timecourse = data.timecourse(idx)
+
+        if renderer == "mip":
+            # project a batch of maps at once, keeping memory bounded to MIP_BATCH components
+            if col % MIP_BATCH == 0:
+                batch = [x[0] for x in components[col:col + MIP_BATCH]]
+                maps = data.component_maps(batch)
+                projections = glass_brain_projections(maps)
+                maxima = np.abs(maps).reshape(-1, maps.shape[-1]).max(axis=0)
+                del maps
+            imgmax = 0.75 * maxima[col % MIP_BATCH]
+        else:
+            # read only this component map
+            img = data.component_map(idx)
+            imgmax = 0.75 * np.abs(img.get_fdata()).max()
+
+        # compute values for plotting...
+        imgmin = imgmax * -1
+
+        allplot = plt.figure(figsize=(12, 3))
+        plt.subplots_adjust(hspace=0.8)
+        ax1 = plt.subplot2grid((2, 2), (0, 0), rowspan=2, colspan=1, fig=allplot)
 
         rcParams['text.color'] = plotcolor
         rcParams['axes.titlecolor'] = plotcolor
@@ -115,12 +448,16 @@ def component_images(analysis_dir, labels_file):
         title.set_y(0.8)
 
         # glass brain
-        plotting.plot_glass_brain(img, threshold=0.1 * imgmax, cmap=colormaps['jet'], vmax=imgmax, vmin=imgmin,
-                                  plot_abs=False, axes=ax1)
+        if renderer == "mip":
+            plot_mip(ax1, [p[..., col % MIP_BATCH] for p in projections], zooms, vmax=imgmax,
+                     threshold=0.1 * imgmax, background=background)
+        else:
+            plotting.plot_glass_brain(img, threshold=0.1 * imgmax, cmap=colormaps['jet'], vmax=imgmax, vmin=imgmin,
+                                      plot_abs=False, axes=ax1)
 
         # time series
         ax2 = plt.subplot2grid((2, 2), (0, 1), rowspan=1, colspan=1, fig=allplot)
-        ax2.plot(time, mmix[idx], linewidth=0.5, color=plotcolor)
+        ax2.plot(data.time, timecourse, linewidth=0.5, color=plotcolor)
 
         ax2.set_xlabel("seconds")
         ax2.spines['right'].set_visible(False)
@@ -131,10 +468,9 @@ def component_images(analysis_dir, labels_file):
 
         # fft
         ax3 = plt.subplot2grid((2, 2), (1, 1), rowspan=1, colspan=1, fig=allplot)
-        spectrum, freqs = get_spectrum(mmix[idx], tr)
-        ax3.plot(freqs, spectrum, color=plotcolor)
+        ax3.plot(data.freqs, data.spectrum(idx), color=plotcolor)
         ax3.set_xlabel("Hz")
-        ax3.set_xlim(freqs[0], freqs[-1])
+        ax3.set_xlim(data.freqs[0], data.freqs[-1])
 
         ax3.spines['right'].set_visible(False)
         ax3.spines['top'].set_visible(False)
@@ -143,22 +479,69 @@ def component_images(analysis_dir, labels_file):
         plt.tick_params(left=False, bottom=False, labelleft=False)
 
         # save figure...
-        os.makedirs(op.join(analysis_dir, "figures"), exist_ok=True)
-        fname = os.path.join(analysis_dir, "figures", "C" + str(compnum).zfill(2) + ".png")
-        plt.savefig(fname, format='png', bbox_inches='tight', pad_inches=0.25)
+        save_figure(allplot, fname, dpi=dpi, bbox_inches='tight', pad_inches=0.25)
 
         plt.close(allplot)
 
-    return
-
 
-def carpet_plots(input_img_filename, output_img_filename, analysis_dir):
+def carpet_matrix(filename, max_voxels=CARPET_MAX_VOXELS, max_frames=CARPET_MAX_FRAMES):
+    """
+    Build a downsampled (voxel, time) carpet from a 4D NIfTI without loading the full series. Frames are read
+    in chunks of at most CARPET_CHUNK_BYTES (memory-mapped for .nii, one sequential pass for .nii.gz). Voxels
+    are a fixed stride through the brain mask (non-zero voxels of the first frame) and frames a fixed stride
+    in time, so the carpet is reproducible and its size bounded by max_voxels x max_frames.
+    Returns:
+        carpet (voxels, frames) array and the time between carpet columns in seconds
+    """
+    img = nib.load(filename, mmap=True, keep_file_open=True)
+    shape = img.shape
+    nvox, ntime = int(np.prod(shape[:3])), shape[3]
+    tr = img.header["pixdim"][4]
+
+    voxels = np.flatnonzero(np.asanyarray(img.dataobj[..., 0]).ravel(order="F"))
+    voxels = voxels[::max(1, -(-len(voxels) // max_voxels))]
+    tstride = max(1, -(-ntime // max_frames))
+    frames = np.arange(0, ntime, tstride)
+
+    carpet = np.empty((len(voxels), len(frames)), dtype=np.float32)
+    chunk = max(1, CARPET_CHUNK_BYTES // (nvox * img.get_data_dtype().itemsize))
+    for start in range(0, ntime, chunk):
+        stop = min(ntime, start + chunk)
+        keep = frames[(frames >= start) & (frames < stop)]
+        if not len(keep):
+            continue
+        block = np.asanyarray(img.dataobj[..., start:stop]).reshape(nvox, stop - start, order="F")
+        carpet[:, keep // tstride] = block[voxels][:, keep - start]
+
+    return carpet, tr * tstride
+
+
+def plot_carpet_matrix(ax, carpet, step, title):
+    """Plot a carpet from carpet_matrix: linearly detrended rows, gray scale clipped at the 2.5/97.5 percentiles."""
+    x = np.arange(carpet.shape[1])
+    if carpet.shape[1] > 1:
+        coef = np.polynomial.polynomial.polyfit(x, carpet.T, 1)
+        carpet = carpet - np.polynomial.polynomial.polyval(x, coef)
+
+    vmin, vmax = np.percentile(carpet, [2.5, 97.5]) if carpet.size else (0, 1)
+    ax.imshow(carpet, cmap="gray", aspect="auto", interpolation="nearest", vmin=vmin, vmax=vmax,
+              extent=[0, carpet.shape[1] * step, carpet.shape[0], 0])
+    ax.set_title(title)
+    ax.set_xlabel("seconds")
+    ax.set_yticks([])
+
+
+def carpet_plots(input_img_filename, output_img_filename, analysis_dir, dpi=FIGURE_DPI, image_format="png"):
     """
     Creates static figure of fMRI image before and after denoising. Used for visual inspection of the results.
     Inputs:
         input_img_filename - functional image used for ICAAROMA
         output_img_filename - denoised output from ICAAROMA
         analysis_dir - Pathlike or sting
+        dpi - figure resolution
+        image_format - "png" or "webp"
+    Returns:
+        figure filename (None if an input is missing)
     """
 
     if not op.exists(input_img_filename):
@@ -169,43 +552,71 @@ def carpet_plots(input_img_filename, output_img_filename, analysis_dir):
         log.error("Input image passed for report generation does not exist.")
         return
 
+    fname = os.path.join(analysis_dir, "figures", "carpetplot." + image_format)
+    cache = load_figure_cache(analysis_dir)
+    fingerprint = file_fingerprint(input_img_filename, output_img_filename) + "_%s" % dpi
+    if is_current(cache, fname, fingerprint):
+        log.info("Carpet plot up to date")
+        return fname
+
     carpetplot = plt.figure(figsize=(12, 6))
     plt.subplots_adjust(hspace=0.25)
 
     ax1 = plt.subplot2grid((2, 1), (0, 0), fig=carpetplot)
-    func = image.load_img(input_img_filename)
-    tr = func.header["pixdim"][4]
-    plotting.plot_carpet(
-        func,
-        t_r=tr,
-        standardize=False,
-        axes=ax1,
-        title="Before"
-    )
-    plt.axis('off');
+    carpet, step = carpet_matrix(input_img_filename)
+    plot_carpet_matrix(ax1, carpet, step, "Before")
 
     ax2 = plt.subplot2grid((2, 1), (1, 0), fig=carpetplot)
-    func = image.load_img(output_img_filename)
-    tr = func.header["pixdim"][4]
-    plotting.plot_carpet(
-        func,
-        t_r=tr,
-        standardize=False,
-        axes=ax2,
-        title="After"
-    )
-
-    plt.axis('off');
+    carpet, step = carpet_matrix(output_img_filename)
+    plot_carpet_matrix(ax2, carpet, step, "After")
 
     # save figure...
     os.makedirs(op.join(analysis_dir, "figures"), exist_ok=True)
-    fname = os.path.join(analysis_dir, "figures", "carpetplot.png")
-    plt.savefig(fname, format='png')
+    save_figure(carpetplot, fname, dpi=dpi)
+    plt.close(carpetplot)
+
+    cache[op.basename(fname)] = fingerprint
+    save_figure_cache(analysis_dir, cache)
+
+    return fname
+
 
-    return
+def component_number(filename):
+    """Component number from a figure name, e.g. figures/C07.png -> 7"""
+    return int(re.sub(r"\D", "", op.basename(filename)) or 0)
 
 
-def report(path, cmd):
+def image_size(filename):
+    """(width, height) from the image header."""
+    with Image.open(filename) as img:
+        return img.size
+
+
+def remove_unused_figures(figures_dir, used):
+    """Remove files of figures_dir not referenced by the report (e.g. figures of another format or layout), so
+    they are not archived with it."""
+    used = {op.abspath(f) for f in used}
+    for f in glob.glob(op.join(figures_dir, "*")):
+        if op.isfile(f) and op.abspath(f) not in used:
+            os.remove(f)
+
+
+def report(path, cmd, n_workers=1, renderer="nilearn", labels_file=None, clean_file=None, dpi=FIGURE_DPI,
+           image_format="png", sprite_size=0):
+    """
+    Generate the html report of an ICA-FIX run: carpet plot and one figure per component.
+    Inputs:
+        path - task directory
+        cmd - command shown in the methods section
+        dpi - figure resolution
+        image_format - "png" or "webp" (both lossless)
+        sprite_size - number of component figures combined per sprite sheet, 0 for one image per component
+    Returns:
+        the ICA directory holding the report
+    """
+    start = time.perf_counter()
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError("Unsupported report image format: %s" % image_format)
 
     # generate report for ICA-AROMA
     icadir = searchfiles(os.path.join(path, "*hp*.ica"), dryrun=False, find_first=True)
@@ -216,39 +627,55 @@ def report(path, cmd):
     shutil.copy2(op.join(op.dirname(op.realpath(__file__)), "report.html"), report_file)
 
     # create figures...
-    if os.path.exists(op.join(icadir,"hand_labels_noise.txt")):
+    if labels_file:
+        log.info("Using component labels %s", os.path.basename(labels_file))
+    elif os.path.exists(op.join(icadir,"hand_labels_noise.txt")):
         labels_file = op.join(icadir, "hand_labels_noise.txt")
     else:
         labels_file = searchfiles(os.path.join(icadir, "fix4melview*.txt"), dryrun=False, find_recent=True)
-    component_images(icadir, labels_file)
+    figures_dir = COMPONENTS_DIR if sprite_size else "figures"
+    files = component_images(icadir, labels_file, n_workers=n_workers, renderer=renderer, dpi=dpi,
+                             image_format=image_format, figures_dir=figures_dir) or []
 
     hpfile = icadir.replace(".ica", ".nii.gz")
-    clean_file = searchfiles(os.path.join(os.path.dirname(icadir), "*_clean.nii.gz"), dryrun=False,find_recent=True)
-    carpet_plots(hpfile, clean_file, icadir)
-
-    # update list of images for report...
-    cwd = os.getcwd()
-    os.chdir(icadir)
-
-    # return in order all files
-    cmd = "ls -dtr figures/C*.png"
-    terminal = sp.Popen(
-        cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-    )
-    stdout, stderr = terminal.communicate()
-    files = stdout.strip("\n").split("\n")
-
-    os.chdir(cwd)
+    if not clean_file:
+        clean_file = searchfiles(os.path.join(os.path.dirname(icadir), "*_clean.nii.gz"), dryrun=False,find_recent=True)
+    carpet_file = carpet_plots(hpfile, clean_file, icadir, dpi=dpi, image_format=image_format)
+
+    # list of images for report, in component order
+    files = sorted(files, key=component_number)
+    os.makedirs(op.join(icadir, "figures"), exist_ok=True)
+    if sprite_size and files:
+        entries = build_sprites(files, op.join(icadir, "figures"), sprite_size, image_format)
+        # the sheets hold the figures, the single images are not stored with the results
+        shutil.rmtree(op.join(icadir, COMPONENTS_DIR), ignore_errors=True)
+    else:
+        entries = [(f, 0) + image_size(f) for f in files]
 
     # load html into python
     with open(report_file) as inf:
         txt = inf.read()
         soup = bs4.BeautifulSoup(txt)
 
-    for f in files:
-        new_tag = soup.new_tag("img", src=f)
-        elm = soup.find(attrs={'id': 'components'})
-        elm.append(new_tag)
+    carpet = soup.find(attrs={'id': 'carpet'})
+    if carpet_file:
+        carpet["src"] = op.relpath(carpet_file, icadir)
+    else:
+        carpet.decompose()
+
+    # images below the fold are only fetched when scrolled to; a sprite is shown through a window of the
+    # size of one component figure
+    elm = soup.find(attrs={'id': 'components'})
+    for f, offset, width, height in entries:
+        img = soup.new_tag("img", src=op.relpath(f, icadir), loading="lazy", decoding="async")
+        if sprite_size:
+            img["style"] = "margin-top: -%spx" % offset
+            frame = soup.new_tag("div", attrs={"class": "sprite"}, style="width: %spx; height: %spx" % (width, height))
+            frame.append(img)
+            elm.append(frame)
+        else:
+            img["width"], img["height"] = width, height
+            elm.append(img)
 
     # replace the command used to run ica-aroma
     result = soup.find(attrs={'id': 'cmd'})
@@ -257,32 +684,9 @@ def report(path, cmd):
     with open(report_file, "w") as outf:
         outf.write(str(soup))
 
-    return icadir
-
-
-def searchfiles(path, dryrun=False, find_first=False, find_recent=False) -> list[str]:
-
-    if find_recent:
-        options=" -dt "
-    else:
-        options=" -d "
-    cmd = "ls" + options + path
-
-    log.debug("\n %s", cmd)
-
-    if not dryrun:
-        terminal = sp.Popen(
-            cmd, shell=True, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True
-        )
-        stdout, stderr = terminal.communicate()
-        log.debug("\n %s", stdout)
-        log.debug("\n %s", stderr)
-
-        files = stdout.strip("\n").split("\n")
-
-        if find_first or find_recent:
-            files = files[0]
-
-        return files
-
+    used = [f for f, _, _, _ in entries] + ([carpet_file] if carpet_file else [])
+    remove_unused_figures(op.join(icadir, "figures"), used)
+    log.info("Report generated in %.1f s: %s image(s), %.1f MB", time.perf_counter() - start, len(set(used)),
+             sum(op.getsize(f) for f in set(used)) / 1024 ** 2)
 
+    return icadir
@@ -0,0 +1,152 @@
+"""Memory-aware admission of tasks run in parallel.
+
+Before any work starts, the headers (only) of each task's volume and CIFTI series are read to estimate
+the peak memory and scratch disk of the task. Estimates follow the data size (voxels x time points) of
+the step with the largest footprint in the gear mode:
+  - hcpfix: MELODIC on the volume series (float32 data plus PCA / whitening workspace), then FIX
+    feature extraction and cleanup in the MATLAB runtime (double precision series)
+  - fix cleanup / hand labeled: `fix -c` feature extraction and `fix -a` cleanup in the MATLAB runtime,
+    or the block-wise numpy engine (see utils.denoise), whose memory does not depend on the series size
+
+The estimates are deliberately conservative: the full volume is counted (MELODIC and FIX only use the
+brain mask). Tasks are admitted largest first whenever their estimate fits in the unused part of the
+memory budget; a task larger than the whole budget runs on its own.
+"""
+
+import logging
+import os.path as op
+from collections import namedtuple
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+
+from utils.denoise import BLOCK_BYTES
+from utils.filesearch import find_first
+
+log = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+# MATLAB runtime (FIX) and python interpreter footprint
+MCR_BYTES = 2 * GB
+PYTHON_BYTES = GB // 2
+
+# in-memory copies of the series (float32 for MELODIC, float64 for FIX)
+MELODIC_COPIES = 4
+FIX_COPIES = 3
+
+# copies of the (compressed) input series written to scratch: hp series, clean series, ICA working files
+HCPFIX_SCRATCH_COPIES = 3
+CLEANUP_SCRATCH_COPIES = 1
+
+TaskEstimate = namedtuple("TaskEstimate", ["index", "task", "voxels", "grayordinates", "timepoints", "memory",
+                                           "scratch"])
+
+
+def series_size(filename):
+    """
+    Data size of a 4D NIfTI or CIFTI-2 dtseries from its header.
+    Returns:
+        tuple: (voxels or grayordinates, time points, bytes on disk), zeros if the file is missing
+    """
+    if not filename or not op.exists(filename):
+        return 0, 0, 0
+    img = nib.load(filename)
+    if isinstance(img, nib.Cifti2Image):
+        ntime, nelem = img.shape
+    else:
+        nelem, ntime = int(np.prod(img.shape[:3])), int(img.shape[3]) if len(img.shape) > 3 else 1
+    return int(nelem), int(ntime), op.getsize(filename)
+
+
+def estimate_task(index, row, mode, engine="fix"):
+    """
+    Peak memory and scratch estimate of one task.
+    Args:
+        index (int): task index (row number of the task table)
+        row (pd.Series): task table row (taskdir, preprocessed_files, surface_files)
+        mode (str): gear mode
+        engine (str): cleanup engine, "fix" or "numpy"
+    Returns:
+        TaskEstimate
+    """
+    voxels, ntime, volume_bytes = series_size(row["preprocessed_files"])
+    surface_file = row.get("surface_files") or find_first(op.join(row["taskdir"], "*_Atlas_hp*.dtseries.nii"))
+    grayordinates, _, surface_bytes = series_size(surface_file)
+
+    melodic = MELODIC_COPIES * voxels * ntime * 4
+    fix = MCR_BYTES + FIX_COPIES * max(voxels, grayordinates) * ntime * 8
+    if mode == "hcpfix":
+        memory = PYTHON_BYTES + max(melodic, fix)
+        scratch = HCPFIX_SCRATCH_COPIES * (volume_bytes + surface_bytes)
+    else:
+        # feature extraction (fix -c) reads the volume series once in single precision
+        classify = MCR_BYTES + 2 * voxels * ntime * 4 if mode == "fix cleanup" else 0
+        cleanup = PYTHON_BYTES + 3 * BLOCK_BYTES if engine == "numpy" else fix
+        memory = PYTHON_BYTES + max(classify, cleanup)
+        scratch = CLEANUP_SCRATCH_COPIES * (volume_bytes + surface_bytes)
+        if engine == "numpy":
+            # the engine maps an uncompressed copy of the series
+            scratch += voxels * ntime * 4
+
+    return TaskEstimate(index, Path(row["taskdir"]).name, voxels, grayordinates, ntime, int(memory), int(scratch))
+
+
+def estimate_tasks(files, mode, engine="fix"):
+    """Estimates of all tasks in the task table, in table order."""
+    return [estimate_task(i, row, mode, engine) for i, (_, row) in enumerate(files.iterrows())]
+
+
+def admission_order(estimates):
+    """Task indices, largest memory estimate first."""
+    return [e.index for e in sorted(estimates, key=lambda e: (-e.memory, e.index))]
+
+
+def admit(pending, estimates, free_bytes, slots, idle):
+    """
+    Select pending tasks to start now.
+    Args:
+        pending (list): task indices not yet started, in admission order
+        estimates (list): TaskEstimate of every task (by index)
+        free_bytes (int): unused part of the memory budget
+        slots (int): free workers
+        idle (bool): nothing is running (the largest pending task is started even if it exceeds the budget)
+    Returns:
+        list: task indices to start
+    """
+    selected = []
+    for index in pending:
+        if len(selected) >= slots:
+            break
+        if estimates[index].memory <= free_bytes:
+            selected.append(index)
+            free_bytes -= estimates[index].memory
+
+    if not selected and idle and pending and slots > 0:
+        selected.append(pending[0])
+
+    return selected
+
+
+def log_plan(estimates, budget, workers, scratch_free=None):
+    """Log the estimates, the admission order and the tasks started first."""
+    order = admission_order(estimates)
+    first = admit(order, estimates, budget, workers, True)
+
+    lines = ["%-45s %12s %7s %10s %10s %s" % ("task", "voxels", "frames", "memory", "scratch", "")]
+    for index in order:
+        e = estimates[index]
+        note = "start" if index in first else "queued"
+        if e.memory > budget:
+            note += ", exceeds budget (runs alone)"
+        lines.append("%-45s %12s %7s %8.1f G %8.1f G %s" % (e.task, e.voxels + e.grayordinates, e.timepoints,
+                                                             e.memory / GB, e.scratch / GB, note))
+    log.info("Task plan: memory budget %.1f G, %s workers, %s task(s) started first (largest first)\n%s",
+             budget / GB, workers, len(first), "\n".join(lines))
+
+    scratch = sum(e.scratch for e in estimates)
+    if scratch_free is not None and scratch > scratch_free:
+        log.warning("Estimated scratch use %.1f G exceeds free space %.1f G", scratch / GB, scratch_free / GB)
+
+    return order
@@ -0,0 +1,301 @@
+"""Trim and restitch frames along the time axis of 4D NIfTI and CIFTI-2 dtseries files without FSL or
+workbench round trips.
+
+NIfTI stores 4D data with time as the slowest varying axis, so every frame is a contiguous block of
+bytes following the header. Trimming and prepending frames is therefore a streamed byte copy of the
+on-disk data with an updated header: no decoding, rescaling or full copies of the original series.
+
+CIFTI-2 dtseries store the series axis fastest (each grayordinate's time course is contiguous), so
+frames are trimmed or prepended on blocks of grayordinates while streaming through the file once.
+
+Outputs compared with the FSL / workbench commands they replace:
+  - NIfTI (`fslroi <in> <out> <n> -1`, `fslroi <in> <dummy> 0 <n>`, `fslmerge -t`): same data, data type
+    and scaling, and the header of the input with dim[4] updated. fslroi / fslmerge rewrite the header
+    themselves (e.g. descrip, and FSLOUTPUTTYPE decides the compression); those fields are kept from the
+    input here.
+  - CIFTI (`wb_command -cifti-convert -to-nifti`, fslroi / fslmerge, then
+    `wb_command -cifti-convert -from-nifti <nifti> <template> <out> -reset-timepoints <step> 0`): same data
+    values, brain models and series axis (NumberOfSeriesPoints updated, SeriesStart 0, SeriesStep and
+    SeriesUnit unchanged). The differences are:
+      - data type: the on-disk type and scaling of the input are kept; workbench writes FLOAT32 (the same
+        values for the FLOAT32 dtseries written by the HCP pipelines)
+      - NIfTI-2 header: copied from the input with dim[5] and vox_offset updated; workbench writes a new
+        header
+      - CIFTI XML: re-serialised by nibabel (whitespace, attribute order and number formatting differ) and
+        matrix metadata kept as is; workbench adds its provenance entries (Provenance, ProgramProvenance,
+        ParentProvenance, WorkingDirectory) to the matrix metadata
+      - SeriesStep: kept exactly, the workbench path passes the step through the text output of
+        `-file-information -only-step-interval`
+"""
+
+import logging
+import os
+import os.path as op
+
+import nibabel as nib
+import numpy as np
+from nibabel.cifti2.parse_cifti2 import Cifti2Extension
+from nibabel.nifti1 import Nifti1Extensions
+from nibabel.openers import ImageOpener
+from nibabel.volumeutils import array_to_file
+
+log = logging.getLogger(__name__)
+
+# bytes copied per read/write when streaming frames
+CHUNK_SIZE = 64 * 1024 ** 2
+
+
+def split_volume_frames(in_file, nframes, dummy_file, out_file=None):
+    """Remove the first `nframes` frames from a 4D NIfTI, storing only the removed frames separately.
+
+    The input is read once: leading frames are streamed to `dummy_file`, remaining frames to
+    `out_file` (default: replace `in_file` in place).
+
+    Args:
+        in_file (str): 4D NIfTI file to trim
+        nframes (int): number of initial frames to remove
+        dummy_file (str): output NIfTI holding only the removed frames
+        out_file (str): trimmed output, defaults to `in_file`
+    Returns:
+        str: path to the trimmed output
+    """
+    out_file = out_file or in_file
+    header = _disk_header(in_file)
+    shape, frame_bytes = _frame_layout(header)
+
+    if not 0 < nframes < shape[3]:
+        raise ValueError(f"Cannot remove {nframes} frames from {in_file} with {shape[3]} frames")
+
+    tmp_out = _tmp_name(out_file)
+    with ImageOpener(in_file, "rb") as src:
+        src.seek(header.get_data_offset())
+
+        with ImageOpener(dummy_file, "wb") as dst:
+            _write_header(header, shape[:3] + (nframes,), dst)
+            _copy_bytes(src, dst, nframes * frame_bytes)
+
+        with ImageOpener(tmp_out, "wb") as dst:
+            _write_header(header, shape[:3] + (shape[3] - nframes,), dst)
+            _copy_bytes(src, dst, (shape[3] - nframes) * frame_bytes)
+
+    os.replace(tmp_out, out_file)
+    log.debug("Split %s frames from %s", nframes, op.basename(in_file))
+
+    return out_file
+
+
+def prepend_volume_frames(frames_file, in_file, out_file=None):
+    """Add the frames stored in `frames_file` to the start of a 4D NIfTI (the inverse of split_volume_frames).
+
+    When both files share the same on-disk data type and scaling the frames are copied as raw bytes,
+    otherwise the prepended frames are converted to the data type and scaling of `in_file`.
+
+    Args:
+        frames_file (str): NIfTI holding the frames to prepend
+        in_file (str): 4D NIfTI file to extend
+        out_file (str): extended output, defaults to `in_file`
+    Returns:
+        str: path to the extended output
+    """
+    out_file = out_file or in_file
+    frames_header = _disk_header(frames_file)
+    header = _disk_header(in_file)
+    frames_shape, frames_bytes = _frame_layout(frames_header)
+    shape, frame_bytes = _frame_layout(header)
+
+    if frames_shape[:3] != shape[:3]:
+        raise ValueError(f"Spatial dimensions of {frames_file} {frames_shape[:3]} do not match {in_file} {shape[:3]}")
+
+    same_layout = (frames_header.get_data_dtype() == header.get_data_dtype()
+                   and _scaling(frames_header) == _scaling(header))
+
+    tmp_out = _tmp_name(out_file)
+    with ImageOpener(tmp_out, "wb") as dst:
+        _write_header(header, shape[:3] + (frames_shape[3] + shape[3],), dst)
+
+        if same_layout:
+            with ImageOpener(frames_file, "rb") as src:
+                src.seek(frames_header.get_data_offset())
+                _copy_bytes(src, dst, frames_shape[3] * frames_bytes)
+        else:
+            slope, inter = _scaling(header)
+            data = np.asanyarray(nib.load(frames_file).dataobj).reshape(frames_shape)
+            array_to_file(data, dst, header.get_data_dtype(), offset=None, intercept=inter, divslope=slope, order="F")
+
+        with ImageOpener(in_file, "rb") as src:
+            src.seek(header.get_data_offset())
+            _copy_bytes(src, dst, shape[3] * frame_bytes)
+
+    os.replace(tmp_out, out_file)
+    log.debug("Prepended %s frames to %s", frames_shape[3], op.basename(out_file))
+
+    return out_file
+
+
+def split_cifti_frames(in_file, nframes, dummy_file, out_file=None):
+    """Remove the first `nframes` series points from a CIFTI-2 dtseries, storing the removed frames separately.
+
+    Args:
+        in_file (str): CIFTI-2 dense timeseries to trim
+        nframes (int): number of initial frames to remove
+        dummy_file (str): output dtseries holding only the removed frames
+        out_file (str): trimmed output, defaults to `in_file`
+    Returns:
+        str: path to the trimmed output
+    """
+    out_file = out_file or in_file
+    header = _disk_header(in_file)
+    ntime, ncols, dtype = _series_layout(in_file, header)
+
+    if not 0 < nframes < ntime:
+        raise ValueError(f"Cannot remove {nframes} frames from {in_file} with {ntime} frames")
+
+    tmp_out = _tmp_name(out_file)
+    block = max(1, CHUNK_SIZE // (ntime * dtype.itemsize))
+    with ImageOpener(in_file, "rb") as src, ImageOpener(dummy_file, "wb") as dummy, \
+            ImageOpener(tmp_out, "wb") as dst:
+        src.seek(header.get_data_offset())
+        _write_cifti_header(in_file, header, nframes, dummy)
+        _write_cifti_header(in_file, header, ntime - nframes, dst)
+
+        for start in range(0, ncols, block):
+            cols = _read_columns(src, min(block, ncols - start), ntime, dtype)
+            dummy.write(cols[:, :nframes].tobytes())
+            dst.write(cols[:, nframes:].tobytes())
+
+    os.replace(tmp_out, out_file)
+    log.debug("Split %s frames from %s", nframes, op.basename(in_file))
+
+    return out_file
+
+
+def prepend_cifti_frames(frames_file, in_file, out_file=None):
+    """Add the series points stored in `frames_file` to the start of a CIFTI-2 dtseries.
+
+    Args:
+        frames_file (str): dtseries holding the frames to prepend
+        in_file (str): CIFTI-2 dense timeseries to extend
+        out_file (str): extended output, defaults to `in_file`
+    Returns:
+        str: path to the extended output
+    """
+    out_file = out_file or in_file
+    frames_header = _disk_header(frames_file)
+    header = _disk_header(in_file)
+    nframes, frames_cols, frames_dtype = _series_layout(frames_file, frames_header)
+    ntime, ncols, dtype = _series_layout(in_file, header)
+
+    if frames_cols != ncols:
+        raise ValueError(f"Number of grayordinates in {frames_file} ({frames_cols}) does not match {in_file} ({ncols})")
+
+    convert = frames_dtype != dtype or _scaling(frames_header) != _scaling(header)
+
+    tmp_out = _tmp_name(out_file)
+    block = max(1, CHUNK_SIZE // ((nframes + ntime) * dtype.itemsize))
+    with ImageOpener(frames_file, "rb") as fsrc, ImageOpener(in_file, "rb") as src, \
+            ImageOpener(tmp_out, "wb") as dst:
+        fsrc.seek(frames_header.get_data_offset())
+        src.seek(header.get_data_offset())
+        _write_cifti_header(in_file, header, nframes + ntime, dst)
+
+        for start in range(0, ncols, block):
+            n = min(block, ncols - start)
+            frames = _read_columns(fsrc, n, nframes, frames_dtype)
+            if convert:
+                slope, inter = _scaling(frames_header)
+                out_slope, out_inter = _scaling(header)
+                frames = ((frames * slope + inter - out_inter) / out_slope).astype(dtype)
+            dst.write(np.concatenate([frames, _read_columns(src, n, ntime, dtype)], axis=1).tobytes())
+
+    os.replace(tmp_out, out_file)
+    log.debug("Prepended %s frames to %s", nframes, op.basename(out_file))
+
+    return out_file
+
+
+def _series_layout(filename, header):
+    """Return (series points, grayordinates, on-disk dtype) of a CIFTI-2 file whose first axis is a series."""
+    cifti_header = nib.load(filename).header
+    if cifti_header.matrix.get_index_map(0).indices_map_to_data_type != "CIFTI_INDEX_TYPE_SERIES":
+        raise ValueError(f"First dimension of {filename} is not a series")
+
+    shape = header.get_data_shape()
+    if len(shape) != 6 or any(x != 1 for x in shape[:4]):
+        raise ValueError(f"Expected a 2D CIFTI-2 matrix, found NIfTI shape {shape}")
+
+    return int(shape[4]), int(shape[5]), header.get_data_dtype()
+
+
+def _read_columns(fileobj, ncols, ntime, dtype):
+    nbytes = ncols * ntime * dtype.itemsize
+    buf = fileobj.read(nbytes)
+    if len(buf) != nbytes:
+        raise EOFError(f"Unexpected end of file in {getattr(fileobj, 'name', fileobj)}")
+    return np.frombuffer(buf, dtype=dtype).reshape(ncols, ntime)
+
+
+def _write_cifti_header(template_file, header, ntime, fileobj):
+    """Write the NIfTI-2 header and CIFTI XML of `template_file` with `ntime` series points."""
+    cifti_header = nib.load(template_file).header
+    series = cifti_header.matrix.get_index_map(0)
+    series.number_of_series_points = ntime
+    series.series_start = 0
+
+    hdr = header.copy()
+    hdr.extensions = Nifti1Extensions(ext for ext in hdr.extensions if ext.get_code() != Cifti2Extension.code)
+    hdr.extensions.append(Cifti2Extension(Cifti2Extension.code, cifti_header.to_xml()))
+    # xml size may change, let the header choose the minimum data offset
+    hdr["vox_offset"] = 0
+
+    # series length is the fifth NIfTI dimension
+    shape = header.get_data_shape()
+    _write_header(hdr, shape[:4] + (ntime,) + shape[5:], fileobj)
+
+
+def _disk_header(filename):
+    """Read the NIfTI header as stored on disk (nib.load resets the data offset and scaling of img.header)."""
+    img = nib.load(filename)
+    # CIFTI-2 images keep the NIfTI-2 header separately from the CIFTI XML header
+    header_class = type(getattr(img, "nifti_header", img.header))
+    with ImageOpener(filename, "rb") as fobj:
+        return header_class.from_fileobj(fobj)
+
+
+def _frame_layout(header):
+    """Return the 4D shape and bytes per frame for a NIfTI header."""
+    shape = header.get_data_shape()
+    if len(shape) == 3:
+        shape = shape + (1,)
+    if len(shape) != 4:
+        raise ValueError(f"Expected a 3D or 4D NIfTI, found shape {shape}")
+
+    frame_bytes = int(np.prod(shape[:3])) * header.get_data_dtype().itemsize
+
+    return tuple(int(x) for x in shape), frame_bytes
+
+
+def _scaling(header):
+    slope, inter = header.get_slope_inter()
+    return (1.0 if slope is None else float(slope)), (0.0 if inter is None else float(inter))
+
+
+def _write_header(header, shape, fileobj):
+    """Write a copy of `header` with the new data shape, padded to the original data offset."""
+    hdr = header.copy()
+    hdr.set_data_shape(shape)
+    hdr.write_to(fileobj)
+    fileobj.write(b"\x00" * (int(hdr.get_data_offset()) - fileobj.tell()))
+
+
+def _copy_bytes(src, dst, nbytes):
+    while nbytes > 0:
+        buf = src.read(min(CHUNK_SIZE, nbytes))
+        if not buf:
+            raise EOFError(f"Unexpected end of file in {getattr(src, 'name', src)}")
+        dst.write(buf)
+        nbytes -= len(buf)
+
+
+def _tmp_name(filename):
+    # keep the extension so the opener uses the same compression as the final output
+    return op.join(op.dirname(filename), "tmp_" + op.basename(filename))
@@ -5,6 +5,7 @@ import glob
 import logging
 import os
 import subprocess as sp
+import time
 from pathlib import Path
 
 FWV0 = Path.cwd()
@@ -24,7 +25,8 @@ def zip_it_zip_it_good(output_dir, destination_id, name, path):
 
     log.debug('Creating viewable archive "' + dest_zip + '"')
 
-    command = ["zip", "-q", "-r", dest_zip, "index.html"]
+    # figures are already compressed images: store them as they are
+    command = ["zip", "-q", "-r", "-n", ".png:.webp", dest_zip, "index.html"]
 
     # find all directories called 'figures' and add them to the archive
     for root, dirs, files in os.walk(path):
@@ -38,7 +40,14 @@ def zip_it_zip_it_good(output_dir, destination_id, name, path):
     log.debug(f"pwd = %s", Path.cwd())
     log.debug(" ".join(command))
 
+    # zip adds to an existing archive: start from scratch so figures of earlier runs are not kept
+    if os.path.exists(dest_zip):
+        os.remove(dest_zip)
+
+    start = time.perf_counter()
     result = sp.run(command, check=True)
+    log.info("Report archive %s: %.1f MB in %.1f s", os.path.basename(dest_zip),
+             os.path.getsize(dest_zip) / 1024 ** 2, time.perf_counter() - start)
 
 
 def zip_htmls(output_dir, destination_id, path):